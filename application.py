@@ -16,92 +16,423 @@ authentication and authorization.
 
 # Importing Flask
 from flask import (
+    abort,
     flash,
     Flask,
+    g,
+    has_request_context,
     jsonify,
     redirect,
     render_template,
     request,
+    Response,
+    send_from_directory,
     url_for,
 )
 
 # Imports for SQLAlchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import (
+    joinedload,
+    scoped_session,
+    selectinload,
+    Session,
+    sessionmaker,
+    undefer,
+)
+from sqlalchemy.sql.expression import UpdateBase
 from database_setup import (
     Base,
     Exercises,
+    Jobs,
     PrimaryCategories,
     SecondaryCategories,
     Users,
-    Equipment,
     ExerciseEquipmentReference,
+    add_with_unique_slug,
 )
 
-import re
+import batch_programs
+import catalog_cache
+import catalog_export
+import catalog_snapshot
+import equipment_index
+import exercise_search
+import fragment_cache
+import http_cache
+import jobs
+import json_api
+import metrics
+import os
+import profiler
+import program_generator
+import static_images
 
 # Imports for local permissions
 from flask import session as login_session
 import random
 import string
+import threading
+import time
 
-# Imports for Oauth2 implementation
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
-import httplib2
+# Imports for Oauth2 implementation; google_login imports oauth2client and
+# the HTTP clients on first use.
+import google_login
 import json
 from flask import make_response
-import requests
 
 app = Flask(__name__)
 
-# Client ID for Google Login
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
-
 APPLICATION_NAME = "Green Machine Exercise Catalog"
 
-# Connecting to PostgreSQL DB exercisecatalog
-engine = create_engine('postgresql:///exercisecatalog')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Users are looked up by ID on exercise pages.
+user_cache = catalog_cache.TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 4096)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 600)))
+
+# Routes that write, and so read from the primary even for GET requests:
+# their forms must show the rows they are about to change.
+PRIMARY_ENDPOINTS = frozenset(['add_exercise', 'edit_exercise',
+                               'delete_exercise', 'gconnect'])
+
+# Routes whose catalog reads may be served from the catalog snapshot. Search
+# needs the full-text index of the database.
+SNAPSHOT_ENDPOINTS = frozenset([
+    'homepage', 'show_secondary_categories', 'show_exercises_in_category',
+    'show_exercise_description', 'exercises_JSON',
+    'secondary_categories_JSON', 'primary_categories_JSON',
+    'generate_program_JSON', 'catalog_JSON'])
+
+# Settings the database engines are created from.
+ENGINE_SETTINGS = ('DATABASE_URL', 'DATABASE_REPLICA_URL',
+                   'CATALOG_SNAPSHOT_DIR', 'DB_POOL_SIZE', 'DB_MAX_OVERFLOW',
+                   'DB_POOL_TIMEOUT', 'DB_POOL_RECYCLE')
+
+# The database engines of this process, created by get_engine(). Without a
+# replica, replica_engine is the primary engine. snapshots reads the catalog
+# snapshot, if CATALOG_SNAPSHOT_DIR is set.
+engine = None
+replica_engine = None
+snapshots = None
+_engine_pid = None
+_engine_settings = None
+_engine_lock = threading.Lock()
+
+
+class RoutingSession(Session):
+    """A session that sends writes to the primary and reads to the replica.
+
+    Reads go to the primary outside of requests, and for requests that must
+    see the latest data (see use_primary). Reads of the catalog tables alone
+    go to the catalog snapshot, when the request may use it, unless they
+    have the execution option snapshot=False.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase):
+            if has_request_context():
+                g.database_written = True
+                table = (mapper.local_table if mapper is not None
+                         else clause.table)
+                if table.name in catalog_snapshot.TABLE_NAMES:
+                    g.catalog_written = True
+            return engine
+        if not has_request_context() or g.get('use_primary', True):
+            return engine
+        snapshot = g.get('snapshot')
+        if (snapshot is not None and
+                catalog_snapshot.reads_only_snapshot_tables(clause) and
+                clause.get_execution_options().get('snapshot', True)):
+            return snapshot
+        return replica_engine
+
+
+DBSession = sessionmaker(class_=RoutingSession)
+
+# Writes to the catalog bump the catalog version that every worker watches.
+catalog_cache.track_writes(DBSession)
+
+
+@event.listens_for(DBSession, 'after_commit')
+def catalog_committed(session):
+    """Note when a request's catalog writes were committed."""
+    if has_request_context() and g.pop('catalog_written', False):
+        g.catalog_committed_at = time.time()
+
+# Each thread handling a request gets its own session from the registry.
+# The session is removed when the app context is torn down, so identity map
+# state never leaks between requests and a failed commit only affects the
+# request that caused it.
+session = scoped_session(DBSession)
+
+# Request latency, SQL statements and cache hit rates, served at /metrics.
+metrics.init_app(app, {'catalog': catalog_cache.catalog,
+                       'fragments': fragment_cache.fragments,
+                       'users': user_cache})
+
+# Opt-in request profiles and slow-request log, see profiler.py.
+profiler.init_app(app)
+
+
+# Template helper that renders responsive, content-hashed image variants.
+app.jinja_env.globals['responsive_image'] = static_images.responsive_image
+
+
+def create_app(config=None):
+    """Configure the application and return it.
+
+    The routes are registered on the module-level app, so this configures
+    that single app rather than building a new one: every call returns the
+    same app, with the settings of the latest call.
+
+    Settings are read from the environment; config, a mapping, overrides
+    them. The database engines are not created here but on first use in
+    each process (see get_engine), so a WSGI server may load the app before
+    it forks its worker processes. A call that changes the database settings
+    closes the engines already created, and the next use creates new ones.
+    """
+    global _engine_pid
+    app.config.update(
+        SECRET_KEY=os.environ.get('SECRET_KEY'),
+        DATABASE_URL=os.environ.get('DATABASE_URL',
+                                    'postgresql:///exercisecatalog'),
+        DATABASE_REPLICA_URL=os.environ.get('DATABASE_REPLICA_URL'),
+        REPLICA_STICKY_SECONDS=float(
+            os.environ.get('REPLICA_STICKY_SECONDS', 10)),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 5)),
+        DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        DB_POOL_TIMEOUT=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        DB_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        CLIENT_SECRETS=os.environ.get('CLIENT_SECRETS',
+                                      'client_secrets.json'),
+        BATCH_WORKERS=int(os.environ.get('BATCH_WORKERS', 0)) or None,
+        CATALOG_SNAPSHOT_DIR=os.environ.get('CATALOG_SNAPSHOT_DIR'),
+    )
+    app.config.update(config or {})
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('Set SECRET_KEY, which signs the login sessions.')
+    with _engine_lock:
+        if (_engine_pid == os.getpid() and
+                engine_settings() != _engine_settings):
+            dispose_engines()
+            _engine_pid = None
+    return app
+
+
+def engine_settings():
+    """Return the current values of the settings in ENGINE_SETTINGS."""
+    return tuple(app.config.get(i) for i in ENGINE_SETTINGS)
+
+
+def client_id():
+    """Return the Client ID for Google Login, read once on first use."""
+    if app.config.get('CLIENT_ID') is None:
+        with open(app.config['CLIENT_SECRETS'], 'r') as f:
+            app.config['CLIENT_ID'] = json.load(f)['web']['client_id']
+    return app.config['CLIENT_ID']
+
+
+def create_database_engine(url, config):
+    """Create the engine for a database URL and the pool settings."""
+    if url.startswith('sqlite'):
+        # SQLite (used by benchmark.py) has no connection pool to size.
+        return create_engine(url)
+    return create_engine(url,
+                         pool_size=config['DB_POOL_SIZE'],
+                         max_overflow=config['DB_MAX_OVERFLOW'],
+                         pool_timeout=config['DB_POOL_TIMEOUT'],
+                         pool_recycle=config['DB_POOL_RECYCLE'],
+                         pool_pre_ping=True,
+                         poolclass=metrics.TimedQueuePool)
+
+
+def get_engine():
+    """Return the primary database engine of this process.
+
+    The primary and replica engines are created on first use. A process
+    forked after they were created (a WSGI worker) creates its own, so pooled
+    connections are never shared between processes. create_app() drops them
+    when the database settings change.
+    """
+    global engine, replica_engine, snapshots, _engine_pid, _engine_settings
+    if _engine_pid == os.getpid():
+        return engine
+    with _engine_lock:
+        if _engine_pid != os.getpid():
+            for old in {engine, replica_engine} - {None}:
+                # The connections belong to the parent process; drop the
+                # pool without closing them.
+                old.dispose(close=False)
+            engine = create_database_engine(app.config['DATABASE_URL'],
+                                            app.config)
+            metrics.instrument_engine(engine, 'primary')
+            profiler.instrument_engine(engine)
+            replica_engine = engine
+            if app.config.get('DATABASE_REPLICA_URL'):
+                replica_engine = create_database_engine(
+                    app.config['DATABASE_REPLICA_URL'], app.config)
+                metrics.instrument_engine(replica_engine, 'replica')
+                profiler.instrument_engine(replica_engine)
+            if snapshots is not None:
+                snapshots.dispose()
+            snapshots = None
+            if app.config.get('CATALOG_SNAPSHOT_DIR'):
+                snapshots = catalog_snapshot.SnapshotReader(
+                    app.config['CATALOG_SNAPSHOT_DIR'],
+                    app.config['DB_POOL_SIZE'], on_swap=snapshot_swapped)
+            Base.metadata.bind = engine
+            DBSession.configure(bind=engine)
+            _engine_settings = engine_settings()
+            _engine_pid = os.getpid()
+    return engine
+
+
+def snapshot_swapped(reader):
+    """Start serving a newly published catalog snapshot."""
+    if reader.current is not None:
+        metrics.instrument_engine(reader.current, 'snapshot')
+        profiler.instrument_engine(reader.current)
+    invalidate_catalog()
+
+
+def invalidate_catalog():
+    """Drop everything this process cached from the catalog."""
+    catalog_cache.catalog.invalidate()
+    fragment_cache.invalidate()
+
+
+def dispose_engines():
+    """Close the pooled connections of this process."""
+    for i in {engine, replica_engine} - {None}:
+        i.dispose()
+    if snapshots is not None:
+        snapshots.dispose()
+
+
+def use_primary():
+    """Return whether the current request must read from the primary.
+
+    Writes, the write routes and, for read-your-writes, every request of a
+    user who wrote in the last REPLICA_STICKY_SECONDS read the primary, as
+    neither the replica nor the caches of the other workers may have caught
+    up with their change yet.
+    """
+    return (request.method not in ('GET', 'HEAD') or
+            request.endpoint in PRIMARY_ENDPOINTS or
+            login_session.get('primary_until', 0) > time.time())
+
+
+def bypass_caches():
+    """Return whether the current request must not use the process caches.
+
+    Requests that read the primary (see use_primary), such as those of a user
+    who just wrote, and requests of a user whose catalog write no published
+    snapshot has yet, neither read nor fill the catalog and fragment caches
+    and are never answered with 304: another worker may have handled the
+    write, so this process's caches may not show it yet.
+    """
+    return has_request_context() and bool(
+        g.get('use_primary', False) or g.get('bypass_caches', False))
+
+
+catalog_cache.catalog.bypass = bypass_caches
+fragment_cache.fragments.bypass = bypass_caches
+
+
+@app.before_request
+def connect_database():
+    """Make sure this process is connected before the view runs."""
+    get_engine()
+    g.use_primary = use_primary()
+    # Requests that read the primary bypass the caches. The others read the
+    # version where they read the catalog, so once they see a new version
+    # they reload the write with it.
+    if not g.use_primary and catalog_cache.versions.changed(session):
+        invalidate_catalog()
+    if (snapshots is not None and not g.use_primary and
+            request.endpoint in SNAPSHOT_ENDPOINTS):
+        g.snapshot = snapshots.engine()
+        # Users read their own catalog writes from the database, past the
+        # process caches, until a snapshot taken after them is published.
+        if (g.snapshot is not None and
+                login_session.get('catalog_written_at', 0) >=
+                snapshots.taken_at):
+            g.snapshot = None
+            g.bypass_caches = True
+        # A snapshot older than the catalog version this process has seen
+        # misses writes the database has, whichever path made them.
+        seen = catalog_cache.versions.version
+        if (g.snapshot is not None and
+                (seen is None or snapshots.catalog_version is None or
+                 snapshots.catalog_version < seen)):
+            g.snapshot = None
+
+
+@app.after_request
+def stick_to_primary(response):
+    """Send the next requests of a user who just wrote to the primary."""
+    if g.get('database_written'):
+        login_session['primary_until'] = (
+            time.time() + app.config['REPLICA_STICKY_SECONDS'])
+    if g.get('catalog_committed_at') and snapshots is not None:
+        login_session['catalog_written_at'] = g.catalog_committed_at
+    return response
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Roll back any unfinished work and return the connection to the pool."""
+    session.remove()
 
 
 @app.route('/')
 @app.route('/exercises/')
+@http_cache.conditional(lambda: ['primary'], vary=lambda: login_name(),
+                        versions=http_cache.page_versions)
 def homepage():
     """Render the homepage with primary categories listed."""
-    primary_categories = session.query(PrimaryCategories).all()
+    primary_categories = catalog_cache.primary_categories(session)
+    body = fragment_cache.render_fragment('homepageBody.html', ['primary'],
+                                          category_names=primary_categories)
     return render_template('homepage.html',
-                           category_names=primary_categories,
+                           body=body,
                            first_name=login_name())
 
 
 @app.route('/exercises/<int:primary_category_id>/')
+@http_cache.conditional(lambda **kw: ['primary', 'secondary'],
+                        vary=lambda: login_name(),
+                        versions=http_cache.page_versions)
 def show_secondary_categories(primary_category_id):
     """Render the secondary categories on the page.
 
     Secondary categories are dependent on the primary category selected.
     """
     # Isolates the primary category from the primary category ID.
-    primary = (
-        session.query(PrimaryCategories)
-        .filter_by(id=primary_category_id).one()
-    )
+    primary = catalog_cache.primary_category(session, primary_category_id)
+    if primary is None:
+        abort(404)
 
     # Selects all secondary categories based on the selecte primary category.
     secondary_categories = (
-        session.query(SecondaryCategories)
-        .filter(SecondaryCategories.primary_category == primary_category_id)
+        catalog_cache.secondary_categories(session, primary_category_id)
     )
+    body = fragment_cache.render_fragment(
+        'secondaryBody.html', ['primary', 'secondary'],
+        secondary_category=secondary_categories, primary_id=primary['id'])
     return render_template('secondary.html',
-                           secondary_category=secondary_categories,
+                           body=body,
                            primary_category=primary,
-                           primary_id=primary.id, first_name=login_name())
+                           primary_id=primary['id'], first_name=login_name())
 
 
 @app.route('/exercises/<int:primary_category_id>/<int:secondary_id>/')
+@http_cache.conditional(lambda secondary_id, **kw: ['primary', 'secondary',
+                                                    ('exercises',
+                                                     secondary_id)],
+                        vary=lambda: login_name(),
+                        versions=http_cache.page_versions)
 def show_exercises_in_category(primary_category_id, secondary_id):
     """Render a page with a list of all exercises.
 
@@ -109,83 +440,55 @@ def show_exercises_in_category(primary_category_id, secondary_id):
     Provide an add an exercise button.
     """
     # Isolates the primary category from the primary category ID.
-    primary = (
-        session.query(PrimaryCategories)
-        .filter_by(id=primary_category_id).one()
-    )
+    primary = catalog_cache.primary_category(session, primary_category_id)
 
     # Find the secondary category information based on secondary ID.
-    secondary_info = (
-        session.query(SecondaryCategories.name, SecondaryCategories.id)
-        .filter_by(id=secondary_id).one()
-    )
-
-    """Find all exercises tied to the secondary category."""
-    exercises = (
-        session.query(Exercises)
-        .filter(secondary_id == Exercises.secondary_category)
-    )
-
+    secondary_info = catalog_cache.secondary_category(session, secondary_id)
+    if primary is None or secondary_info is None:
+        abort(404)
+
+    """Find all exercises tied to the secondary category, keeping only the
+    ones doable with the requested equipment, if any."""
+    exercises = feasible_exercises(
+        catalog_cache.exercises(session, secondary_id))
+
+    body = fragment_cache.render_fragment(
+        'exercisesBody.html',
+        ['primary', 'secondary', ('exercises', secondary_id)],
+        exercise_names=exercises, primary_category_id=primary['id'])
     return render_template('exercises.html',
-                           primary_category_id=primary.id,
-                           secondary_id=secondary_info.id,
-                           exercise_names=exercises,
+                           body=body,
+                           primary_category_id=primary['id'],
+                           secondary_id=secondary_info['id'],
                            category_name=secondary_info,
                            first_name=login_name())
 
 
 @app.route('/exercises/<int:primary_category_id>/<int:secondary_id>/'
-           '<string:exercise_name>/')
+           '<string:exercise_slug>/')
 def show_exercise_description(primary_category_id, secondary_id,
-                              exercise_name):
+                              exercise_slug):
     """Display a specific exercise selected.
 
     Display with exercise name, description, and an embedded YouTube video.
     If the user is the owner, they will be able to edit or delete the exercise.
     If they are not, they can only view the exercise.
     """
-    """Reformat the exercise name that was passed in through
-    the URL to exclude dashes.
+    """Load the exercise together with everything the page renders: its
+    categories in one joined query, and its equipment in a second query,
+    no matter how much equipment the exercise uses.
     """
-    exercise_name = exercise_name.replace('-', ' ')
-    exercise_name = re.sub(r'   ', ' - ', exercise_name)
-
-    # Display primary category.
-    primary = (
-        session.query(PrimaryCategories)
-        .filter_by(id=primary_category_id).one()
-    )
-    # Display secondary category.
-    secondary_info = (
-        session.query(SecondaryCategories.id)
-        .filter_by(id=secondary_id).one()
-    )
-
-    # Display exercise.
     exercise_info = (
-        session.query(Exercises).filter_by(name=exercise_name).one()
-    )
-
-    """
-    Extracting equipment ID from exercise_equipment_reference table based on
-    the exercise ID.
-    """
-    equipment_exercise_id = (
-        session.query(ExerciseEquipmentReference.equipment_id).filter_by(exercise_id=exercise_info.id).all()
+        session.query(Exercises)
+        .options(joinedload(Exercises.secondary)
+                 .joinedload(SecondaryCategories.primary),
+                 selectinload(Exercises.equipment_references)
+                 .joinedload(ExerciseEquipmentReference.equipment))
+        .filter_by(secondary_category=secondary_id, slug=exercise_slug).one()
     )
-
-    equipment = []
-
-    for id in equipment_exercise_id:
-        id = id[0]
-
-        # Finding the name of the equipment from the equipment ID
-        equipment_details = (
-            session.query(Equipment).filter_by(id=id).one()
-        )
-
-        equipment.append(equipment_details)
-
+    primary = exercise_info.secondary.primary
+    secondary_info = exercise_info.secondary
+    equipment = exercise_info.equipment
 
     # Find the creator of the exercise.
     creator = get_user_info(exercise_info.user_id)
@@ -196,7 +499,7 @@ def show_exercise_description(primary_category_id, secondary_id,
     """
     if (
         'username' not in login_session or
-        creator.id != login_session['user_id']
+        exercise_info.user_id != login_session['user_id']
     ):
         return render_template('publicExerciseDescription.html',
                                primary_category_id=primary.id,
@@ -214,20 +517,18 @@ def show_exercise_description(primary_category_id, secondary_id,
 
 
 @app.route('/exercises/<int:primary_category_id>/<int:secondary_id>/'
-           '<string:exercise_name>/edit/', methods=['GET', 'POST'])
-def edit_exercise(primary_category_id, secondary_id, exercise_name):
+           '<string:exercise_slug>/edit/', methods=['GET', 'POST'])
+def edit_exercise(primary_category_id, secondary_id, exercise_slug):
     """Allow user to edit an exercise.
 
     All fields must be edited, including name, description, and video url.
     All edits are saved to the exercisecatalog DB.
     """
-    """Reformatting the name that was passed in through
-    the URL to exclude dashes."""
-    exercise_name = exercise_name.replace('-', ' ')
-    exercise_name = re.sub(r'   ', ' - ', exercise_name)
-
-    # Find specific exercise based on passed in exercise name.
-    exercises = session.query(Exercises).filter_by(name=exercise_name).one()
+    # Find specific exercise based on passed in exercise slug.
+    exercises = (
+        session.query(Exercises)
+        .filter_by(secondary_category=secondary_id, slug=exercise_slug).one()
+    )
 
     # If user is not logged in, redirect to the login page.
     if 'username' not in login_session:
@@ -252,8 +553,9 @@ def edit_exercise(primary_category_id, secondary_id, exercise_name):
             exercises.name = request.form['name']
             exercises.description = request.form['description']
             exercises.video_url = request.form['video_url']
-        session.add(exercises)
+        add_with_unique_slug(session, exercises)
         session.commit()
+        exercise_changed(secondary_id, exercises.id)
         flash("Your exercise has been edited!")
         return redirect(url_for('show_exercises_in_category',
                                 primary_category_id=primary_category_id,
@@ -266,19 +568,17 @@ def edit_exercise(primary_category_id, secondary_id, exercise_name):
 
 
 @app.route('/exercises/<int:primary_category_id>/<int:secondary_id>/'
-           '<string:exercise_name>/delete/', methods=['GET', 'POST'])
-def delete_exercise(primary_category_id, secondary_id, exercise_name):
+           '<string:exercise_slug>/delete/', methods=['GET', 'POST'])
+def delete_exercise(primary_category_id, secondary_id, exercise_slug):
     """Allow the user to delete all information regarding an exercise.
 
     The user must be the owner of the exercise to delete.
     """
-    """Reformat the name that was passed in through the URL
-    to exclude dashes."""
-    exercise_name = exercise_name.replace('-', ' ')
-    exercise_name = re.sub(r'   ', ' - ', exercise_name)
-
     # SQLAlchemy query to identify exercise to be deleted.
-    to_delete = session.query(Exercises).filter_by(name=exercise_name).one()
+    to_delete = (
+        session.query(Exercises)
+        .filter_by(secondary_category=secondary_id, slug=exercise_slug).one()
+    )
 
     # If user is not logged in, redirect to the login page.
     if 'username' not in login_session:
@@ -296,15 +596,18 @@ def delete_exercise(primary_category_id, secondary_id, exercise_name):
 
     """Delete exercise from database. Then redirect to list of exercises."""
     if request.method == 'POST':
+        exercise_id = to_delete.id
         session.delete(to_delete)
         session.commit()
+        exercise_changed(secondary_id, exercise_id)
         flash("This exercise has been deleted!")
         return redirect(url_for('show_exercises_in_category',
                                 primary_category_id=primary_category_id,
                                 secondary_id=secondary_id))
     else:
         return render_template('deleteExercise.html',
-                               exercise_name=exercise_name,
+                               exercise_name=to_delete.name,
+                               exercise_slug=to_delete.slug,
                                primary_category_id=primary_category_id,
                                secondary_id=secondary_id)
 
@@ -317,16 +620,15 @@ def add_exercise(primary_category_id, secondary_id):
     All fields are required, including the name, description, and YouTube video
     embed URL. Any user may add an exercise, but the user must be logged in.
     """
-    # SQLAlchemy query to identify secondary category to store new exercise in.
-    name = session.query(SecondaryCategories).filter_by(id=secondary_id).one()
-
-    # Storing info of all equipment for user to select later.
-    equipment_list = session.query(Equipment).all()
-
     # If user is not logged in, redirect to the login page.
     if 'username' not in login_session:
         return redirect('/login')
 
+    # Identify the secondary category to store the new exercise in.
+    name = catalog_cache.secondary_category(session, secondary_id)
+    if name is None:
+        abort(404)
+
     """Add exercise to the database. Then redirect to list of exercises."""
     if request.method == 'POST':
         new_exercise = (
@@ -334,12 +636,12 @@ def add_exercise(primary_category_id, secondary_id):
                       description=request.form['description'],
                       video_url=request.form['video_url'],
                       secondary_category=secondary_id,
-                      user_id=login_session['user_id'],
-                      equipment=equipment_list)
+                      user_id=login_session['user_id'])
         )
 
-        session.add(new_exercise)
+        add_with_unique_slug(session, new_exercise)
         session.commit()
+        exercise_changed(secondary_id, new_exercise.id)
         flash("Your new exercise has been created!")
         return redirect(url_for('show_exercises_in_category',
                                 primary_category_id=primary_category_id,
@@ -349,7 +651,36 @@ def add_exercise(primary_category_id, secondary_id):
                                category_name=name,
                                primary_category_id=primary_category_id,
                                secondary_id=secondary_id,
-                               equipment=equipment_list)
+                               equipment=catalog_cache.equipment(session))
+
+
+@app.route('/search/')
+def search():
+    """Render the exercises that best match the search text."""
+    search_text = request.args.get('q', '').strip()
+    results = exercise_search.search_exercises(
+        session, search_text,
+        json_api.int_arg('limit', exercise_search.DEFAULT_LIMIT))
+    return render_template('search.html',
+                           search_text=search_text,
+                           results=results,
+                           first_name=login_name())
+
+
+@app.route('/static/build/<path:filename>')
+def static_build(filename):
+    """Serve the content-hashed image variants with far-future caching."""
+    response = send_from_directory(static_images.BUILD_DIR, filename,
+                                   max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Expose request, database, and cache metrics for Prometheus."""
+    return metrics.response()
 
 
 @app.route('/login')
@@ -370,60 +701,44 @@ def gconnect():
     username, picture, email, and first name.
     """
     # If state token does not match user's state token, alert user.
-    if request.args.get('state') != login_session['state']:
+    if request.args.get('state') != login_session.get('state'):
         r_json = 'Invalid state token.'
         error_code = 401
         r = 'Sorry, we cannot log you in.'
-        gconnect_errors(r_json, error_code, r)
+        return gconnect_errors(r_json, error_code, r)
 
     code = request.data
 
     try:
         """Upgrade the authorization code into a credentials object.
         If there is an error, alert user."""
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        credentials = google_login.exchange_code(app.config['CLIENT_SECRETS'],
+                                                 code)
+    except google_login.LoginError:
         r_json = 'Failed to upgrade the authorization code.'
         error_code = 401
         r = 'Sorry, we cannot log you in.'
-        gconnect_errors(r_json, error_code, r)
+        return gconnect_errors(r_json, error_code, r)
 
-    # Check to see if the access token is valid.
-    access_token = credentials.access_token
-    url = (
-           'https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token
-    )
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1].decode('utf8'))
-
-    """If there is an error in the access token info,
-    then do not log in and return an error."""
-    if result.get('error') is not None:
-        print("ERROR ERROR")
-        r_json = 'error'
-        error_code = 500
+    """Verify the ID token locally: it must be signed by Google, issued to
+    this app, and unexpired. Otherwise, return an error."""
+    try:
+        claims = google_login.verify_id_token(
+            credentials.token_response['id_token'], client_id())
+    except (google_login.LoginError, KeyError):
+        r_json = "Token could not be verified."
+        error_code = 401
         r = 'Sorry, we cannot log you in.'
-        gconnect_errors(r_json, error_code, r)
+        return gconnect_errors(r_json, error_code, r)
 
-    """Verify that access token is for the intended user.
+    """Verify that the ID token is for the intended user.
     Otherwise, return an error."""
     gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
+    if claims['sub'] != gplus_id:
         r_json = "Token's user ID does not match given user ID."
         error_code = 401
         r = 'Sorry, we cannot log you in.'
-        gconnect_errors(r_json, error_code, r)
-
-    """Verify that the access token is valid for the app.
-    Otherwise, return an error."""
-    if result['issued_to'] != CLIENT_ID:
-        r_json = "Token's client ID does not match app's"
-        error_code = 401
-        r = 'Sorry, we cannot log you in.'
-        gconnect_errors(r_json, error_code, r)
+        return gconnect_errors(r_json, error_code, r)
 
     """Check to see if the user is already logged into the system.
     If so, alert user."""
@@ -433,29 +748,29 @@ def gconnect():
         r_json = 'Current user is already logged in.'
         error_code = 200
         r = 'You are already signed in.'
-        gconnect_errors(r_json, error_code, r)
+        return gconnect_errors(r_json, error_code, r)
+
+    # Get user info, from the ID token when it carries the profile.
+    try:
+        data = google_login.user_info(credentials.access_token, claims)
+    except google_login.LoginError:
+        r_json = 'Failed to get user info.'
+        error_code = 500
+        r = 'Sorry, we cannot log you in.'
+        return gconnect_errors(r_json, error_code, r)
 
     # Store access token in the session for later use.
     login_session['access_token'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info.
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    data = answer.json()
-
     # Storing user information.
     login_session['username'] = data["name"]
     login_session['picture'] = data["picture"]
     login_session['email'] = data["email"]
     login_session['first_name'] = data["given_name"]
 
-    # If user does not exist, create a new user.
-    user_id = get_user_id(login_session['email'])
-    if not user_id:
-        user_id = create_user(login_session)
-    login_session['user_id'] = user_id
+    # Create the user if they do not exist yet, and find their ID.
+    login_session['user_id'] = create_user(login_session)
 
     # Flash Login message to user and render the login confirmation page.
     flash("You are now logged in as %s" % login_session['username'])
@@ -488,14 +803,7 @@ def gdisconnect():
                                'signed in.')
 
     # Execute HTTP GET request to revoke current token.
-    url = (
-           'https://accounts.google.com/o/oauth2/revoke?token=%s'
-           % login_session['access_token']
-    )
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-
-    if result['status'] == '200':
+    if google_login.revoke(access_token):
         # Resetting the user's session
         del login_session['access_token']
         del login_session['gplus_id']
@@ -523,30 +831,219 @@ def gdisconnect():
 
 
 @app.route('/exercises/<int:primary_category_id>/<int:secondary_id>/JSON/')
+@http_cache.conditional(lambda secondary_id, **kw: [('exercises',
+                                                     secondary_id)],
+                        versions=lambda: equipment_versions())
 def exercises_JSON(primary_category_id, secondary_id):
-    """Create an API Endpoint for exercises within a secondary category."""
-    exercises = (
-        session.query(Exercises)
-        .filter_by(secondary_category=secondary_id).all()
-    )
-    return jsonify(Exercises=[i.serialize for i in exercises])
+    """Create an API Endpoint for exercises within a secondary category.
+
+    Pass equipment as a comma separated list of equipment IDs to only list
+    exercises that can be done with that equipment.
+    """
+    if json_api.wants_paging():
+        query = (
+            session.query(Exercises)
+            .filter_by(secondary_category=secondary_id)
+        )
+        owned = json_api.int_set_arg('equipment')
+        if owned is not None:
+            query = query.filter(equipment_index.feasible_clause(owned))
+        return json_api.paginated_json('Exercises', query, Exercises.id)
+
+    exercises = feasible_exercises(
+        catalog_cache.exercises(session, secondary_id))
+    return jsonify(Exercises=[
+        {k: i[k] for k in ('id', 'name', 'description', 'video_url')}
+        for i in exercises
+    ])
 
 
 @app.route('/exercises/<int:primary_category_id>/JSON/')
+@http_cache.conditional(lambda **kw: ['secondary'])
 def secondary_categories_JSON(primary_category_id):
     """Create an API Endpoint for all secondary categories."""
-    categories = (
-        session.query(SecondaryCategories)
-        .filter_by(primary_category=primary_category_id).all()
-    )
-    return jsonify(Categories=[i.serialize for i in categories])
+    if json_api.wants_paging():
+        return json_api.paginated_json(
+            'Categories',
+            session.query(SecondaryCategories)
+            .filter_by(primary_category=primary_category_id),
+            SecondaryCategories.id)
+
+    categories = catalog_cache.secondary_categories(session,
+                                                    primary_category_id)
+    return jsonify(Categories=list(categories))
 
 
 @app.route('/exercises/JSON/')
+@http_cache.conditional(lambda: ['primary'])
 def primary_categories_JSON():
     """Create an API Endpoint for all primary categories."""
-    categories = session.query(PrimaryCategories).all()
-    return jsonify(Categories=[i.serialize for i in categories])
+    if json_api.wants_paging():
+        return json_api.paginated_json('Categories',
+                                       session.query(PrimaryCategories),
+                                       PrimaryCategories.id)
+
+    categories = catalog_cache.primary_categories(session)
+    return jsonify(Categories=list(categories))
+
+
+@app.route('/templates/<int:template_id>/generate/JSON/')
+def generate_program_JSON(template_id):
+    """Create an API Endpoint that generates a program from a template.
+
+    The optional equipment argument is a comma separated list of the
+    equipment IDs the user owns; without it all equipment is available.
+    Pass seed to make the generated program reproducible.
+    """
+    seed = json_api.int_arg('seed')
+    program = program_generator.generate_program(
+        session, template_id,
+        owned_equipment=json_api.int_set_arg('equipment'),
+        rng=random.Random(seed) if seed is not None else random)
+    if program is None:
+        abort(404)
+    return jsonify(program)
+
+
+@app.route('/templates/<int:template_id>/generate/batch/',
+           methods=['POST'])
+def generate_programs_batch(template_id):
+    """Generate programs from a template for a whole list of clients.
+
+    The request body is JSON: {"clients": [{"client": ..., "equipment":
+    [IDs]}, ...], "seed": n}, where seed is optional. The programs are
+    streamed as NDJSON as they are generated, or as CSV with format=csv.
+    """
+    if 'username' not in login_session:
+        abort(401)
+    lines, content_type = batch_programs.FORMATS.get(
+        request.args.get('format', 'ndjson'), (None, None))
+    data = request.get_json(silent=True)
+    if lines is None or not isinstance(data, dict):
+        abort(400)
+    seed = data.get('seed')
+    try:
+        clients = batch_programs.read_clients(data.get('clients'))
+    except ValueError:
+        abort(400)
+    if seed is not None and not isinstance(seed, int):
+        abort(400)
+
+    loaded = batch_programs.load_batch(session, template_id)
+    if loaded is None:
+        abort(404)
+
+    def report(count, seconds):
+        app.logger.info('Generated %d programs from template %d in %.3fs '
+                        '(%.0f programs/s)', count, template_id, seconds,
+                        count / seconds if seconds else 0)
+
+    programs = batch_programs.generate_programs(
+        *loaded, clients, seed=seed, workers=app.config['BATCH_WORKERS'])
+    return Response(lines(batch_programs.timed(programs, report)),
+                    content_type=content_type)
+
+
+@app.route('/templates/<int:template_id>/generate/jobs/',
+           methods=['POST'])
+def queue_programs_batch(template_id):
+    """Queue the generation of programs for a list of clients.
+
+    The request body is the same as for generate_programs_batch. Answer 202
+    with the queued job; its status is at job_JSON and, once it succeeded,
+    the programs are at job_output.
+    """
+    if 'username' not in login_session:
+        abort(401)
+    data = request.get_json(silent=True)
+    if (not isinstance(data, dict) or
+            request.args.get('format', 'ndjson') not in
+            batch_programs.FORMATS):
+        abort(400)
+    try:
+        batch_programs.read_clients(data.get('clients'))
+    except ValueError:
+        abort(400)
+    if data.get('seed') is not None and not isinstance(data['seed'], int):
+        abort(400)
+
+    job = jobs.enqueue(session, 'generate_programs', {
+        'template_id': template_id,
+        'clients': data['clients'],
+        'seed': data.get('seed'),
+        'format': request.args.get('format', 'ndjson'),
+    }, user_id=login_session['user_id'])
+    session.commit()
+    response = jsonify(Job=job.serialize)
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_JSON', job_id=job.id)
+    return response
+
+
+def users_job(job_id, *options):
+    """Return a job of the logged in user, or abort with 401 or 404."""
+    if 'username' not in login_session:
+        abort(401)
+    job = session.query(Jobs).options(*options).filter_by(
+        id=job_id, user_id=login_session['user_id']).one_or_none()
+    if job is None:
+        abort(404)
+    return job
+
+
+@app.route('/jobs/<int:job_id>/JSON/')
+def job_JSON(job_id):
+    """Create an API Endpoint with the status and progress of a job."""
+    job = users_job(job_id)
+    data = job.serialize
+    if job.output_type is not None:
+        data['output'] = url_for('job_output', job_id=job.id)
+    return jsonify(Job=data)
+
+
+@app.route('/jobs/<int:job_id>/output/')
+def job_output(job_id):
+    """Download the file a job produced."""
+    job = users_job(job_id, undefer(Jobs.output))
+    if job.output_type is None:
+        abort(404)
+    return Response(job.output, content_type=job.output_type)
+
+
+@app.route('/search/JSON/')
+def search_JSON():
+    """Create an API Endpoint for full-text exercise search."""
+    results = exercise_search.search_exercises(
+        session, request.args.get('q', ''),
+        json_api.int_arg('limit', exercise_search.DEFAULT_LIMIT))
+    return jsonify(Exercises=results)
+
+
+@app.route('/catalog/JSON/')
+def catalog_JSON():
+    """Create an API Endpoint with the whole catalog tree.
+
+    The response is gzip-compressed when the client accepts it, and its
+    ETag is the catalog version so unchanged catalogs are answered with 304.
+    The gzip-compressed representation has its own ETag, the version with a
+    -gzip suffix.
+    """
+    version, chunks = catalog_export.catalog_export(session)
+    gzipped = 'gzip' in request.accept_encodings
+    etag = version + '-gzip' if gzipped else version
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif gzipped:
+        response = Response(chunks, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Length'] = sum(len(i) for i in chunks)
+    else:
+        response = Response(catalog_export.decompressed(chunks),
+                            mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['X-Catalog-Version'] = version
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 def login_name():
@@ -559,36 +1056,108 @@ def login_name():
         return first_name
 
 
-def get_user_id(email):
-    """Find the user ID based on email for local permissions."""
-    try:
-        user = session.query(Users).filter_by(email=email).one()
-        return user.id
-    except:
-        return None
+def equipment_versions():
+    """Return the version an equipment filtered response is built from.
+
+    Equipment filters read the equipment references, which no catalog cache
+    entry covers; the catalog version this process has seen does.
+    """
+    if 'equipment' not in request.args:
+        return []
+    version = catalog_cache.versions.version
+    return None if version is None else [str(version)]
+
+
+def feasible_exercises(exercises):
+    """Keep the exercises doable with the requested equipment, if any."""
+    owned = json_api.int_set_arg('equipment')
+    if owned is None:
+        return exercises
+    feasible = equipment_index.index.feasible(session, owned,
+                                              [i['id'] for i in exercises])
+    return [i for i in exercises if i['id'] in feasible]
+
+
+def exercise_changed(secondary_id, exercise_id):
+    """Update the caches and indexes after an exercise write is committed."""
+    invalidate_exercise_caches(secondary_id)
+    equipment_index.index.refresh_exercise(session, exercise_id)
+    if snapshots is not None:
+        queue_snapshot_export()
+
+
+def queue_snapshot_export():
+    """Queue a catalog snapshot export, unless one is already waiting."""
+    jobs.queue_snapshot_export(session, app.config['CATALOG_SNAPSHOT_DIR'])
+    session.commit()
+
+
+def invalidate_exercise_caches(secondary_id):
+    """Drop the cached data that shows the exercises of a category."""
+    catalog_cache.invalidate_exercises(secondary_id)
+    fragment_cache.invalidate()
+
+
+def cache_user(user):
+    """Store a user's details in the user cache."""
+    user_cache.put(('id', user['id']), user)
 
 
 def get_user_info(user_id):
     """Return all user information based on user ID."""
-    user = session.query(Users).filter_by(id=user_id).one()
+    def load():
+        user = session.query(Users).filter_by(id=user_id).one_or_none()
+        if user is None:
+            return None
+        return {'id': user.id, 'name': user.name, 'email': user.email,
+                'picture': user.picture}
+
+    user = user_cache.get(('id', user_id), load)
+    if user is None:
+        # Do not remember unknown users; one may be created later.
+        user_cache.invalidate(('id', user_id))
     return user
 
 
 def create_user(login_session):
-    """Create a new user if user does not yet exist."""
-    new_user = (
-        Users(name=login_session['username'],
-              email=login_session['email'],
-              picture=login_session['picture'])
-    )
+    """Create a new user, or update the details of an existing one.
+
+    Return the user ID. On PostgreSQL this is a single
+    INSERT ... ON CONFLICT ... RETURNING statement.
+    """
+    user = {'name': login_session['username'],
+            'email': login_session['email'],
+            'picture': login_session['picture']}
+
+    if session.get_bind().dialect.name == 'postgresql':
+        insert = pg_insert(Users).values(**user)
+        insert = insert.on_conflict_do_update(
+            index_elements=[Users.email],
+            set_={'name': insert.excluded.name,
+                  'picture': insert.excluded.picture},
+        ).returning(Users.id)
+        user['id'] = session.execute(insert).scalar()
+    else:
+        existing = (
+            session.query(Users).filter_by(email=user['email']).one_or_none()
+        )
+        if existing is None:
+            existing = Users(email=user['email'])
+            session.add(existing)
+        existing.name = user['name']
+        existing.picture = user['picture']
+        session.flush()
+        user['id'] = existing.id
 
-    session.add(new_user)
     session.commit()
-    user = session.query(Users).filter_by(email=login_session['email']).one()
-    return user.id
+    cache_user(user)
+    return user['id']
 
 
 if __name__ == '__main__':
-    app.secret_key = 'super_secret_key'
-    app.debug = True
+    # Development server; see wsgi.py for serving in production.
+    create_app({
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'super_secret_key'),
+        'DEBUG': True,
+    })
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""
+Batch program generation for whole client rosters.
+
+A trainer generates programs from one template for many clients at once,
+each client with their own equipment. The template, the exercise pools of
+its secondary categories and their equipment references are loaded once,
+with the same two queries as a single program. The programs are then
+generated from memory, at thousands of programs per second for templates of
+a few items, so a roster is usually generated in this process. A batch large
+enough to outweigh the startup of worker processes (see PARALLEL_MIN_CHECKS)
+is spread across the CPU cores by a process pool instead. Each worker process
+receives the loaded template and pools once, when it starts; after that only
+the client profiles are sent to it.
+
+Programs come back in the order of the clients, so they can be written out
+as they are generated: as NDJSON, one program per line, or as CSV, one row
+per template item.
+
+    python batch_programs.py 3 clients.json --format csv --output programs.csv
+
+clients.json holds a list of {"client": ..., "equipment": [IDs]} objects. A
+client without an equipment list has access to all equipment. The
+throughput, in programs per second, is reported on stderr.
+"""
+
+import collections
+import concurrent.futures
+import csv
+import io
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import program_generator
+
+MAX_CLIENTS = 1000
+
+# Clients sent to a worker process at a time.
+CHUNK_SIZE = 25
+
+# Batches that check fewer exercises than this (clients times the candidate
+# exercises of every template item) are generated in this process: about two
+# seconds of work, which starting worker processes would cost more than it
+# saves.
+PARALLEL_MIN_CHECKS = int(os.environ.get('BATCH_PARALLEL_MIN_CHECKS',
+                                         5000000))
+
+CSV_FIELDS = ('client', 'item_id', 'item_name', 'secondary_category',
+              'exercise_id', 'exercise_name', 'exercise_slug',
+              'required_equipment', 'optional_equipment')
+
+# Plain, picklable copies of a template and its items, which is all
+# program_generator.expand_template reads from them.
+TemplateSnapshot = collections.namedtuple('TemplateSnapshot',
+                                          'serialize items')
+ItemSnapshot = collections.namedtuple('ItemSnapshot',
+                                      'serialize secondary_category')
+
+# The template and pools of the batch a worker process generates.
+_batch = None
+
+
+def read_clients(data):
+    """Return (client, owned equipment) pairs from a decoded client list.
+
+    Owned equipment is a set of IDs, or None for all equipment. Raise
+    ValueError if the list is malformed or longer than MAX_CLIENTS.
+    """
+    if not isinstance(data, list):
+        raise ValueError('expected a list of clients')
+    if len(data) > MAX_CLIENTS:
+        raise ValueError('at most %d clients per batch' % MAX_CLIENTS)
+
+    clients = []
+    for i, entry in enumerate(data):
+        if not isinstance(entry, dict):
+            raise ValueError('client %d is not an object' % i)
+        equipment = entry.get('equipment')
+        if equipment is not None:
+            if not isinstance(equipment, list) or not all(
+                    isinstance(j, int) and not isinstance(j, bool)
+                    for j in equipment):
+                raise ValueError('client %d: equipment must be a list of '
+                                 'IDs' % i)
+            equipment = set(equipment)
+        clients.append((entry.get('client', i), equipment))
+    return clients
+
+
+def load_batch(session, template_id):
+    """Return (template snapshot, pools), or None if there is no template."""
+    template = program_generator.load_template(session, template_id)
+    if template is None:
+        return None
+    snapshot = TemplateSnapshot(
+        template.serialize,
+        tuple(ItemSnapshot(i.serialize, i.secondary_category)
+              for i in template.items))
+    secondary_ids = {i.secondary_category for i in snapshot.items}
+    secondary_ids.discard(None)
+    return snapshot, program_generator.load_exercise_pools(session,
+                                                           secondary_ids)
+
+
+def client_rng(seed, index):
+    """Return the random generator for the client at index in the batch.
+
+    With a seed, every client's program is reproducible however the batch is
+    split between the worker processes.
+    """
+    if seed is None:
+        return random.Random()
+    return random.Random('%d:%d' % (seed, index))
+
+
+def generate_chunk(template, pools, seed, chunk):
+    """Generate the programs of (index, owned equipment) pairs."""
+    return [program_generator.expand_template(template, pools, owned,
+                                              client_rng(seed, index))
+            for index, owned in chunk]
+
+
+def _start_worker(template, pools, seed):
+    global _batch
+    _batch = (template, pools, seed)
+
+
+def _generate_worker_chunk(chunk):
+    return generate_chunk(*_batch, chunk)
+
+
+def process_context():
+    """Return the multiprocessing context to start worker processes with.
+
+    Worker processes are started from a fresh server process rather than
+    forked from the caller, which may be a threaded web server.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def generate_programs(template, pools, clients, seed=None, workers=None,
+                      min_checks=PARALLEL_MIN_CHECKS):
+    """Yield the (client, owned equipment, program) of every client, in order.
+
+    The programs are generated by up to workers processes (default: one per
+    CPU core) when the batch needs at least min_checks feasibility checks,
+    and in this process otherwise.
+    """
+    chunks = [[(i, clients[i][1]) for i in range(start, min(
+        start + CHUNK_SIZE, len(clients)))]
+        for start in range(0, len(clients), CHUNK_SIZE)]
+    checks = len(clients) * sum(len(pools.get(i.secondary_category, ()))
+                                for i in template.items)
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if checks < min_checks:
+        workers = 1
+
+    if workers <= 1:
+        results = (generate_chunk(template, pools, seed, i) for i in chunks)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=process_context(),
+            initializer=_start_worker, initargs=(template, pools, seed))
+        results = executor.map(_generate_worker_chunk, chunks)
+
+    try:
+        for chunk, programs in zip(chunks, results):
+            for (index, owned), program in zip(chunk, programs):
+                yield clients[index][0], owned, program
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def timed(results, report):
+    """Pass results through, then call report(count, seconds)."""
+    start = time.perf_counter()
+    count = 0
+    try:
+        for count, result in enumerate(results, 1):
+            yield result
+    finally:
+        report(count, time.perf_counter() - start)
+
+
+def ndjson_lines(results):
+    """Yield one JSON line per generated program."""
+    for client, owned, program in results:
+        yield json.dumps({
+            'client': client,
+            'equipment': sorted(owned) if owned is not None else None,
+            'program': program,
+        }) + '\n'
+
+
+def csv_lines(results):
+    """Yield a CSV header, then one row per item of every program."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(CSV_FIELDS)
+    yield flush()
+    for client, owned, program in results:
+        for item in program['Items']:
+            exercise = item['Exercise'] or {}
+            writer.writerow([
+                client, item['id'], item['name'], item['secondary_category'],
+                exercise.get('id'), exercise.get('name'), exercise.get('slug'),
+                ' '.join(map(str, exercise.get('required_equipment', ()))),
+                ' '.join(map(str, exercise.get('optional_equipment', ()))),
+            ])
+        yield flush()
+
+
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = argparse.ArgumentParser(
+        description='Generate programs from a template for many clients.')
+    parser.add_argument('template_id', type=int)
+    parser.add_argument('clients',
+                        help='JSON file with the list of clients, or - to '
+                             'read it from stdin')
+    parser.add_argument('--format', choices=sorted(FORMATS),
+                        default='ndjson')
+    parser.add_argument('--output', default='-',
+                        help='file to write the programs to (default: stdout)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: one per CPU core)')
+    parser.add_argument('--parallel-min-checks', type=int,
+                        default=PARALLEL_MIN_CHECKS,
+                        help='generate smaller batches in this process')
+    parser.add_argument('--seed', type=int,
+                        help='make the generated programs reproducible')
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql:///exercisecatalog'))
+    args = parser.parse_args()
+
+    with (sys.stdin if args.clients == '-' else open(args.clients)) as f:
+        try:
+            clients = read_clients(json.load(f))
+        except ValueError as e:
+            parser.error('%s: %s' % (args.clients, e))
+
+    start = time.perf_counter()
+    engine = create_engine(args.database_url)
+    session = sessionmaker(bind=engine)()
+    try:
+        loaded = load_batch(session, args.template_id)
+    finally:
+        session.close()
+        engine.dispose()
+    if loaded is None:
+        parser.error('there is no template %d' % args.template_id)
+    print('Loaded template %d in %.3fs' % (args.template_id,
+                                           time.perf_counter() - start),
+          file=sys.stderr)
+
+    def report(count, seconds):
+        print('Generated %d programs in %.3fs (%.0f programs/s)' % (
+            count, seconds, count / seconds if seconds else 0),
+            file=sys.stderr)
+
+    lines, content_type = FORMATS[args.format]
+    output = (sys.stdout if args.output == '-'
+              else open(args.output, 'w', newline=''))
+    with output:
+        for line in lines(timed(generate_programs(
+                *loaded, clients, seed=args.seed, workers=args.workers,
+                min_checks=args.parallel_min_checks),
+                report)):
+            output.write(line)
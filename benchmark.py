@@ -0,0 +1,700 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the Exercise Catalog application.
+
+The suite seeds a throwaway database with a synthetic catalog shaped like the
+bundled CSV files, then drives every route of application.py through Flask's
+test client: the HTML pages, the JSON endpoints, the Google login (with the
+calls to Google stubbed out) and the add, edit and delete flows. For each
+route it reports the p50, p95 and p99 latency, the throughput and the number
+of SQL statements per request.
+
+    python benchmark.py --scale small --output results.json
+    python benchmark.py --database-url postgresql:///catalog_bench \\
+        --scale large --output new.json --compare results.json
+
+Without --database-url the catalog is seeded into a temporary SQLite file.
+Every table is dropped and recreated, so never point --database-url at a
+database holding real data. The results are written as JSON so that runs can
+be compared; --compare prints the change in p95 latency and query count
+against an earlier run.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, event, Sequence, text
+
+from database_setup import (
+    Base,
+    Equipment,
+    ExerciseEquipmentReference,
+    Exercises,
+    PrimaryCategories,
+    SecondaryCategories,
+    Templates,
+    TemplateItems,
+    TemplateType,
+    Users,
+    slugify,
+    upgrade_exercise_search,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Catalog sizes. The CSVs hold 8 primary categories, 113 pieces of equipment
+# and roughly 1.6 equipment references per exercise.
+SCALES = {
+    'tiny': {'primary': 4, 'secondary': 12, 'exercises': 200,
+             'references': 400},
+    'small': {'primary': 8, 'secondary': 80, 'exercises': 2000,
+              'references': 8000},
+    'medium': {'primary': 20, 'secondary': 250, 'exercises': 20000,
+               'references': 150000},
+    'large': {'primary': 100, 'secondary': 1000, 'exercises': 100000,
+              'references': 1000000},
+}
+
+TEMPLATES = 10
+TEMPLATE_ITEMS = 6
+ROSTER_SIZE = 50
+BATCH_SIZE = 5000
+
+MOVEMENTS = ('Press', 'Row', 'Curl', 'Squat', 'Lunge', 'Deadlift', 'Raise',
+             'Extension', 'Fly', 'Pulldown', 'Carry', 'Crunch', 'Bridge',
+             'Thrust', 'Pullover', 'Shrug')
+WORDS = ('slow', 'controlled', 'tempo', 'pause', 'explosive', 'grip', 'stance',
+         'neutral', 'elbows', 'knees', 'hips', 'core', 'brace', 'full', 'range',
+         'motion', 'shoulders', 'back', 'chest', 'legs', 'arms', 'glutes')
+
+
+def read_csv(name):
+    """Return the rows of one of the bundled CSV files as dicts."""
+    with open(os.path.join(HERE, name), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def insert_batches(connection, table, rows):
+    """Insert an iterable of row dicts in batches of BATCH_SIZE."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+
+
+def reset_sequences(connection):
+    """Move the PostgreSQL ID sequences past the explicitly seeded IDs."""
+    for table in Base.metadata.sorted_tables:
+        column = table.c.id
+        if isinstance(column.default, Sequence):
+            sequence = column.default.name
+        else:
+            sequence = connection.execute(
+                text('SELECT pg_get_serial_sequence(:table, :column)'),
+                {'table': table.name, 'column': 'id'}).scalar()
+        if sequence is not None:
+            connection.execute(
+                text('SELECT setval(:sequence, max(id)) FROM %s' % table.name),
+                {'sequence': sequence})
+
+
+def seed(engine, scale, rng):
+    """Recreate the schema and fill it with a synthetic catalog.
+
+    Return a dict describing the seeded catalog, which the route scenarios
+    pick their URLs from.
+    """
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    if engine.dialect.name == 'postgresql':
+        upgrade_exercise_search(engine)
+
+    primary_rows = read_csv('primary_categories.csv')
+    equipment_rows = read_csv('equipment_table.csv')
+    references = read_csv('reference_table.csv')
+    optional_share = (sum(i['is_optional'].upper() == 'TRUE'
+                          for i in references) / len(references))
+    equipment_ids = list(range(1, len(equipment_rows) + 1))
+    equipment_words = [i['name'].split()[0] for i in equipment_rows]
+    pictures = [i['picture'] for i in primary_rows]
+
+    secondaries = []
+    exercises = []
+
+    def primary_categories():
+        for i in range(1, scale['primary'] + 1):
+            row = primary_rows[(i - 1) % len(primary_rows)]
+            yield {'id': i, 'name': '%s %d' % (row['name'], i),
+                   'description': row['description'],
+                   'picture': row['picture']}
+
+    def secondary_categories():
+        for i in range(1, scale['secondary'] + 1):
+            primary_id = (i - 1) % scale['primary'] + 1
+            secondaries.append((primary_id, i))
+            yield {'id': i, 'name': '%s %d' % (rng.choice(MOVEMENTS), i),
+                   'description': ' '.join(rng.sample(WORDS, 8)),
+                   'picture': rng.choice(pictures),
+                   'primary_category': primary_id}
+
+    def exercise_rows():
+        for i in range(1, scale['exercises'] + 1):
+            primary_id, secondary_id = secondaries[(i - 1) % len(secondaries)]
+            name = '%s %s %d' % (rng.choice(equipment_words),
+                                 rng.choice(MOVEMENTS), i)
+            slug = slugify(name)
+            exercises.append((primary_id, secondary_id, slug))
+            yield {'id': i, 'name': name, 'slug': slug,
+                   'description': ' '.join(rng.sample(WORDS, 12)),
+                   'video_url': 'https://www.youtube.com/embed/%011d' % i,
+                   'secondary_category': secondary_id, 'user_id': 1}
+
+    def reference_rows():
+        per_exercise, extra = divmod(scale['references'], scale['exercises'])
+        reference_id = 0
+        for i in range(1, scale['exercises'] + 1):
+            count = min(per_exercise + (i <= extra), len(equipment_ids))
+            for equipment_id in rng.sample(equipment_ids, count):
+                reference_id += 1
+                yield {'id': reference_id, 'exercise_id': i,
+                       'equipment_id': equipment_id,
+                       'is_optional': rng.random() < optional_share}
+
+    def template_items():
+        item_id = 0
+        for template_id in range(1, TEMPLATES + 1):
+            for primary_id, secondary_id in rng.sample(
+                    secondaries, min(TEMPLATE_ITEMS, len(secondaries))):
+                item_id += 1
+                yield {'id': item_id, 'name': 'Block %d' % item_id,
+                       'link': '/exercises/%d/%d/' % (primary_id,
+                                                      secondary_id),
+                       'template_id': template_id}
+
+    with engine.begin() as connection:
+        connection.execute(Users.__table__.insert(),
+                           {'id': 1, 'name': 'Catalog Owner',
+                            'email': 'owner@example.com',
+                            'picture': 'img/back.jpg'})
+        insert_batches(connection, PrimaryCategories.__table__,
+                       primary_categories())
+        insert_batches(connection, SecondaryCategories.__table__,
+                       secondary_categories())
+        insert_batches(connection, Equipment.__table__,
+                       ({'id': i, 'name': row['name'], 'image': row['image']}
+                        for i, row in zip(equipment_ids, equipment_rows)))
+        insert_batches(connection, Exercises.__table__, exercise_rows())
+        insert_batches(connection, ExerciseEquipmentReference.__table__,
+                       reference_rows())
+        connection.execute(TemplateType.__table__.insert(),
+                           {'id': 1, 'name': 'Full body'})
+        insert_batches(connection, Templates.__table__,
+                       ({'id': i, 'name': 'Template %d' % i,
+                         'template_type': 1, 'user_id': 1}
+                        for i in range(1, TEMPLATES + 1)))
+        insert_batches(connection, TemplateItems.__table__, template_items())
+        if engine.dialect.name == 'postgresql':
+            reset_sequences(connection)
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT')
+            connection.execute(text('VACUUM ANALYZE'))
+
+    return {'primary': list(range(1, scale['primary'] + 1)),
+            'secondary': secondaries,
+            'exercises': exercises,
+            'equipment': equipment_ids,
+            'templates': list(range(1, TEMPLATES + 1))}
+
+
+class QueryCounter(object):
+    """Count the SQL statements each thread sends to an engine."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, *args):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def reset(self):
+        self._local.count = 0
+
+
+def stub_claims(key, client_id):
+    """Return the ID token claims of the benchmark user called key."""
+    return {'sub': key, 'iss': 'accounts.google.com', 'aud': client_id,
+            'email': '%s@example.com' % key, 'name': 'Benchmark %s' % key,
+            'given_name': 'Benchmark', 'picture': 'img/back.jpg'}
+
+
+class StubCredentials(object):
+    """Stands in for the oauth2client credentials of a benchmark user."""
+
+    def __init__(self, key, client_id):
+        self.access_token = 'access-%s' % key
+        self.token_response = {'id_token': key}
+        self.id_token = stub_claims(key, client_id)
+
+
+@contextlib.contextmanager
+def stub_google(application):
+    """Replace the calls gconnect and gdisconnect make to Google."""
+    google_login = application.google_login
+    client_id = application.client_id()
+    originals = (google_login.exchange_code, google_login.verify_id_token,
+                 google_login.revoke)
+    # The authorization code is the key of the user logging in.
+    google_login.exchange_code = (
+        lambda client_secrets, code: StubCredentials(code.decode('utf8'),
+                                                     client_id))
+    google_login.verify_id_token = (
+        lambda id_token, audience: stub_claims(id_token, audience))
+    google_login.revoke = lambda access_token: True
+    try:
+        yield
+    finally:
+        (google_login.exchange_code, google_login.verify_id_token,
+         google_login.revoke) = originals
+
+
+def percentile(values, share):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+class Recorder(object):
+    """Collects the timings and query counts of every route."""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.samples = {}
+        self.errors = {}
+        self.elapsed = {}
+        self._lock = threading.Lock()
+
+    def request(self, route, client, method, url, expect=200, **kwargs):
+        """Send one request, record it under route and return the response."""
+        self.counter.reset()
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        response.get_data()
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(route, []).append(
+                (duration, self.counter.count))
+            if response.status_code != expect:
+                self.errors.setdefault(route, []).append(
+                    '%s %s -> %d' % (method, url, response.status_code))
+        return response
+
+    def results(self):
+        """Return the per-route summary."""
+        results = {}
+        for route, samples in sorted(self.samples.items()):
+            durations = sorted(i[0] for i in samples)
+            queries = [i[1] for i in samples]
+            elapsed = self.elapsed.get(route) or sum(durations)
+            errors = self.errors.get(route, [])
+            results[route] = {
+                'requests': len(samples),
+                'errors': len(errors),
+                'error_samples': errors[:5],
+                'p50_ms': round(percentile(durations, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+                'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+                'max_ms': round(durations[-1] * 1000, 3),
+                'throughput_rps': round(len(samples) / elapsed, 1),
+                'queries_mean': round(sum(queries) / len(queries), 2),
+                'queries_max': max(queries),
+            }
+        return results
+
+
+def read_scenarios(catalog):
+    """Return the read-only routes as (route, url factory, kwargs) tuples."""
+    def exercise(rng):
+        return rng.choice(catalog['exercises'])
+
+    def secondary(rng):
+        return rng.choice(catalog['secondary'])
+
+    def equipment(rng):
+        return ','.join(str(i) for i in rng.sample(catalog['equipment'], 20))
+
+    def search_text(rng):
+        return rng.choice(MOVEMENTS).lower()
+
+    scenarios = [
+        ('homepage', lambda rng: '/', {}),
+        ('show_secondary_categories',
+         lambda rng: '/exercises/%d/' % rng.choice(catalog['primary']), {}),
+        ('show_exercises_in_category',
+         lambda rng: '/exercises/%d/%d/' % secondary(rng), {}),
+        ('show_exercises_in_category?equipment',
+         lambda rng: '/exercises/%d/%d/?equipment=%s' % (
+             secondary(rng) + (equipment(rng),)), {}),
+        ('show_exercise_description',
+         lambda rng: '/exercises/%d/%d/%s/' % exercise(rng), {}),
+        ('primary_categories_JSON', lambda rng: '/exercises/JSON/', {}),
+        ('secondary_categories_JSON',
+         lambda rng: '/exercises/%d/JSON/' % rng.choice(catalog['primary']),
+         {}),
+        ('exercises_JSON',
+         lambda rng: '/exercises/%d/%d/JSON/' % secondary(rng), {}),
+        ('exercises_JSON?equipment',
+         lambda rng: '/exercises/%d/%d/JSON/?equipment=%s' % (
+             secondary(rng) + (equipment(rng),)), {}),
+        ('exercises_JSON?limit',
+         lambda rng: '/exercises/%d/%d/JSON/?limit=10' % secondary(rng), {}),
+        ('generate_program_JSON',
+         lambda rng: '/templates/%d/generate/JSON/?seed=%d' % (
+             rng.choice(catalog['templates']), rng.randrange(1000)), {}),
+        ('generate_program_JSON?equipment',
+         lambda rng: '/templates/%d/generate/JSON/?equipment=%s' % (
+             rng.choice(catalog['templates']), equipment(rng)), {}),
+        ('search', lambda rng: '/search/?q=%s' % search_text(rng), {}),
+        ('search_JSON', lambda rng: '/search/JSON/?q=%s' % search_text(rng),
+         {}),
+        ('catalog_JSON', lambda rng: '/catalog/JSON/',
+         {'headers': {'Accept-Encoding': 'gzip'}}),
+        ('static', lambda rng: '/static/css/styles.css', {}),
+        ('login', lambda rng: '/login', {}),
+        ('show_metrics', lambda rng: '/metrics', {}),
+    ]
+
+    import static_images
+    built = sorted(
+        path for entry in static_images.manifest().values()
+        for variants in entry['variants'].values()
+        for path in variants.values())
+    if built:
+        scenarios.append(('static_build',
+                          lambda rng: '/static/build/%s' % rng.choice(built),
+                          {}))
+    return scenarios
+
+
+def log_in(recorder, client, key):
+    """Log a benchmark user in through the stubbed Google login."""
+    recorder.request('login', client, 'GET', '/login')
+    with client.session_transaction() as login_session:
+        state = login_session['state']
+    recorder.request('gconnect', client, 'POST', '/gconnect?state=%s' % state,
+                     data=key)
+
+
+def write_flow(recorder, client, catalog, rng, key, iteration):
+    """Add, view, edit and delete one exercise as the logged in user."""
+    primary_id, secondary_id = rng.choice(catalog['secondary'])
+    category = '/exercises/%d/%d/' % (primary_id, secondary_id)
+    name = 'Benchmark %s %d' % (key, iteration)
+    form = {'name': name, 'description': 'Added by the benchmark suite.',
+            'video_url': 'https://www.youtube.com/embed/benchmark'}
+    exercise = '%s%s/' % (category, slugify(name))
+
+    recorder.request('add_exercise', client, 'GET', category + 'add/')
+    recorder.request('add_exercise POST', client, 'POST', category + 'add/',
+                     data=form, expect=302)
+    recorder.request('edit_exercise', client, 'GET', exercise + 'edit/')
+    form['description'] = 'Edited by the benchmark suite.'
+    recorder.request('edit_exercise POST', client, 'POST',
+                     exercise + 'edit/', data=form, expect=302)
+    recorder.request('delete_exercise', client, 'GET', exercise + 'delete/')
+    recorder.request('delete_exercise POST', client, 'POST',
+                     exercise + 'delete/', expect=302)
+
+
+def trainer_flow(recorder, client, catalog, rng, application):
+    """Generate a roster's programs, directly and as a background job.
+
+    The job is run in this process, standing in for the job workers.
+    """
+    template = '/templates/%d/generate/' % rng.choice(catalog['templates'])
+    body = {'seed': rng.randrange(1000), 'clients': [
+        {'client': 'client-%d' % i,
+         'equipment': rng.sample(catalog['equipment'],
+                                 rng.randrange(len(catalog['equipment'])))}
+        for i in range(ROSTER_SIZE)]}
+
+    recorder.request('generate_programs_batch', client, 'POST',
+                     template + 'batch/', json=body)
+    response = recorder.request('queue_programs_batch', client, 'POST',
+                                template + 'jobs/', json=body, expect=202)
+    status = response.headers.get('Location')
+    if status is None:
+        return
+    recorder.request('job_JSON', client, 'GET', status)
+
+    jobs, engine = application.jobs, application.get_engine()
+    job = jobs.claim(engine, 'benchmark')
+    while job is not None:
+        jobs.run_job(engine, job, 'benchmark')
+        job = jobs.claim(engine, 'benchmark')
+    # Another thread may still be running this job.
+    while client.get(status).get_json()['Job']['status'] == 'running':
+        time.sleep(0.01)
+    recorder.request('job_output', client, 'GET',
+                     status.replace('/JSON/', '/output/'))
+
+
+def clear_caches(application):
+    """Empty every in-process cache so requests measure the database path."""
+    application.catalog_cache.catalog.invalidate()
+    application.fragment_cache.invalidate()
+    application.user_cache.invalidate()
+    application.equipment_index.index.invalidate()
+
+
+def run_phase(concurrency, work, recorder=None, routes=()):
+    """Run work(worker) on every worker thread.
+
+    The wall time of the phase is recorded for the routes, which is what
+    their throughput is computed from.
+    """
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(work, i) for i in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    for route in routes:
+        recorder.elapsed[route] = elapsed
+
+
+def run(application, catalog, args):
+    """Drive every route and return the recorder holding the samples."""
+    app = application.app
+    recorder = Recorder(QueryCounter(application.get_engine()))
+    warmup = Recorder(QueryCounter(application.get_engine()))
+    per_worker = max(1, args.requests // args.concurrency)
+    clients = [app.test_client() for i in range(args.concurrency)]
+
+    for route, url, kwargs in read_scenarios(catalog):
+        rngs = [random.Random('%d-%s-%d' % (args.seed, route, i))
+                for i in range(args.concurrency)]
+
+        def warm(worker, route=route, url=url, kwargs=kwargs):
+            for i in range(args.warmup):
+                warmup.request(route, clients[worker], 'GET',
+                               url(rngs[worker]), **kwargs)
+
+        def work(worker, route=route, url=url, kwargs=kwargs):
+            for i in range(per_worker):
+                if args.cold:
+                    clear_caches(application)
+                recorder.request(route, clients[worker], 'GET',
+                                 url(rngs[worker]), **kwargs)
+
+        run_phase(args.concurrency, warm)
+        run_phase(args.concurrency, work, recorder, [route])
+
+    # Logging in and out; the login page itself is measured above.
+    def login_work(worker):
+        for i in range(per_worker):
+            with clients[worker].session_transaction() as login_session:
+                login_session['state'] = 'benchmark'
+            recorder.request('gconnect', clients[worker], 'POST',
+                             '/gconnect?state=benchmark',
+                             data='login-%d-%d' % (worker, i % 10))
+            recorder.request('gdisconnect', clients[worker], 'GET',
+                             '/gdisconnect')
+
+    run_phase(args.concurrency, login_work, recorder,
+              ['gconnect', 'gdisconnect'])
+
+    # The write flows, as one logged in user per worker.
+    rngs = [random.Random('%d-write-%d' % (args.seed, i))
+            for i in range(args.concurrency)]
+
+    def write_work(worker):
+        for i in range(per_worker):
+            write_flow(recorder, clients[worker], catalog, rngs[worker],
+                       'writer-%d' % worker, i)
+
+    run_phase(args.concurrency,
+              lambda worker: log_in(warmup, clients[worker],
+                                    'writer-%d' % worker))
+    run_phase(args.concurrency, write_work, recorder,
+              ['add_exercise', 'add_exercise POST', 'edit_exercise',
+               'edit_exercise POST', 'delete_exercise',
+               'delete_exercise POST'])
+
+    def trainer_work(worker):
+        for i in range(per_worker):
+            trainer_flow(recorder, clients[worker], catalog, rngs[worker],
+                         application)
+
+    run_phase(args.concurrency, trainer_work, recorder,
+              ['generate_programs_batch', 'queue_programs_batch', 'job_JSON',
+               'job_output'])
+    return recorder
+
+
+def uncovered_endpoints(app, results):
+    """Return the endpoints of the app that no route scenario exercised."""
+    covered = {i.split()[0].split('?')[0] for i in results}
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint not in covered)
+
+
+def git_commit():
+    """Return the commit the benchmark runs against, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    """Print the results as a table, compared to a previous run if given."""
+    print('%-38s %7s %9s %9s %9s %9s %7s %6s' % (
+        'route', 'reqs', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql',
+        'errors'))
+    for route, result in results.items():
+        line = '%-38s %7d %9.2f %9.2f %9.2f %9.1f %7.2f %6d' % (
+            route, result['requests'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['throughput_rps'],
+            result['queries_mean'], result['errors'])
+        old = (previous or {}).get(route)
+        if old:
+            line += '   p95 %+.0f%%, sql %+.2f' % (
+                (result['p95_ms'] / old['p95_ms'] - 1) * 100
+                if old['p95_ms'] else 0,
+                result['queries_mean'] - old['queries_mean'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Seed a synthetic catalog and benchmark every route.')
+    parser.add_argument('--database-url',
+                        help='throwaway database to seed; every table is '
+                             'dropped (default: a temporary SQLite file)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                        help='size of the synthetic catalog')
+    for name in ('primary', 'secondary', 'exercises', 'references'):
+        parser.add_argument('--' + name, type=int,
+                            help='override the number of %s' % name)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='unmeasured requests per route and worker')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='worker threads sending requests')
+    parser.add_argument('--cold', action='store_true',
+                        help='empty the in-process caches before every '
+                             'measured read request')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed for the catalog and the requests')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='JSON results of an earlier run to compare to')
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    for name in scale:
+        if getattr(args, name) is not None:
+            scale[name] = getattr(args, name)
+
+    directory = None
+    database_url = args.database_url
+    if database_url is None:
+        directory = tempfile.mkdtemp(prefix='catalog-benchmark-')
+        database_url = 'sqlite:///%s' % os.path.join(directory, 'catalog.db')
+
+    started = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        engine = create_engine(database_url)
+        start = time.perf_counter()
+        catalog = seed(engine, scale, random.Random(args.seed))
+        seed_seconds = time.perf_counter() - start
+        engine.dispose()
+        print('Seeded %s in %.1fs' % (
+            ', '.join('%d %s' % (scale[i], i) for i in sorted(scale)),
+            seed_seconds))
+
+        import application
+        application.create_app({
+            'DATABASE_URL': database_url,
+            'DATABASE_REPLICA_URL': None,
+            'SECRET_KEY': 'benchmark',
+            'CLIENT_SECRETS': os.environ.get(
+                'CLIENT_SECRETS', os.path.join(HERE, 'client_secrets.json')),
+        })
+
+        with stub_google(application):
+            recorder = run(application, catalog, args)
+        application.dispose_engines()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    results = recorder.results()
+    uncovered = uncovered_endpoints(application.app, results)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['routes']
+    print_results(results, previous)
+    if uncovered:
+        print('Routes not exercised: %s' % ', '.join(uncovered))
+
+    if args.output:
+        report = {
+            'meta': {
+                'started': started.isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'sqlalchemy': sqlalchemy.__version__,
+                'database': engine.dialect.name,
+                'scale': scale,
+                'seed_seconds': round(seed_seconds, 2),
+                'requests': args.requests,
+                'warmup': args.warmup,
+                'concurrency': args.concurrency,
+                'cold': args.cold,
+                'seed': args.seed,
+            },
+            'routes': results,
+            'uncovered': uncovered,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Wrote %s' % args.output)
+
+    if any(i['errors'] for i in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+In-process cache for the near-static tables of the exercisecatalog database.
+
+Primary categories, secondary categories, equipment and the exercise lists
+of each secondary category change rarely, so each worker keeps a copy of them
+in memory. Entries expire after a TTL, the cache holds a bounded number of
+entries, and the add, edit, and delete routes invalidate the affected entries
+as soon as they commit.
+
+Other worker processes learn about a write through the shared catalog
+version, a row that every transaction writing the catalog tables bumps (see
+track_writes; python_db_script.py bumps it too). Each process reads it at
+most every CATALOG_VERSION_CHECK_SECONDS and drops its cached catalog when it
+moved (see VersionWatch).
+
+Cached values are plain dictionaries (the serialize format of each table) so
+they can be shared safely between requests and threads.
+
+Every entry also carries a data version, a hash of its content. It is used
+for conditional GET support, so it stays the same when an expired entry is
+reloaded with unchanged data, and matches between workers serving the same
+data.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect, select
+
+from database_setup import (
+    CatalogChange,
+    CatalogVersion,
+    Equipment,
+    ExerciseEquipmentReference,
+    Exercises,
+    PrimaryCategories,
+    SecondaryCategories,
+)
+
+CATALOG_MODELS = (PrimaryCategories, SecondaryCategories, Exercises,
+                  Equipment, ExerciseEquipmentReference)
+
+BUMP_VERSION = CatalogVersion.__table__.update().values(
+    version=CatalogVersion.version + 1)
+
+CURRENT_VERSION = select(CatalogVersion.version).where(CatalogVersion.id == 1)
+
+# Catalog versions kept in the catalog_changes log. An equipment index that
+# is further behind rebuilds in full.
+CHANGE_LOG_SIZE = 1000
+
+VERSION_CHECK_SECONDS = float(os.environ.get('CATALOG_VERSION_CHECK_SECONDS',
+                                             1))
+
+
+def content_version(value):
+    """Return a hash of a JSON serializable value."""
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+class TTLCache(object):
+    """A thread safe, size bounded LRU cache whose entries expire.
+
+    Values are produced by a loader function the first time a key is read,
+    and again once the entry is older than ttl seconds. While bypass, a
+    function, returns True the cache is neither read nor filled.
+    """
+
+    def __init__(self, maxsize=512, ttl=300, bypass=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader, versioner=content_version):
+        """Return the cached value for key, calling loader() on a miss.
+
+        versioner(value) computes the data version of a freshly loaded value.
+        """
+        if self.bypass is not None and self.bypass():
+            self.misses += 1
+            return loader()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = loader()
+        self.put(key, value, versioner)
+        return value
+
+    def put(self, key, value, versioner=content_version):
+        """Store a value that is already known, such as one just written."""
+        version = versioner(value)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def version(self, key):
+        """Return the data version of a fresh entry, or None."""
+        if self.bypass is not None and self.bypass():
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            return entry[2]
+
+    def invalidate(self, *keys):
+        """Drop the given keys, or every entry when no key is given."""
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class VersionWatch(object):
+    """Notices writes to the catalog made by any process."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def changed(self, session):
+        """Return True if the catalog version moved since the last check.
+
+        The version is read at most every interval seconds, by one thread at
+        a time; other calls return False straight away.
+        """
+        checked_at = self._checked_at
+        if (checked_at is not None and
+                time.monotonic() - checked_at < self.interval):
+            return False
+        with self._lock:
+            if self._checked_at != checked_at:
+                return False
+            self._checked_at = time.monotonic()
+        version = (
+            session.query(CatalogVersion.version).filter_by(id=1).scalar()
+        )
+        changed = self.version is not None and version != self.version
+        self.version = version
+        return changed
+
+
+def track_writes(session_factory):
+    """Bump the catalog version in every flush that writes the catalog.
+
+    The bump commits in the same transaction as the write, so a process that
+    sees the new version, even on a replica, also sees the write. The
+    exercises whose equipment requirements the write may change are logged
+    under the new version in catalog_changes.
+    """
+    @event.listens_for(session_factory, 'after_flush')
+    def bump_version(session, flush_context):
+        written = [i for i in itertools.chain(
+            session.new, session.dirty, session.deleted)
+            if isinstance(i, CATALOG_MODELS)]
+        if not written:
+            return
+        session.execute(BUMP_VERSION)
+
+        exercise_ids = set()
+        for i in written:
+            if isinstance(i, Exercises):
+                exercise_ids.add(i.id)
+            elif isinstance(i, ExerciseEquipmentReference):
+                # A moved reference changes its old exercise too.
+                exercise_ids.update(inspect(i).attrs.exercise_id.history.sum())
+        exercise_ids.discard(None)
+        if not exercise_ids:
+            return
+        version = session.execute(CURRENT_VERSION).scalar()
+        session.execute(CatalogChange.__table__.insert(), [
+            {'version': version, 'exercise_id': i} for i in exercise_ids])
+        session.execute(CatalogChange.__table__.delete().where(
+            CatalogChange.version <= version - CHANGE_LOG_SIZE))
+
+
+catalog = TTLCache(maxsize=int(os.environ.get('CATALOG_CACHE_SIZE', 512)),
+                   ttl=int(os.environ.get('CATALOG_CACHE_TTL', 300)))
+
+versions = VersionWatch(VERSION_CHECK_SECONDS)
+
+
+def primary_categories(session):
+    """Return all primary categories, ordered by ID."""
+    return catalog.get('primary', lambda: tuple(
+        i.serialize for i in
+        session.query(PrimaryCategories).order_by(PrimaryCategories.id)
+    ))
+
+
+def primary_category(session, primary_category_id):
+    """Return a single primary category, or None if it does not exist."""
+    for i in primary_categories(session):
+        if i['id'] == primary_category_id:
+            return i
+    return None
+
+
+def secondary_categories(session, primary_category_id=None):
+    """Return the secondary categories, optionally of one primary category."""
+    categories = catalog.get('secondary', lambda: tuple(
+        i.serialize for i in
+        session.query(SecondaryCategories).order_by(SecondaryCategories.id)
+    ))
+    if primary_category_id is None:
+        return categories
+    return tuple(i for i in categories
+                 if i['primary_category'] == primary_category_id)
+
+
+def secondary_category(session, secondary_id):
+    """Return a single secondary category, or None if it does not exist."""
+    for i in secondary_categories(session):
+        if i['id'] == secondary_id:
+            return i
+    return None
+
+
+def equipment(session):
+    """Return all equipment, ordered by ID."""
+    return catalog.get('equipment', lambda: tuple(
+        i.serialize for i in
+        session.query(Equipment).order_by(Equipment.id)
+    ))
+
+
+def exercises(session, secondary_id):
+    """Return the exercises in a secondary category, ordered by ID.
+
+    Besides the serialize fields each exercise carries its slug and
+    secondary category so that listing pages can link to it.
+    """
+    def load():
+        rows = (
+            session.query(Exercises)
+            .filter_by(secondary_category=secondary_id)
+            .order_by(Exercises.id)
+        )
+        return tuple(dict(i.serialize, slug=i.slug,
+                          secondary_category=i.secondary_category)
+                     for i in rows)
+
+    return catalog.get(('exercises', secondary_id), load)
+
+
+def invalidate_exercises(secondary_id):
+    """Forget the cached exercise list of a secondary category."""
+    catalog.invalidate(('exercises', secondary_id), 'export')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Full catalog tree export for clients that mirror the whole catalog.
+
+The tree nests primary categories, secondary categories, exercises and the
+equipment of each exercise (with its is_optional flag), using the serialize
+format of each table. Categories and equipment come from the catalog cache
+and every exercise with its equipment references comes from one ordered
+query, so building the tree costs a single round-trip however large the
+catalog is.
+
+The tree is gzip-compressed as it is generated and kept in the catalog cache
+as a list of chunks, together with a version stamp: the SHA-1 of the
+uncompressed JSON. The stamp is sent as the ETag (with a -gzip suffix for the
+compressed body) so clients can skip the download when nothing has changed.
+"""
+
+import hashlib
+import json
+import zlib
+
+import catalog_cache
+from database_setup import (
+    ExerciseEquipmentReference,
+    Exercises,
+    SecondaryCategories,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _exercise_rows(session):
+    """Return every exercise with its equipment, in tree order."""
+    return (
+        session.query(SecondaryCategories.primary_category,
+                      Exercises.secondary_category,
+                      Exercises.id,
+                      Exercises.name,
+                      Exercises.description,
+                      Exercises.video_url,
+                      ExerciseEquipmentReference.equipment_id,
+                      ExerciseEquipmentReference.is_optional)
+        .join(SecondaryCategories,
+              SecondaryCategories.id == Exercises.secondary_category)
+        .outerjoin(ExerciseEquipmentReference,
+                   ExerciseEquipmentReference.exercise_id == Exercises.id)
+        .filter(SecondaryCategories.primary_category.isnot(None))
+        .order_by(SecondaryCategories.primary_category,
+                  Exercises.secondary_category,
+                  Exercises.id,
+                  ExerciseEquipmentReference.equipment_id)
+        .execution_options(stream_results=True)
+        .yield_per(1000)
+    )
+
+
+def _open(item, child_key):
+    """Return the JSON of item with its closing brace replaced by child_key."""
+    return json.dumps(item)[:-1] + ', %s: [' % json.dumps(child_key)
+
+
+def _tree_fragments(session):
+    """Yield the catalog tree as consecutive pieces of JSON text."""
+    equipment = {i['id']: i for i in catalog_cache.equipment(session)}
+    rows = iter(_exercise_rows(session))
+    row = next(rows, None)
+
+    yield '{"Categories": ['
+    for p, primary in enumerate(catalog_cache.primary_categories(session)):
+        yield (', ' if p else '') + _open(primary, 'SecondaryCategories')
+        secondaries = catalog_cache.secondary_categories(session,
+                                                         primary['id'])
+        for s, secondary in enumerate(secondaries):
+            yield (', ' if s else '') + _open(secondary, 'Exercises')
+            key = (primary['id'], secondary['id'])
+
+            # Skip exercises whose category is missing from the cache.
+            while row is not None and tuple(row[:2]) < key:
+                row = next(rows, None)
+
+            e = 0
+            while row is not None and tuple(row[:2]) == key:
+                exercise = {'id': row.id,
+                            'name': row.name,
+                            'description': row.description,
+                            'video_url': row.video_url}
+                items = []
+                while row is not None and row.id == exercise['id']:
+                    if row.equipment_id in equipment:
+                        items.append(dict(equipment[row.equipment_id],
+                                          is_optional=bool(row.is_optional)))
+                    row = next(rows, None)
+                exercise['Equipment'] = items
+                yield (', ' if e else '') + json.dumps(exercise)
+                e += 1
+            yield ']}'
+        yield ']}'
+    yield ']}'
+
+
+def build_export(session):
+    """Build the gzip-compressed catalog tree.
+
+    Return a (version, chunks) tuple where chunks is a list of gzip bytes.
+    """
+    digest = hashlib.sha1()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    chunks = []
+    pending = []
+    pending_size = 0
+
+    for fragment in _tree_fragments(session):
+        data = fragment.encode('utf8')
+        digest.update(data)
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= CHUNK_SIZE:
+            chunks.append(compressor.compress(b''.join(pending)))
+            pending = []
+            pending_size = 0
+
+    chunks.append(compressor.compress(b''.join(pending)) +
+                  compressor.flush())
+    return digest.hexdigest(), [i for i in chunks if i]
+
+
+def catalog_export(session):
+    """Return the cached (version, chunks) export, building it on a miss."""
+    return catalog_cache.catalog.get('export',
+                                     lambda: build_export(session),
+                                     versioner=lambda export: export[0])
+
+
+def decompressed(chunks):
+    """Yield the uncompressed JSON for clients that do not accept gzip."""
+    decompressor = zlib.decompressobj(31)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
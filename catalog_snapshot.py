@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+Read-only catalog snapshots for serving the browse pages without PostgreSQL.
+
+The catalog tables (primary and secondary categories, exercises, equipment,
+and the exercise equipment references) are read far more often than they
+are written. export() copies them, from a single consistent transaction,
+into an SQLite file in a snapshot directory, then publishes it by pointing
+the CURRENT file at it:
+
+    python catalog_snapshot.py export --directory snapshots
+
+Snapshot files are named after the time they were taken and the hash of
+their content, and are never changed once published. Each records the
+catalog version (see catalog_cache) it was taken at; workers do not serve a
+snapshot older than the catalog version they have seen. An export whose
+content and catalog version match the current snapshot is not published.
+The newest KEEP snapshots are kept; readers that still have an older one
+open keep reading it until they move on.
+
+SnapshotReader opens the current snapshot read-only and immutable, with the
+whole file memory-mapped, so pages are read straight from the operating
+system's page cache, which every worker process on the machine shares.
+Opening a snapshot reads only its snapshot_info row up front, so worker
+memory and startup do not grow with the catalog. Readers look for a newly published snapshot at
+most every CHECK_SECONDS and switch to it between requests.
+
+Snapshots have no full-text index; search keeps using the database.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event, inspect, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.util import find_tables
+
+from database_setup import (
+    Base,
+    CatalogVersion,
+    Equipment,
+    ExerciseEquipmentReference,
+    Exercises,
+    PrimaryCategories,
+    SecondaryCategories,
+)
+
+TABLES = tuple(i.__table__ for i in (PrimaryCategories, SecondaryCategories,
+                                     Exercises, Equipment,
+                                     ExerciseEquipmentReference))
+TABLE_NAMES = frozenset(i.name for i in TABLES)
+
+# Only the search index reads this column.
+SKIPPED_COLUMNS = frozenset(['search_vector'])
+
+CURRENT = 'CURRENT'
+KEEP = int(os.environ.get('SNAPSHOT_KEEP', 3))
+CHECK_SECONDS = float(os.environ.get('SNAPSHOT_CHECK_SECONDS', 1))
+
+# Upper bound of the memory map; pages are only loaded when they are read.
+MMAP_SIZE = int(os.environ.get('SNAPSHOT_MMAP_SIZE', 1 << 30))
+
+BATCH_SIZE = 5000
+
+
+def reads_only_snapshot_tables(clause):
+    """Return True if a statement reads nothing but snapshot tables."""
+    if clause is None:
+        return False
+    tables = {i.name for i in find_tables(clause, include_joins=True,
+                                          include_aliases=True)}
+    return bool(tables) and tables <= TABLE_NAMES
+
+
+def current_name(directory):
+    """Return the file name of the current snapshot, or None."""
+    try:
+        with open(os.path.join(directory, CURRENT)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_atomically(path, data):
+    """Replace the file at path with data, so readers see old or new."""
+    directory = os.path.dirname(path)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    fsync_directory(directory)
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_tables(source, target):
+    """Copy the catalog tables; return the SHA-1 of the rows copied."""
+    digest = hashlib.sha1()
+    for table in TABLES:
+        columns = [i for i in table.columns if i.name not in SKIPPED_COLUMNS]
+        result = source.execution_options(stream_results=True).execute(
+            select(*columns).order_by(table.primary_key.columns.values()[0]))
+        insert = table.insert()
+        while True:
+            rows = [dict(i._mapping) for i in result.fetchmany(BATCH_SIZE)]
+            if not rows:
+                break
+            digest.update(json.dumps([table.name, rows], sort_keys=True,
+                                     default=str).encode('utf8'))
+            target.execute(insert, rows)
+    return digest.hexdigest()
+
+
+def catalog_version(connection):
+    """Return the catalog version of a database, or None if it has none."""
+    if not inspect(connection).has_table(CatalogVersion.__tablename__):
+        return None
+    return connection.execute(
+        select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+
+
+def snapshot_version(engine):
+    """Return the catalog version a snapshot was taken at, or None."""
+    with engine.connect() as connection:
+        try:
+            return connection.execute(text(
+                'SELECT catalog_version FROM snapshot_info')).scalar()
+        except OperationalError:
+            # Taken before snapshots recorded the catalog version.
+            return None
+
+
+def export(engine, directory, keep=KEEP):
+    """Take a snapshot of the catalog and publish it if it changed.
+
+    Return (file name, published).
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-',
+                                     suffix='.sqlite')
+    os.close(fd)
+    try:
+        target = create_engine('sqlite:///%s' % temporary)
+        Base.metadata.create_all(target, tables=TABLES)
+        taken = datetime.now(timezone.utc)
+        with engine.connect() as source, target.begin() as connection:
+            if engine.dialect.name == 'postgresql':
+                # Every table from the same point in time.
+                source = source.execution_options(
+                    isolation_level='REPEATABLE READ')
+            with source.begin():
+                version = catalog_version(source)
+                content_hash = copy_tables(source, connection)
+            connection.execute(text(
+                'CREATE TABLE snapshot_info (content_hash TEXT, '
+                'taken_at TEXT, catalog_version INTEGER)'))
+            connection.execute(text(
+                'INSERT INTO snapshot_info VALUES (:hash, :taken_at, '
+                ':version)'),
+                {'hash': content_hash, 'taken_at': taken.isoformat(),
+                 'version': version})
+        with target.connect() as connection:
+            connection.execute(text('ANALYZE'))
+            # Compact the file, so it maps to as few pages as possible.
+            connection.execute(text('VACUUM'))
+        target.dispose()
+
+        current = current_name(directory)
+        if current is not None and content_hash[:12] in current:
+            reader = open_snapshot(os.path.join(directory, current))
+            try:
+                current_version = snapshot_version(reader)
+            finally:
+                reader.dispose()
+            if current_version == version:
+                return current, False
+        name = 'catalog-%s-%s.sqlite' % (
+            taken.strftime('%Y%m%dT%H%M%S%fZ'), content_hash[:12])
+        with open(temporary, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temporary, os.path.join(directory, name))
+        write_atomically(os.path.join(directory, CURRENT), name + '\n')
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+    snapshots = sorted(i for i in os.listdir(directory)
+                       if i.startswith('catalog-') and i.endswith('.sqlite'))
+    for old in snapshots[:max(0, len(snapshots) - keep)]:
+        if old != name:
+            os.remove(os.path.join(directory, old))
+    return name, True
+
+
+def taken_at(name):
+    """Return when the snapshot of a file name was taken, as a timestamp."""
+    taken = datetime.strptime(name.split('-')[1], '%Y%m%dT%H%M%S%fZ')
+    return taken.replace(tzinfo=timezone.utc).timestamp()
+
+
+def open_snapshot(path, pool_size=5):
+    """Return a read-only engine for a snapshot file."""
+    engine = create_engine(
+        'sqlite:///file:%s?mode=ro&immutable=1&uri=true' % quote(path),
+        poolclass=QueuePool, pool_size=pool_size,
+        connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def memory_map(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA mmap_size = %d' % MMAP_SIZE)
+
+    return engine
+
+
+class SnapshotReader(object):
+    """The engine of the current snapshot in a directory, kept current.
+
+    on_swap(reader) is called after the reader switched snapshots.
+    """
+
+    def __init__(self, directory, pool_size=5, on_swap=None):
+        self.directory = directory
+        self.pool_size = pool_size
+        self.on_swap = on_swap
+        self.name = None
+        self.current = None
+        self.taken_at = 0
+        self.catalog_version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def engine(self):
+        """Return the engine of the current snapshot, or None if none."""
+        checked_at = self._checked_at
+        if checked_at is None or time.monotonic() - checked_at > CHECK_SECONDS:
+            with self._lock:
+                if self._checked_at == checked_at:
+                    self._check()
+        return self.current
+
+    def _check(self):
+        self._checked_at = time.monotonic()
+        name = current_name(self.directory)
+        if name == self.name:
+            return
+        old = self.current
+        self.current = None
+        if name is not None:
+            self.current = open_snapshot(os.path.join(self.directory, name),
+                                         self.pool_size)
+        self.name = name
+        self.taken_at = taken_at(name) if name is not None else 0
+        self.catalog_version = (snapshot_version(self.current)
+                                if self.current is not None else None)
+        if old is not None:
+            # Requests still using the old snapshot keep their connection.
+            old.dispose()
+        if self.on_swap is not None:
+            self.on_swap(self)
+
+    def dispose(self):
+        if self.current is not None:
+            self.current.dispose()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Export and inspect read-only catalog snapshots.')
+    parser.add_argument('command', choices=['export', 'info'])
+    parser.add_argument('--directory',
+                        default=os.environ.get('CATALOG_SNAPSHOT_DIR',
+                                               'snapshots'))
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql:///exercisecatalog'))
+    parser.add_argument('--keep', type=int, default=KEEP,
+                        help='snapshots to keep')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        start = time.perf_counter()
+        engine = create_engine(args.database_url)
+        name, published = export(engine, args.directory, args.keep)
+        engine.dispose()
+        print('%s %s in %.1fs' % ('Published' if published else
+                                  'Unchanged, kept', name,
+                                  time.perf_counter() - start))
+    else:
+        name = current_name(args.directory)
+        if name is None:
+            parser.error('no snapshot has been published in %s' %
+                         args.directory)
+        engine = open_snapshot(os.path.join(args.directory, name))
+        with engine.connect() as connection:
+            info = connection.execute(text(
+                'SELECT * FROM snapshot_info')).first()
+            print('%s: taken at %s, catalog version %s, %.1f MB' % (
+                name, info.taken_at, info._mapping.get('catalog_version'),
+                os.path.getsize(os.path.join(args.directory, name)) / 1e6))
+            for table in TABLES:
+                print('  %-30s %9d rows' % (table.name, connection.execute(
+                    text('SELECT count(*) FROM %s' % table.name)).scalar()))
+        engine.dispose()
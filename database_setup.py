@@ -8,11 +8,16 @@ database with the Exercise Catalog app.
 """
 
 import os
+import re
 import sys
+import json
 from sqlalchemy import Column, ForeignKey, Integer, String, Text, Sequence, Boolean
+from sqlalchemy import DateTime, DDL, event, Float, Index, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
 
 
 Base = declarative_base()
@@ -25,6 +30,9 @@ class Users(Base):
     """
 
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_email', 'email', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
@@ -64,12 +72,17 @@ class SecondaryCategories(Base):
     """
 
     __tablename__ = 'secondary_categories'
+    __table_args__ = (
+        Index('ix_secondary_categories_primary_category_id',
+              'primary_category', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
     description = Column(Text)
     primary_category = Column(Integer, ForeignKey('primary_categories.id'))
     picture = Column(Text)
+    primary = relationship(PrimaryCategories)
 
     @property
     def serialize(self):
@@ -90,14 +103,31 @@ class Exercises(Base):
     """
 
     __tablename__ = 'exercises'
+    __table_args__ = (
+        Index('ix_exercises_secondary_category_slug',
+              'secondary_category', 'slug', unique=True),
+        Index('ix_exercises_secondary_category_id',
+              'secondary_category', 'id'),
+        Index('ix_exercises_search_vector', 'search_vector',
+              postgresql_using='gin'),
+    )
 
     id = Column(Integer, Sequence('exercises_id'), primary_key=True)
     name = Column(String(250), nullable=False)
+    slug = Column(String(250), nullable=False)
     description = Column(Text)
     video_url = Column(Text)
     secondary_category = Column(Integer, ForeignKey('secondary_categories.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
+    # Maintained by the exercises_search_vector_update trigger. Plain text
+    # (and always empty) on SQLite, which the benchmark suite can run on.
+    search_vector = deferred(
+        Column(TSVECTOR().with_variant(Text(), 'sqlite')))
     user = relationship(Users)
+    secondary = relationship(SecondaryCategories)
+    equipment_references = relationship(
+        'ExerciseEquipmentReference', back_populates='exercise',
+        cascade='all, delete-orphan')
 
     @property
     def serialize(self):
@@ -109,6 +139,11 @@ class Exercises(Base):
             'video_url': self.video_url,
         }
 
+    @property
+    def equipment(self):
+        """Return the equipment used by this exercise."""
+        return [i.equipment for i in self.equipment_references]
+
 
 class Equipment(Base):
     """Equipment table in the exercisecatalog database.
@@ -140,12 +175,17 @@ class ExerciseEquipmentReference(Base):
     """
 
     __tablename__ = 'exercise_equipment_reference'
+    __table_args__ = (
+        Index('ix_exercise_equipment_reference_exercise_id', 'exercise_id'),
+        Index('ix_exercise_equipment_reference_equipment_id', 'equipment_id'),
+    )
 
     id = Column(Integer, Sequence('reference_id'), primary_key=True)
     exercise_id = Column(Integer, ForeignKey('exercises.id'), nullable=False)
     equipment_id = Column(Integer, ForeignKey('equipment.id'), nullable=False)
     is_optional = Column(Boolean)
-
+    exercise = relationship(Exercises, back_populates='equipment_references')
+    equipment = relationship(Equipment)
 
 
 class Templates(Base):
@@ -156,11 +196,15 @@ class Templates(Base):
     """
 
     __tablename__ = 'templates'
+    __table_args__ = (
+        Index('ix_templates_user_id', 'user_id'),
+    )
 
     id = Column(Integer, Sequence('template_id'), primary_key=True)
     name = Column(String(250), nullable=False)
     template_type = Column(Integer, ForeignKey('template_type.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
+    items = relationship('TemplateItems', order_by='TemplateItems.id')
 
     @property
     def serialize(self):
@@ -203,6 +247,9 @@ class TemplateItems(Base):
     """
 
     __tablename__ = 'template_items'
+    __table_args__ = (
+        Index('ix_template_items_template_id_id', 'template_id', 'id'),
+    )
 
     id = Column(Integer, Sequence('template_items_id'), primary_key=True)
     name = Column(String(250), nullable=False)
@@ -218,7 +265,296 @@ class TemplateItems(Base):
            'link': self.link,
         }
 
+    @property
+    def secondary_category(self):
+        """Return the ID of the secondary category the link points to.
+
+        Links look like /exercises/<primary id>/<secondary id>/. Return None
+        if the link does not point to a secondary category.
+        """
+        match = re.search(r'/exercises/\d+/(\d+)', self.link)
+        return int(match.group(1)) if match else None
+
+
+class Jobs(Base):
+    """Jobs table in the exercisecatalog database.
+
+    The durable queue of background jobs run by jobs.py. Payload and result
+    are JSON; output is the file a job produced, such as a batch of
+    generated programs, served with output_type.
+    """
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        Index('ix_jobs_status_run_after', 'status', 'run_after'),
+        Index('ix_jobs_user_id', 'user_id'),
+    )
+
+    id = Column(Integer, Sequence('job_id'), primary_key=True)
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default='queued')
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    progress = Column(Float)
+    progress_message = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    output = deferred(Column(Text))
+    output_type = Column(String(100))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    locked_by = Column(String(100))
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    started_at = Column(DateTime(timezone=True))
+    heartbeat_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+    @property
+    def serialize(self):
+        """Return object data in serializable format for JSON endpoints."""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'progress': self.progress,
+            'progress_message': self.progress_message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'has_output': self.output_type is not None,
+            'created_at': self.created_at.isoformat(),
+            'started_at': (self.started_at.isoformat()
+                           if self.started_at else None),
+            'finished_at': (self.finished_at.isoformat()
+                            if self.finished_at else None),
+        }
+
+
+class CatalogVersion(Base):
+    """Catalog version table in the exercisecatalog database.
+
+    A single row whose version goes up in every transaction that writes to
+    the catalog tables, so that every process caching the catalog can tell
+    when its copy is out of date (see catalog_cache).
+    """
+
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+event.listen(CatalogVersion.__table__, 'after_create', DDL(
+    'INSERT INTO catalog_version (id, version) VALUES (1, 0)'))
+
+
+class CatalogChange(Base):
+    """Catalog change log table in the exercisecatalog database.
+
+    The exercises whose equipment requirements a catalog version may have
+    changed, so that the equipment index can refresh just those (see
+    equipment_index). A row without an exercise ID means any exercise may
+    have changed.
+    """
+
+    __tablename__ = 'catalog_changes'
+    __table_args__ = (
+        Index('ix_catalog_changes_version', 'version'),
+    )
+
+    id = Column(Integer, Sequence('catalog_change_id'), primary_key=True)
+    version = Column(Integer, nullable=False)
+    exercise_id = Column(Integer)
+
+
+def slugify(name):
+    """Turn an exercise name into a lowercase, hyphen separated URL slug."""
+    slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+    return slug or 'exercise'
+
+
+def unique_exercise_slug(session, name, secondary_category, exercise_id=None):
+    """Return a slug for the name that is unused in the secondary category.
+
+    Exercise exercise_id is ignored so that an edit can keep its own slug.
+    """
+    base = slugify(name)
+    query = (
+        session.query(Exercises.slug)
+        .filter(Exercises.secondary_category == secondary_category)
+        .filter(Exercises.slug.like(base + '%'))
+    )
+    if exercise_id is not None:
+        query = query.filter(Exercises.id != exercise_id)
+    taken = {row.slug for row in query}
+
+    slug = base
+    suffix = 2
+    while slug in taken:
+        slug = '%s-%d' % (base, suffix)
+        suffix += 1
+    return slug
+
+
+def add_with_unique_slug(session, exercise, attempts=5):
+    """Give an exercise an unused slug and flush it, without committing.
+
+    Two concurrent writes may pick the same slug. The one that loses the
+    race on the unique index rolls back to a savepoint and picks the next
+    free slug, up to attempts times.
+    """
+    for attempt in range(attempts):
+        slug = unique_exercise_slug(
+            session, exercise.name, exercise.secondary_category, exercise.id)
+        try:
+            with session.begin_nested():
+                exercise.slug = slug
+                session.add(exercise)
+            return
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+# Rows updated per transaction when backfilling a new column, so that a
+# backfill never holds row locks on the whole table.
+BACKFILL_BATCH_SIZE = 1000
+
+
+def upgrade_exercise_slugs(engine):
+    """Add the exercises.slug column to an existing database and backfill it.
+
+    The backfill commits every BACKFILL_BATCH_SIZE rows, and the NOT NULL
+    constraint is checked without blocking writes. The unique index is
+    built by the migration. Safe to run more than once; rows that already
+    have a slug are kept.
+    """
+    from sqlalchemy.orm import sessionmaker
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            'ALTER TABLE exercises ADD COLUMN IF NOT EXISTS slug VARCHAR(250)'))
+
+    session = sessionmaker(bind=engine)()
+    try:
+        while True:
+            missing = (
+                session.query(Exercises).filter(Exercises.slug.is_(None))
+                .order_by(Exercises.id).limit(BACKFILL_BATCH_SIZE).all()
+            )
+            if not missing:
+                break
+            for exercise in missing:
+                exercise.slug = unique_exercise_slug(
+                    session, exercise.name, exercise.secondary_category,
+                    exercise.id)
+                session.flush()
+            session.commit()
+    finally:
+        session.close()
+
+    # Validating a NOT VALID check scans the table without blocking writes;
+    # SET NOT NULL then relies on it instead of scanning under its lock.
+    with engine.begin() as connection:
+        connection.execute(text(
+            'ALTER TABLE exercises '
+            'DROP CONSTRAINT IF EXISTS exercises_slug_not_null'))
+        connection.execute(text(
+            'ALTER TABLE exercises ADD CONSTRAINT exercises_slug_not_null '
+            'CHECK (slug IS NOT NULL) NOT VALID'))
+    with engine.begin() as connection:
+        connection.execute(text(
+            'ALTER TABLE exercises '
+            'VALIDATE CONSTRAINT exercises_slug_not_null'))
+    with engine.begin() as connection:
+        connection.execute(text(
+            'ALTER TABLE exercises ALTER COLUMN slug SET NOT NULL'))
+        connection.execute(text(
+            'ALTER TABLE exercises DROP CONSTRAINT exercises_slug_not_null'))
+
+
+# Exercise names weigh most, then the name of the secondary category, then
+# the description. The trigger keeps the vector current for every write,
+# including writes made by the Exercise Catalog app sharing the database.
+SEARCH_VECTOR_TRIGGER = """
+CREATE OR REPLACE FUNCTION exercises_search_vector_update()
+RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT name FROM secondary_categories
+             WHERE id = NEW.secondary_category), '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS exercises_search_vector_update ON exercises;
+CREATE TRIGGER exercises_search_vector_update
+    BEFORE INSERT OR UPDATE OF name, description, secondary_category
+    ON exercises
+    FOR EACH ROW EXECUTE PROCEDURE exercises_search_vector_update();
+"""
+
+
+def upgrade_exercise_search(engine):
+    """Add the full-text search column and its trigger.
+
+    Existing rows are backfilled BACKFILL_BATCH_SIZE rows per transaction.
+    The GIN index is built by the migration. Safe to run more than once.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(
+            'ALTER TABLE exercises ADD COLUMN IF NOT EXISTS '
+            'search_vector tsvector'))
+        connection.execute(text(SEARCH_VECTOR_TRIGGER))
+
+    while True:
+        with engine.begin() as connection:
+            updated = connection.execute(text(
+                'UPDATE exercises SET name = name WHERE id IN ('
+                'SELECT id FROM exercises WHERE search_vector IS NULL '
+                'ORDER BY id LIMIT :limit)'),
+                {'limit': BACKFILL_BATCH_SIZE}).rowcount
+        if not updated:
+            break
+
+
+# The vectors include the secondary category name, so renaming a category
+# recomputes the vectors of its exercises.
+CATEGORY_SEARCH_TRIGGER = """
+CREATE OR REPLACE FUNCTION secondary_categories_search_vector_update()
+RETURNS trigger AS $$
+BEGIN
+    UPDATE exercises SET name = name WHERE secondary_category = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS secondary_categories_search_vector_update
+    ON secondary_categories;
+CREATE TRIGGER secondary_categories_search_vector_update
+    AFTER UPDATE OF name ON secondary_categories
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE secondary_categories_search_vector_update();
+"""
+
+
+def upgrade_category_search(engine):
+    """Add the trigger that refreshes search vectors on category renames.
+
+    Safe to run more than once.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(CATEGORY_SEARCH_TRIGGER))
+
 
 if __name__ == '__main__':
+    import migrations
+
     engine = create_engine('postgresql:///exercisecatalog')
     Base.metadata.create_all(engine)
+    migrations.migrate(engine)
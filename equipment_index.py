@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Equipment feasibility index for "what can I do with my gear" queries.
+
+For every exercise the index keeps a bitmask of its required equipment (the
+references in exercise_equipment_reference that are not is_optional), with
+bit n set for the piece of equipment whose ID is n. An equipment set is
+turned into a mask the same way, and an exercise is feasible when its mask
+has no bits outside that set, so filtering a list of exercises is a pass of
+integer AND operations without touching the database. Equipment IDs above
+the highest one any exercise requires cannot change the result and are left
+out of the mask, which keeps it as small as the catalog's own masks.
+
+Paged and streamed listings filter in SQL instead, with feasible_clause().
+
+The index is built on first use and refreshed one exercise at a time: by the
+add, edit, and delete routes, and, for writes made by other processes, from
+the catalog_changes log of the exercises changed since the catalog version
+the index was built at. It reads the database, never the catalog snapshot,
+so that its masks match that version.
+"""
+
+import threading
+import time
+
+from sqlalchemy import and_, exists, or_, select
+
+from catalog_cache import (
+    CHANGE_LOG_SIZE,
+    CURRENT_VERSION,
+    VERSION_CHECK_SECONDS,
+)
+from database_setup import CatalogChange, ExerciseEquipmentReference, Exercises
+
+# The equipment references an exercise cannot be done without.
+REQUIRED = or_(ExerciseEquipmentReference.is_optional.is_(None),
+               ExerciseEquipmentReference.is_optional.is_(False))
+
+
+
+def equipment_mask(equipment_ids):
+    """Return the bitmask of a collection of equipment IDs."""
+    mask = 0
+    for i in equipment_ids:
+        mask |= 1 << i
+    return mask
+
+
+def database_only(statement):
+    """Make the routing session read a statement from the database.
+
+    Catalog reads are otherwise served from the catalog snapshot, which may
+    be older than the catalog version the index is at.
+    """
+    return statement.execution_options(snapshot=False)
+
+
+def feasible_clause(equipment_ids):
+    """Return a filter for the exercises doable with the equipment."""
+    return ~exists().where(and_(
+        ExerciseEquipmentReference.exercise_id == Exercises.id, REQUIRED,
+        ExerciseEquipmentReference.equipment_id.notin_(
+            sorted(equipment_ids))))
+
+
+class EquipmentIndex(object):
+    """Required equipment bitmasks of every exercise in the catalog."""
+
+    def __init__(self, check_interval=1):
+        self.check_interval = check_interval
+        self._masks = {}
+        self._max_equipment_id = -1
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def _required(self, session, exercise_ids=None):
+        """Return the (exercise ID, required equipment ID) rows.
+
+        Exercises without required equipment have one row with None.
+        """
+        query = (
+            select(Exercises.id, ExerciseEquipmentReference.equipment_id)
+            .outerjoin(ExerciseEquipmentReference,
+                       (ExerciseEquipmentReference.exercise_id ==
+                        Exercises.id) & REQUIRED)
+        )
+        if exercise_ids is not None:
+            query = query.where(Exercises.id.in_(sorted(exercise_ids)))
+        return session.execute(database_only(query)).all()
+
+    def _update(self, session, exercise_ids):
+        """Recompute the masks of some exercises, dropping deleted ones."""
+        rows = self._required(session, exercise_ids)
+        required = {}
+        for exercise_id, equipment_id in rows:
+            mask = required.get(exercise_id, 0)
+            if equipment_id is not None:
+                mask |= 1 << equipment_id
+            required[exercise_id] = mask
+        with self._lock:
+            masks = dict(self._masks)
+            for exercise_id in exercise_ids:
+                masks.pop(exercise_id, None)
+            masks.update(required)
+            self._masks = masks
+            self._max_equipment_id = max(
+                [self._max_equipment_id] +
+                [i.equipment_id for i in rows if i.equipment_id is not None])
+
+    def rebuild(self, session):
+        """Rebuild the masks of every exercise from the database."""
+        # Read the version first: the masks are then at least as new.
+        version = session.execute(database_only(CURRENT_VERSION)).scalar()
+        masks = {}
+        max_equipment_id = -1
+        for exercise_id, equipment_id in self._required(session):
+            mask = masks.get(exercise_id, 0)
+            if equipment_id is not None:
+                mask |= 1 << equipment_id
+                max_equipment_id = max(max_equipment_id, equipment_id)
+            masks[exercise_id] = mask
+        with self._lock:
+            self._masks = masks
+            self._max_equipment_id = max_equipment_id
+            self._version = version
+
+    def catch_up(self, session):
+        """Refresh the exercises changed since the index's catalog version.
+
+        Rebuild in full if the change log no longer reaches back that far,
+        or logs a change to any exercise.
+        """
+        version = session.execute(database_only(CURRENT_VERSION)).scalar()
+        if version == self._version:
+            return
+        if version - self._version >= CHANGE_LOG_SIZE:
+            self.rebuild(session)
+            return
+        changed = {i.exercise_id for i in session.execute(
+            select(CatalogChange.exercise_id).distinct()
+            .where(CatalogChange.version > self._version)
+            .where(CatalogChange.version <= version))}
+        if None in changed:
+            self.rebuild(session)
+            return
+        if changed:
+            self._update(session, changed)
+        self._version = version
+
+    def invalidate(self):
+        """Rebuild the whole index on its next use."""
+        self._version = None
+        self._checked_at = None
+
+    def refresh_exercise(self, session, exercise_id):
+        """Recompute the mask of one exercise, or drop it if it is gone."""
+        if self._version is None:
+            return
+        self._update(session, [exercise_id])
+
+    def masks(self, session):
+        """Return the exercise ID to mask mapping, building it if needed.
+
+        The index catches up with the catalog at most every check_interval
+        seconds, in one thread at a time; the others keep using the current
+        masks meanwhile, and only wait for the first build.
+        """
+        checked_at = self._checked_at
+        if (checked_at is None or
+                time.monotonic() - checked_at >= self.check_interval):
+            if self._update_lock.acquire(blocking=self._version is None):
+                try:
+                    if self._checked_at == checked_at:
+                        if self._version is None:
+                            self.rebuild(session)
+                        else:
+                            self.catch_up(session)
+                        self._checked_at = time.monotonic()
+                finally:
+                    self._update_lock.release()
+        return self._masks
+
+    def feasible(self, session, equipment_ids, exercise_ids):
+        """Return the IDs among exercise_ids doable with the equipment."""
+        self.masks(session)
+        with self._lock:
+            masks, max_equipment_id = self._masks, self._max_equipment_id
+        owned = equipment_mask(i for i in equipment_ids
+                               if i <= max_equipment_id)
+        feasible = set()
+        for exercise_id in exercise_ids:
+            mask = masks.get(exercise_id)
+            if mask is not None and not mask & ~owned:
+                feasible.add(exercise_id)
+        return feasible
+
+
+index = EquipmentIndex(check_interval=VERSION_CHECK_SECONDS)
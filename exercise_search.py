@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Full-text exercise search for the Exercise Catalog.
+
+Searches run against exercises.search_vector, a weighted tsvector of the
+exercise name, its secondary category name, and its description, backed by
+a GIN index. Every word of the search text is matched as a prefix, so
+"bench pre" finds "Bench Press", and results are ranked with ts_rank_cd.
+
+Databases other than PostgreSQL (such as the SQLite files used for local
+benchmarking) fall back to a case-insensitive substring match on the name.
+"""
+
+import re
+
+from sqlalchemy import func
+
+from database_setup import Exercises, SecondaryCategories
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def prefix_query(search_text):
+    """Turn search text into a tsquery matching every word as a prefix.
+
+    Return None if the text has no searchable words.
+    """
+    words = re.findall(r'\w+', search_text.lower())
+    if not words:
+        return None
+    return ' & '.join('%s:*' % i for i in words)
+
+
+def search_exercises(session, search_text, limit=DEFAULT_LIMIT):
+    """Return the best matching exercises for the search text.
+
+    Each result is a dictionary with the serialize fields of the exercise,
+    plus what is needed to link to it: slug, secondary_category and
+    primary_category.
+    """
+    tsquery = prefix_query(search_text)
+    if tsquery is None:
+        return []
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    query = (
+        session.query(Exercises.id,
+                      Exercises.name,
+                      Exercises.slug,
+                      Exercises.description,
+                      Exercises.video_url,
+                      Exercises.secondary_category,
+                      SecondaryCategories.primary_category)
+        .join(SecondaryCategories,
+              SecondaryCategories.id == Exercises.secondary_category)
+    )
+
+    if session.get_bind().dialect.name == 'postgresql':
+        ts = func.to_tsquery('english', tsquery)
+        query = (
+            query.filter(Exercises.search_vector.op('@@')(ts))
+            .order_by(func.ts_rank_cd(Exercises.search_vector, ts).desc(),
+                      Exercises.id)
+        )
+    else:
+        for word in re.findall(r'\w+', search_text.lower()):
+            word = re.sub(r'([\\%_])', r'\\\1', word)
+            query = query.filter(
+                Exercises.name.ilike('%' + word + '%', escape='\\'))
+        query = query.order_by(Exercises.name, Exercises.id)
+
+    return [dict(i._asdict()) for i in query.limit(limit)]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Query-plan regression check for the hot query paths.
+
+The check seeds a synthetic catalog (see benchmark.py) and applies the
+migrations, then drives every route with the in-process caches emptied
+before each request so that every query reaches the database. Each distinct
+statement is then run through EXPLAIN with the parameters it was sent with:
+
+    python explain_check.py --database-url postgresql:///catalog_bench
+
+On PostgreSQL sequential scans are disabled for the EXPLAIN, so the planner
+only picks one when no index can serve the query, however small the table.
+A sequential scan that filters rows therefore means an index is missing, and
+fails the check; scans that read a whole table on purpose (the category and
+equipment listings, the catalog export) carry no filter and pass.
+
+Without --database-url the check runs on a temporary SQLite file, where a
+SCAN of a table in a statement that filters it fails the check instead.
+Every table of the database is dropped, so only use a throwaway database.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+
+from flask import has_request_context, request
+from sqlalchemy import create_engine, event
+
+import benchmark
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Full scans that are expected: SQLite has no full-text index, so search
+# falls back to a LIKE over the exercise names.
+ALLOWED = {
+    ('sqlite', 'search', 'exercises'),
+    ('sqlite', 'search_JSON', 'exercises'),
+}
+
+
+class StatementLog(object):
+    """Collects the distinct statements each endpoint sends."""
+
+    def __init__(self, engine):
+        self.statements = {}
+        event.listen(engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        if executemany or not has_request_context():
+            return
+        key = (request.endpoint, statement)
+        if key not in self.statements:
+            self.statements[key] = parameters
+
+
+def postgresql_seq_scans(cursor, statement, parameters):
+    """Return the tables a PostgreSQL plan scans sequentially with a filter."""
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    tables = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan' and 'Filter' in node:
+            tables.append(node['Relation Name'])
+        nodes.extend(node.get('Plans', []))
+    return tables
+
+
+def sqlite_scans(cursor, statement, parameters):
+    """Return the tables an SQLite plan scans in full while filtering them."""
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    where = ' '.join(statement.upper().split()).partition(' WHERE ')[2]
+    tables = []
+    for row in cursor.fetchall():
+        # SQLite names the table by its alias, if the statement gives one.
+        match = re.match(r'SCAN (\w+)$', row[-1])
+        if match is not None and '%s.' % match.group(1).upper() in where:
+            tables.append(match.group(1))
+    return tables
+
+
+def check_plans(engine, statements):
+    """EXPLAIN every statement; return the (endpoint, table, sql) failures."""
+    dialect = engine.dialect.name
+    scans = (postgresql_seq_scans if dialect == 'postgresql'
+             else sqlite_scans)
+    failures = []
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if dialect == 'postgresql':
+            cursor.execute('SET enable_seqscan = off')
+        for (endpoint, statement), parameters in sorted(
+                statements.items(), key=lambda i: (i[0][0] or '', i[0][1])):
+            for table in scans(cursor, statement, parameters):
+                if (dialect, endpoint, table) not in ALLOWED:
+                    failures.append((endpoint, table, statement))
+        connection.rollback()
+    finally:
+        connection.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fail if a route query scans a table without an index.')
+    parser.add_argument('--database-url',
+                        help='throwaway database to seed; every table is '
+                             'dropped (default: a temporary SQLite file)')
+    parser.add_argument('--scale', choices=sorted(benchmark.SCALES),
+                        help='size of the synthetic catalog (default: large '
+                             'on PostgreSQL, small on SQLite)')
+    parser.add_argument('--requests', type=int, default=3,
+                        help='requests per route')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    directory = None
+    database_url = args.database_url
+    if database_url is None:
+        directory = tempfile.mkdtemp(prefix='catalog-explain-')
+        database_url = 'sqlite:///%s' % os.path.join(directory, 'catalog.db')
+
+    try:
+        engine = create_engine(database_url)
+        scale = args.scale or ('large' if engine.dialect.name == 'postgresql'
+                               else 'small')
+        catalog = benchmark.seed(engine, dict(benchmark.SCALES[scale]),
+                                 random.Random(args.seed))
+        if engine.dialect.name == 'postgresql':
+            import migrations
+            migrations.migrate(engine, verbose=False)
+        engine.dispose()
+
+        import application
+        application.create_app({
+            'DATABASE_URL': database_url,
+            'DATABASE_REPLICA_URL': None,
+            'SECRET_KEY': 'explain',
+            'CLIENT_SECRETS': os.environ.get(
+                'CLIENT_SECRETS', os.path.join(HERE, 'client_secrets.json')),
+        })
+        log = StatementLog(application.get_engine())
+        run_args = argparse.Namespace(
+            requests=args.requests, warmup=0, concurrency=1, cold=True,
+            seed=args.seed)
+        with benchmark.stub_google(application):
+            benchmark.run(application, catalog, run_args)
+
+        failures = check_plans(application.get_engine(), log.statements)
+        application.dispose_engines()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print('Checked the plans of %d statements from %d endpoints on %s' % (
+        len(log.statements), len({i[0] for i in log.statements}),
+        engine.dialect.name))
+    for endpoint, table, statement in failures:
+        print('FAIL %s: full scan of %s in\n    %s' % (
+            endpoint, table, ' '.join(statement.split())[:300]))
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Rendered HTML fragment cache for the catalog listing pages.
+
+The category and exercise listings are the same for every visitor; only the
+page header (the logged in user's first name) and flashed messages differ.
+The listings are rendered from their own templates and kept in a bounded LRU
+cache, keyed by the route arguments, the data versions of the catalog cache
+entries they were rendered from and the version of the image manifest, so a
+write or an image build produces new keys. The exercise write routes also
+clear the cache outright.
+"""
+
+import os
+
+from flask import render_template, request
+from markupsafe import Markup
+
+import static_images
+from catalog_cache import catalog, TTLCache
+
+fragments = TTLCache(maxsize=int(os.environ.get('FRAGMENT_CACHE_SIZE', 256)),
+                     ttl=int(os.environ.get('CATALOG_CACHE_TTL', 300)))
+
+
+def render_fragment(template_name, data_keys, **context):
+    """Render a template fragment, or return it from the cache.
+
+    data_keys are the catalog cache keys the context was built from; they
+    must already be loaded. The route arguments, the query string and the
+    image manifest version are part of the cache key.
+    """
+    versions = tuple(catalog.version(i) for i in data_keys)
+    if None in versions:
+        return Markup(render_template(template_name, **context))
+
+    key = (template_name, tuple(sorted(request.view_args.items())),
+           request.query_string, versions,
+           static_images.manifest_version())
+    return Markup(fragments.get(
+        key, lambda: render_template(template_name, **context),
+        versioner=lambda html: None))
+
+
+def invalidate():
+    """Drop every cached fragment."""
+    fragments.invalidate()
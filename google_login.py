@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Google Sign-In helpers for the gconnect and gdisconnect routes.
+
+The ID token returned with the access token is verified locally: its
+signature against Google's public signing certificates, which are cached and
+refreshed when they expire (or, at most every CERTS_MIN_REFRESH_SECONDS,
+when a token names a key that is not cached yet), and its audience, issuer,
+and expiry. The profile claims in the
+ID token are used for the user's details, so a successful login needs no
+further calls to Google once the certificates are cached.
+
+Every remaining HTTP call uses pooled, keep-alive connections with timeouts.
+All Google endpoints can be overridden through environment variables, so
+logins can be tested against a local stand-in identity server.
+
+oauth2client, httplib2 and requests are imported on first use, so processes
+that never handle a login do not pay for loading them.
+"""
+
+import base64
+import json
+import os
+import re
+import threading
+import time
+
+CERTS_URL = os.environ.get('GOOGLE_CERTS_URL',
+                           'https://www.googleapis.com/oauth2/v1/certs')
+USERINFO_URL = os.environ.get('GOOGLE_USERINFO_URL',
+                              'https://www.googleapis.com/oauth2/v1/userinfo')
+REVOKE_URL = os.environ.get('GOOGLE_REVOKE_URL',
+                            'https://accounts.google.com/o/oauth2/revoke')
+ISSUERS = tuple(os.environ.get(
+    'GOOGLE_ISSUERS', 'accounts.google.com,https://accounts.google.com'
+).split(','))
+
+HTTP_TIMEOUT = float(os.environ.get('GOOGLE_HTTP_TIMEOUT', 5))
+DEFAULT_CERTS_MAX_AGE = 3600
+CERTS_MIN_REFRESH_SECONDS = float(
+    os.environ.get('GOOGLE_CERTS_MIN_REFRESH_SECONDS', 60))
+
+PROFILE_CLAIMS = ('name', 'picture', 'email', 'given_name')
+
+
+class LoginError(Exception):
+    """Raised when a Google login cannot be verified."""
+
+
+_http = None
+_http_lock = threading.Lock()
+_local = threading.local()
+
+
+def http():
+    """Return the shared requests session, creating it on first use.
+
+    requests sessions pool connections per host and are safe to share
+    between threads for plain GET and POST calls.
+    """
+    global _http
+    if _http is None:
+        import requests
+
+        with _http_lock:
+            if _http is None:
+                session = requests.Session()
+                for prefix in ('https://', 'http://'):
+                    session.mount(prefix, requests.adapters.HTTPAdapter(
+                        pool_connections=4, pool_maxsize=16))
+                _http = session
+    return _http
+
+
+def oauth_http():
+    """Return this thread's keep-alive httplib2 client for oauth2client."""
+    client = getattr(_local, 'http', None)
+    if client is None:
+        import httplib2
+
+        client = _local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return client
+
+
+def exchange_code(client_secrets, code):
+    """Upgrade an authorization code into oauth2client credentials.
+
+    Raise LoginError if Google does not accept the code.
+    """
+    from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
+
+    oauth_flow = flow_from_clientsecrets(client_secrets, scope='')
+    oauth_flow.redirect_uri = 'postmessage'
+    try:
+        return oauth_flow.step2_exchange(code, http=oauth_http())
+    except FlowExchangeError as e:
+        raise LoginError(str(e))
+
+
+class CertificateCache(object):
+    """Google's public signing certificates, refreshed as they expire."""
+
+    def __init__(self, url):
+        self.url = url
+        self._certs = {}
+        self._expires = 0
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Download the certificates and honor their Cache-Control max-age."""
+        response = http().get(self.url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        max_age = re.search(r'max-age=(\d+)',
+                            response.headers.get('Cache-Control', ''))
+        with self._lock:
+            self._certs = response.json()
+            self._expires = time.time() + (int(max_age.group(1)) if max_age
+                                           else DEFAULT_CERTS_MAX_AGE)
+
+    def certs(self, key_id=None):
+        """Return the cached certificates, refreshing them if needed.
+
+        They are refreshed once they expire, and when key_id is not among
+        them, as Google may have rotated in a new key since they were cached.
+        Unknown keys trigger a refresh at most every CERTS_MIN_REFRESH_SECONDS,
+        so tokens with made-up keys cannot make every login download them.
+        """
+        now = time.time()
+        refresh = now >= self._expires
+        if not refresh and key_id is not None and key_id not in self._certs:
+            with self._lock:
+                refresh = (self._refreshed_at is None or
+                           now - self._refreshed_at >=
+                           CERTS_MIN_REFRESH_SECONDS)
+                if refresh:
+                    self._refreshed_at = now
+        if refresh:
+            self.refresh()
+        return self._certs
+
+
+certificates = CertificateCache(CERTS_URL)
+
+
+def token_key_id(id_token):
+    """Return the ID of the key a JWT says it was signed with, or None.
+
+    Raise ValueError if the token header cannot be decoded.
+    """
+    header = id_token.split('.')[0]
+    header = json.loads(base64.urlsafe_b64decode(
+        header + '=' * (-len(header) % 4)).decode('utf8'))
+    return header.get('kid') if isinstance(header, dict) else None
+
+
+def verify_id_token(id_token, client_id):
+    """Verify a Google ID token locally and return its claims.
+
+    Raise LoginError if the signature, audience, issuer, or expiry is wrong.
+    """
+    import requests
+    from oauth2client import crypt
+
+    try:
+        claims = crypt.verify_signed_jwt_with_certs(
+            id_token, certificates.certs(token_key_id(id_token)), client_id)
+    except (crypt.AppIdentityError, requests.RequestException,
+            ValueError) as e:
+        raise LoginError(str(e))
+
+    if claims.get('iss') not in ISSUERS:
+        raise LoginError('Token was not issued by Google.')
+    if not claims.get('sub'):
+        raise LoginError('Token has no subject.')
+    return claims
+
+
+def user_info(access_token, claims):
+    """Return the user's name, picture, email, and first name.
+
+    They are taken from the ID token claims when the token carries them,
+    otherwise from the userinfo endpoint.
+    """
+    if all(i in claims for i in PROFILE_CLAIMS):
+        return claims
+
+    import requests
+
+    try:
+        response = http().get(USERINFO_URL,
+                              params={'access_token': access_token,
+                                      'alt': 'json'},
+                              timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise LoginError(str(e))
+
+
+def revoke(access_token):
+    """Revoke an access token and return True if Google accepted it."""
+    import requests
+
+    try:
+        response = http().get(REVOKE_URL, params={'token': access_token},
+                              timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
@@ -0,0 +1,80 @@
+"""
+Gunicorn settings for serving wsgi:app in production.
+
+The app runs in one worker process per CPU core (WEB_CONCURRENCY) with
+WEB_THREADS threads each. Every worker has its own connection pool of
+DB_POOL_SIZE connections plus DB_MAX_OVERFLOW, so PostgreSQL must accept
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, and WEB_THREADS should
+not exceed the pool size by much. With DATABASE_REPLICA_URL set, each worker
+has a pool of the same size for the replica as well.
+
+Restarting gracefully:
+
+* kill -HUP <master pid> starts new workers with the current code and
+  settings, then lets the old workers finish their requests and exit.
+* kill -TERM <master pid> stops taking new connections and shuts down after
+  in-flight requests finish, waiting at most graceful_timeout seconds.
+
+Workers are also recycled after roughly max_requests requests, which bounds
+the growth of the in-process caches and of any leaked memory.
+
+All workers listen on the same port, so a scrape of /metrics reaches any one
+of them. They therefore share their metrics through METRICS_DIR (a fresh
+temporary directory unless it is set), which /metrics adds up across the
+workers; see metrics.py. The counters of recycled workers are kept there.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:%s' % os.environ.get('PORT', 8000))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+
+# Load the app in each worker rather than in the master, so HUP also picks up
+# new code. The app is safe to preload (set PRELOAD=1 to share its memory
+# between workers), in which case deploying new code takes a USR2 upgrade.
+preload_app = os.environ.get('PRELOAD', '') == '1'
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+if not os.environ.get('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='catalog-metrics-')
+
+
+def on_starting(server):
+    """Forget the metrics of a previous run sharing METRICS_DIR."""
+    import metrics
+    metrics.clear_directory()
+
+
+def post_worker_init(worker):
+    """Connect the new worker before it takes its first request.
+
+    This runs once the worker has loaded wsgi:app, which configures the app,
+    whether or not the app was preloaded.
+    """
+    import application
+    application.get_engine()
+
+
+def worker_exit(server, worker):
+    """Close the worker's pooled connections on its way out."""
+    import application
+    import metrics
+    application.dispose_engines()
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    """Keep the counters of a worker that exited, however it exited."""
+    import metrics
+    metrics.retire(worker.pid)
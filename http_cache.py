@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Conditional GET support (ETag and 304) for catalog routes.
+
+A route decorated with conditional() names the catalog cache entries its
+response is built from. The ETag of the response is a hash of their data
+versions and of anything else the response varies on: the query string,
+the logged in user shown in the page header, and the versions of whatever
+else it is built from, such as the templates and the image manifest of the
+HTML pages. When those entries are fresh in the cache, a request whose
+If-None-Match still matches is answered with 304 before the view runs, so
+it costs no database or template work at all.
+
+Responses carry no Last-Modified: every worker loads its cache entries at
+its own time, and a date to the second cannot tell apart two writes made
+within the same second.
+"""
+
+import functools
+import hashlib
+
+from flask import current_app, make_response, request, Response
+from flask import session as login_session
+
+import static_images
+from catalog_cache import catalog
+
+_template_version = None
+
+
+def template_version():
+    """Return a hash of the application's templates.
+
+    Templates only change with a deploy, which restarts the workers, so it
+    is computed once.
+    """
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.sha1()
+        environment = current_app.jinja_env
+        for name in sorted(environment.list_templates()):
+            source = environment.loader.get_source(environment, name)[0]
+            digest.update(name.encode('utf8'))
+            digest.update(source.encode('utf8'))
+        _template_version = digest.hexdigest()
+    return _template_version
+
+
+def page_versions():
+    """Return the versions every HTML page is built from besides the data."""
+    return [template_version(), static_images.manifest_version()]
+
+
+def _etag(keys, extra):
+    """Return the ETag of the entries and extra strings, or None if unknown."""
+    if extra is None:
+        return None
+    versions = []
+    for key in keys:
+        version = catalog.version(key)
+        if version is None:
+            return None
+        versions.append(version)
+
+    digest = hashlib.sha1()
+    for i in versions + [request.query_string.decode('utf8')] + extra:
+        digest.update(i.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def conditional(keys, vary=None, versions=None):
+    """Decorate a view so that it answers conditional GETs.
+
+    keys(**view_args) returns the catalog cache keys the response is built
+    from. vary() returns a string for anything else the response depends
+    on, such as the logged in user shown in the page header; responses with
+    a vary function are marked private. versions() returns the versions of
+    anything else the response is built from as a list of strings, or None
+    if one is not known, in which case the response has no ETag.
+    """
+    def extra():
+        strings = [vary()] if vary is not None else []
+        if versions is None:
+            return strings
+        more = versions()
+        return None if more is None else strings + more
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            # Flashed messages are shown once on the next page, so never
+            # skip rendering a page while one is pending.
+            if vary is not None and '_flashes' in login_session:
+                return view(**view_args)
+
+            cache_keys = keys(**view_args)
+            etag = _etag(cache_keys, extra())
+            if etag is not None and request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+                etag = _etag(cache_keys, extra())
+                if etag is None:
+                    return response
+
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            if vary is not None:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
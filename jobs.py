@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+"""
+Background jobs for long-running catalog and program operations.
+
+Jobs are rows of the jobs table in the exercisecatalog database, so queued
+work survives restarts. The web tier only inserts a row (see enqueue) and
+answers straight away; a separate pool of worker processes runs the jobs:
+
+    python jobs.py work --workers 4
+    python jobs.py enqueue build_images '{"force": true}'
+    python jobs.py status 12
+
+Each worker claims the oldest queued job with SELECT ... FOR UPDATE SKIP
+LOCKED, so workers never wait on each other or run a job twice. On
+PostgreSQL, idle workers LISTEN for a NOTIFY sent when a job is queued, so
+they pick it up without delay; they also poll every POLL_SECONDS.
+
+A job that raises is retried, after RETRY_SECONDS doubling with every
+attempt, up to its max_attempts; JobError fails it at once. Workers record a
+heartbeat while running a job, and the jobs of a worker that stopped
+heartbeating (it crashed or was killed) are queued again. Progress, the
+result, and any output file are stored on the job row, where the status
+endpoints read them. Finished jobs are deleted after JOB_RETENTION_DAYS.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, create_engine, select as select_, text, update
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import Jobs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 5))
+HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', 10))
+STALE_SECONDS = HEARTBEAT_SECONDS * 6
+RETRY_SECONDS = float(os.environ.get('JOB_RETRY_SECONDS', 30))
+RETENTION_DAYS = float(os.environ.get('JOB_RETENTION_DAYS', 7))
+
+# Progress is written at most this often, however often a job reports it.
+PROGRESS_SECONDS = 1.0
+
+NOTIFY_CHANNEL = 'jobs'
+
+logger = logging.getLogger('jobs')
+
+jobs = Jobs.__table__
+
+# Job kind -> function(context, payload) returning the JSON result.
+handlers = {}
+
+
+class JobError(Exception):
+    """A job failed in a way that retrying cannot fix."""
+
+
+def handler(kind):
+    """Register the decorated function as the handler of a job kind."""
+    def register(function):
+        handlers[kind] = function
+        return function
+    return register
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def enqueue(session, kind, payload, user_id=None, max_attempts=3):
+    """Queue a job and return it; the caller commits.
+
+    On PostgreSQL the workers are notified when the transaction commits.
+    """
+    if kind not in handlers:
+        raise ValueError('unknown job kind: %s' % kind)
+    created = now()
+    job = Jobs(kind=kind, payload=json.dumps(payload), status='queued',
+               attempts=0, max_attempts=max_attempts, user_id=user_id,
+               created_at=created, run_after=created)
+    session.add(job)
+    session.flush()
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text('NOTIFY %s' % NOTIFY_CHANNEL))
+    return job
+
+
+def queue_snapshot_export(session, directory):
+    """Queue a catalog snapshot export, unless one is already waiting.
+
+    The caller commits.
+    """
+    waiting = session.query(Jobs.id).filter_by(
+        kind='export_snapshot', status='queued').first()
+    if waiting is None:
+        enqueue(session, 'export_snapshot',
+                {'directory': os.path.abspath(directory)})
+
+
+class JobContext(object):
+    """What a handler gets to report progress and store its output."""
+
+    def __init__(self, engine, job_id, worker):
+        self.engine = engine
+        self.job_id = job_id
+        self.worker = worker
+        self.output = None
+        self.output_type = None
+        self._progress_at = 0
+
+    def session(self):
+        """Return a new database session; the handler closes it."""
+        return sessionmaker(bind=self.engine)()
+
+    def progress(self, fraction, message=None):
+        """Record how far along the job is, as a fraction from 0 to 1."""
+        if time.monotonic() - self._progress_at < PROGRESS_SECONDS:
+            return
+        self._progress_at = time.monotonic()
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(jobs).where(and_(jobs.c.id == self.job_id,
+                                        jobs.c.locked_by == self.worker))
+                .values(progress=fraction, progress_message=message,
+                        heartbeat_at=now()))
+
+    def set_output(self, data, content_type):
+        """Store a file the job produced, served by the job output route."""
+        self.output = data
+        self.output_type = content_type
+
+
+def claim(engine, worker):
+    """Mark the next due job as running by worker; return it, or None."""
+    started = now()
+    values = dict(status='running', attempts=jobs.c.attempts + 1,
+                  locked_by=worker, started_at=started, heartbeat_at=started,
+                  progress=None, progress_message=None)
+    due = (
+        select_(jobs.c.id)
+        .where(and_(jobs.c.status == 'queued', jobs.c.run_after <= started))
+        .order_by(jobs.c.run_after, jobs.c.id)
+        .limit(1)
+    )
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            # One statement; rows other workers hold are skipped, not waited
+            # for.
+            job = connection.execute(
+                update(jobs)
+                .where(jobs.c.id == due.with_for_update(skip_locked=True)
+                       .scalar_subquery())
+                .values(**values)
+                .returning(jobs.c.id, jobs.c.kind, jobs.c.payload,
+                           jobs.c.attempts, jobs.c.max_attempts)).first()
+            return job
+
+        # SQLite serializes writers; the status check makes the claim safe.
+        job_id = connection.execute(due).scalar()
+        if job_id is None or connection.execute(
+                update(jobs).where(and_(jobs.c.id == job_id,
+                                        jobs.c.status == 'queued'))
+                .values(**values)).rowcount != 1:
+            return None
+        return connection.execute(
+            select_(jobs.c.id, jobs.c.kind, jobs.c.payload, jobs.c.attempts,
+                    jobs.c.max_attempts).where(jobs.c.id == job_id)).first()
+
+
+def finish(engine, job, worker, **values):
+    """Store the outcome of a job the worker still holds.
+
+    Return False if the job was taken away from the worker meanwhile.
+    """
+    with engine.begin() as connection:
+        return connection.execute(
+            update(jobs).where(and_(jobs.c.id == job.id,
+                                    jobs.c.locked_by == worker))
+            .values(locked_by=None, **values)).rowcount == 1
+
+
+def heartbeat(engine, job, worker, done):
+    """Refresh the heartbeat of a running job until done is set."""
+    while not done.wait(HEARTBEAT_SECONDS):
+        with engine.begin() as connection:
+            connection.execute(
+                update(jobs).where(and_(jobs.c.id == job.id,
+                                        jobs.c.locked_by == worker))
+                .values(heartbeat_at=now()))
+
+
+def run_job(engine, job, worker):
+    """Run a claimed job and store its result, or schedule its retry."""
+    context = JobContext(engine, job.id, worker)
+    done = threading.Event()
+    beating = threading.Thread(target=heartbeat,
+                               args=(engine, job, worker, done), daemon=True)
+    beating.start()
+    start = time.perf_counter()
+    try:
+        function = handlers.get(job.kind)
+        if function is None:
+            raise JobError('unknown job kind: %s' % job.kind)
+        result = function(context, json.loads(job.payload))
+    except Exception as e:
+        retry = (not isinstance(e, JobError) and
+                 job.attempts < job.max_attempts)
+        logger.warning('Job %d (%s) failed on attempt %d of %d%s', job.id,
+                       job.kind, job.attempts, job.max_attempts,
+                       ', retrying' if retry else '',
+                       exc_info=not isinstance(e, JobError))
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        if retry:
+            delay = RETRY_SECONDS * 2 ** (job.attempts - 1)
+            finish(engine, job, worker, status='queued', error=error,
+                   run_after=now() + timedelta(seconds=delay))
+        else:
+            finish(engine, job, worker, status='failed', error=error,
+                   finished_at=now())
+        return
+    finally:
+        done.set()
+
+    if not finish(engine, job, worker, status='succeeded', progress=1.0,
+                  progress_message=None, error=None,
+                  result=json.dumps(result),
+                  output=context.output, output_type=context.output_type,
+                  finished_at=now()):
+        logger.warning('Job %d (%s) was queued again while it ran; its '
+                       'result was dropped', job.id, job.kind)
+        return
+    logger.info('Job %d (%s) succeeded in %.2fs', job.id, job.kind,
+                time.perf_counter() - start)
+
+
+def recover(engine):
+    """Queue the jobs of dead workers again, and delete old finished jobs."""
+    current = now()
+    stale = and_(jobs.c.status == 'running',
+                 jobs.c.heartbeat_at < current - timedelta(
+                     seconds=STALE_SECONDS))
+    with engine.begin() as connection:
+        connection.execute(
+            update(jobs).where(and_(stale,
+                                    jobs.c.attempts < jobs.c.max_attempts))
+            .values(status='queued', locked_by=None, run_after=current))
+        connection.execute(
+            update(jobs).where(stale)
+            .values(status='failed', locked_by=None, finished_at=current,
+                    error='The worker running the job stopped'))
+        connection.execute(
+            jobs.delete().where(and_(
+                jobs.c.status.in_(['succeeded', 'failed']),
+                jobs.c.finished_at < current - timedelta(
+                    days=RETENTION_DAYS))))
+
+
+class Waiter(object):
+    """Sleeps until a job is queued or the poll interval has passed."""
+
+    def __init__(self, engine):
+        self.connection = None
+        if engine.dialect.name == 'postgresql':
+            self.connection = engine.raw_connection()
+            # Keep the autocommit connection out of the pool.
+            self.connection.detach()
+            self.connection.dbapi_connection.autocommit = True
+            self.connection.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+
+    def wait(self, timeout):
+        if self.connection is None:
+            time.sleep(timeout)
+            return
+        dbapi_connection = self.connection.dbapi_connection
+        if select.select([dbapi_connection], [], [], timeout)[0]:
+            dbapi_connection.poll()
+            del dbapi_connection.notifies[:]
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+def work(database_url, worker, stop):
+    """Run jobs until stop is set; the main loop of one worker process."""
+    engine = create_engine(database_url)
+    waiter = Waiter(engine)
+    recovered_at = 0
+    try:
+        while not stop.is_set():
+            if time.monotonic() - recovered_at > HEARTBEAT_SECONDS:
+                recover(engine)
+                recovered_at = time.monotonic()
+            job = claim(engine, worker)
+            if job is None:
+                waiter.wait(POLL_SECONDS)
+            else:
+                run_job(engine, job, worker)
+    finally:
+        waiter.close()
+        engine.dispose()
+
+
+def _worker_process(database_url, worker, stop):
+    # Stop after the current job on SIGTERM or Ctrl-C, like the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s: %(message)s')
+    work(database_url, worker, stop)
+
+
+def run_pool(database_url, processes):
+    """Run a pool of worker processes, restarting any that dies.
+
+    SIGTERM or Ctrl-C lets every worker finish its current job, then exits.
+    """
+    stop = multiprocessing.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    def start(number):
+        worker = '%s:%d:%d' % (socket.gethostname(), os.getpid(), number)
+        process = multiprocessing.Process(
+            target=_worker_process, args=(database_url, worker, stop),
+            name='job-worker-%d' % number)
+        process.start()
+        return process
+
+    pool = [start(i) for i in range(processes)]
+    logger.info('Started %d job workers', processes)
+    while not stop.wait(1):
+        for number, process in enumerate(pool):
+            if not process.is_alive():
+                logger.warning('Job worker %d exited with %s; restarting it',
+                               number, process.exitcode)
+                pool[number] = start(number)
+    for process in pool:
+        process.join()
+
+
+def job_status(engine, job_id):
+    """Return the serialized job, or None if there is no such job."""
+    session = sessionmaker(bind=engine)()
+    try:
+        job = session.get(Jobs, job_id)
+        return job.serialize if job is not None else None
+    finally:
+        session.close()
+
+
+@handler('generate_programs')
+def generate_programs_job(context, payload):
+    """Generate the programs of a client roster, see batch_programs."""
+    import batch_programs
+
+    lines, content_type = batch_programs.FORMATS.get(
+        payload.get('format', 'ndjson'), (None, None))
+    if lines is None:
+        raise JobError('unknown format: %s' % payload['format'])
+    try:
+        clients = batch_programs.read_clients(payload.get('clients'))
+    except ValueError as e:
+        raise JobError(str(e))
+
+    session = context.session()
+    try:
+        loaded = batch_programs.load_batch(session, payload['template_id'])
+    finally:
+        session.close()
+    if loaded is None:
+        raise JobError('there is no template %s' % payload['template_id'])
+
+    def with_progress(results):
+        for count, result in enumerate(results, 1):
+            context.progress(count / len(clients),
+                             '%d of %d programs' % (count, len(clients)))
+            yield result
+
+    start = time.perf_counter()
+    context.set_output(''.join(lines(with_progress(
+        batch_programs.generate_programs(*loaded, clients,
+                                         seed=payload.get('seed'))))),
+        content_type)
+    seconds = time.perf_counter() - start
+    return {'programs': len(clients), 'seconds': round(seconds, 3),
+            'programs_per_second': round(len(clients) / seconds, 1)
+            if seconds else None}
+
+
+@handler('load_catalog')
+def load_catalog_job(context, payload):
+    """Load the catalog CSV files, see python_db_script.
+
+    Queues an export of the catalog snapshot if snapshot_directory is in the
+    payload or CATALOG_SNAPSHOT_DIR is set.
+    """
+    import python_db_script
+
+    dsn = context.engine.url.set(drivername='postgresql')
+    python_db_script.database_connection(
+        dsn.render_as_string(hide_password=False),
+        payload.get('directory', HERE))
+    snapshot_directory = payload.get('snapshot_directory',
+                                     os.environ.get('CATALOG_SNAPSHOT_DIR'))
+    if snapshot_directory:
+        session = context.session()
+        try:
+            queue_snapshot_export(session, snapshot_directory)
+            session.commit()
+        finally:
+            session.close()
+    return {}
+
+
+@handler('build_images')
+def build_images_job(context, payload):
+    """Build the responsive image variants, see static_images."""
+    import static_images
+
+    manifest = static_images.build(payload.get('force', False))
+    return {'images': len(manifest)}
+
+
+@handler('export_snapshot')
+def export_snapshot_job(context, payload):
+    """Export and publish a catalog snapshot, see catalog_snapshot."""
+    import catalog_snapshot
+
+    name, published = catalog_snapshot.export(
+        context.engine, payload.get('directory', os.path.join(HERE,
+                                                              'snapshots')))
+    return {'snapshot': name, 'published': published}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Run and queue background jobs.')
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL',
+                                               'postgresql:///exercisecatalog'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('work', help='run a pool of job workers')
+    command.add_argument('--workers', type=int,
+                         default=int(os.environ.get('JOB_WORKERS', 2)),
+                         help='worker processes')
+    command = commands.add_parser('enqueue', help='queue a job')
+    command.add_argument('kind', choices=sorted(handlers))
+    command.add_argument('payload', nargs='?', default='{}',
+                         help='JSON payload of the job')
+    command = commands.add_parser('status', help='show a job')
+    command.add_argument('job_id', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s: %(message)s')
+    if args.command == 'work':
+        run_pool(args.database_url, args.workers)
+    else:
+        engine = create_engine(args.database_url)
+        if args.command == 'enqueue':
+            session = sessionmaker(bind=engine)()
+            try:
+                job = enqueue(session, args.kind, json.loads(args.payload))
+                session.commit()
+                print('Queued job %d' % job.id)
+            finally:
+                session.close()
+        else:
+            status = job_status(engine, args.job_id)
+            if status is None:
+                parser.error('there is no job %d' % args.job_id)
+            print(json.dumps(status, indent=2))
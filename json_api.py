@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Keyset pagination and streaming for the JSON API Endpoints.
+
+Every list endpoint accepts these optional query string parameters:
+
+    limit   return at most this many rows, at least 1 (capped at
+            MAX_PAGE_SIZE)
+    after   only return rows whose ID is greater than this cursor
+    stream  when set, stream every row after the cursor instead of a page
+
+A page response carries a "next" cursor to pass back as after, or null on
+the last page. Streamed responses read rows from a server-side cursor and
+write the JSON out as they go, so memory use stays flat however large the
+catalog grows.
+"""
+
+import json
+
+from flask import abort, jsonify, request, Response, stream_with_context
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+
+def int_arg(name, default=None):
+    """Read a non-negative integer query string argument, or abort with 400."""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < 0:
+        abort(400)
+    return value
+
+
+def int_set_arg(name):
+    """Read a comma separated list of non-negative integers as a set.
+
+    Return None when the argument is not given at all, and abort with 400
+    when it is malformed.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        values = {int(i) for i in value.split(',') if i.strip()}
+    except ValueError:
+        abort(400)
+    if any(i < 0 for i in values):
+        abort(400)
+    return values
+
+
+def wants_paging():
+    """Return True if the request asked for a page or a stream."""
+    return any(i in request.args for i in ('limit', 'after', 'stream'))
+
+
+def paginated_json(key, query, column):
+    """Return a page or a stream of query results, serialized under key.
+
+    The query must not be ordered yet; rows are ordered by column, which is
+    also the column the cursor refers to.
+    """
+    after = int_arg('after')
+    if after is not None:
+        query = query.filter(column > after)
+    query = query.order_by(column)
+
+    if request.args.get('stream'):
+        return stream_json(key, query)
+
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE)
+    if limit == 0:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    rows = query.limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return jsonify({key: [i.serialize for i in rows[:limit]],
+                    'next': next_cursor})
+
+
+def stream_json(key, query):
+    """Stream the serialized query results as {"key": [...]}."""
+    rows = (
+        query.execution_options(stream_results=True)
+        .yield_per(STREAM_BATCH_SIZE)
+    )
+
+    def generate():
+        yield '{%s: [' % json.dumps(key)
+        separator = ''
+        batch = []
+        for row in rows:
+            batch.append(json.dumps(row.serialize))
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield separator + ', '.join(batch)
+                separator = ', '
+                batch = []
+        if batch:
+            yield separator + ', '.join(batch)
+        yield ']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
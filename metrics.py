@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+
+"""
+Request, database, and cache metrics in the Prometheus text format.
+
+init_app() and instrument_engine() hook into Flask and a SQLAlchemy engine
+to record, per Flask endpoint:
+
+* the number of requests and their latency (a histogram),
+* the number of SQL statements sent and the time spent in them.
+
+Engines created with poolclass=TimedQueuePool also record how long each
+connection checkout waited for the pool. The hit and miss counts of the
+in-process caches and the state of the connection pools are read when
+/metrics is scraped.
+
+With SERVER_TIMING=1 every response also carries a Server-Timing header with
+the statement count, the database time, and the total time of the request,
+which browser developer tools show next to the request.
+
+Metrics are kept per process. When several worker processes serve the app
+behind one port (gunicorn.conf.py), set METRICS_DIR to a directory they
+share: every process then writes its values there, at most
+METRICS_FLUSH_SECONDS apart, and a scrape of any worker adds up the values
+of all of them. Counters and histograms keep the totals of workers that have
+exited (see retire()), so they never go backwards; gauges only add up the
+workers that are running.
+"""
+
+import bisect
+import fcntl
+import functools
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true',
+                                                                 'yes')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+
+# The totals of the processes that have exited, in METRICS_DIR.
+RETIRED = 'retired.json'
+
+registry = []
+
+# The engines whose pool state is exposed, by name; see instrument_engine().
+_engines = {}
+
+
+def _format_labels(names, values):
+    """Return the {name="value",...} part of a sample line."""
+    if not names:
+        return ''
+    escaped = (str(i).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for i in values)
+    return '{%s}' % ','.join('%s="%s"' % i for i in zip(names, escaped))
+
+
+def _format_value(value):
+    """Return a sample value the way Prometheus expects it."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named family of samples, one per combination of label values."""
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[i] for i in self.labels)
+
+    def values(self):
+        """Return the current label values to value mapping."""
+        with self._lock:
+            return dict(self._values)
+
+    def sample_lines(self, key, value):
+        yield '%s%s %s' % (self.name, _format_labels(self.labels, key),
+                           _format_value(value))
+
+    def expose(self, values=None):
+        """Return the lines of this metric in the text format.
+
+        values defaults to the values of this process.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        if values is None:
+            values = self.values()
+        for key, value in sorted(values.items()):
+            lines.extend(self.sample_lines(key, value))
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Collected(Metric):
+    """A metric whose values are read from collect() when it is exposed.
+
+    collect() returns a mapping of label value tuples to values; type is
+    'gauge', or 'counter' for totals kept elsewhere.
+    """
+
+    def __init__(self, name, documentation, labels=(), collect=None,
+                 type='gauge'):
+        super(Collected, self).__init__(name, documentation, labels)
+        self.collect = collect
+        self.type = type
+
+    def values(self):
+        return self.collect()
+
+
+class Histogram(Metric):
+    """Observations counted into buckets, with their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum.
+                counts = self._values[key] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def values(self):
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    def sample_lines(self, key, counts):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            yield '%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.labels + ('le',),
+                               key + (_format_value(bound),)),
+                total)
+        labels = _format_labels(self.labels, key)
+        yield '%s_sum%s %s' % (self.name, labels, _format_value(counts[-1]))
+        yield '%s_count%s %d' % (self.name, labels, total)
+
+
+requests_total = Counter(
+    'http_requests_total', 'HTTP requests handled.',
+    ('endpoint', 'method', 'status'))
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling HTTP requests.',
+    ('endpoint',))
+statements_total = Counter(
+    'db_statements_total', 'SQL statements sent to the database.',
+    ('endpoint',))
+statement_seconds = Counter(
+    'db_statement_seconds_total', 'Time spent executing SQL statements.',
+    ('endpoint',))
+pool_wait = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the pool.',
+    buckets=POOL_WAIT_BUCKETS)
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long every checkout waited."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - start)
+
+
+def _endpoint():
+    """Return the endpoint label of the current request."""
+    if not has_request_context():
+        return ''
+    return request.endpoint or 'unmatched'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['metrics_start'].pop()
+    endpoint = _endpoint()
+    statements_total.inc(endpoint=endpoint)
+    statement_seconds.inc(duration, endpoint=endpoint)
+    if has_request_context():
+        g.metrics_statements = g.get('metrics_statements', 0) + 1
+        g.metrics_db_time = g.get('metrics_db_time', 0) + duration
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    if METRICS_DIR:
+        _flusher.start()
+
+
+def _record(endpoint, method, status, start):
+    request_duration.observe(time.perf_counter() - start, endpoint=endpoint)
+    requests_total.inc(endpoint=endpoint, method=method, status=status)
+
+
+def _finish_response(response):
+    """Add the Server-Timing header and record the request when it closes.
+
+    Recording on close means streamed bodies are included in the latency.
+    """
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    if SERVER_TIMING:
+        response.headers.add(
+            'Server-Timing',
+            'db;dur=%.3f;desc="%d statements", total;dur=%.3f' % (
+                g.get('metrics_db_time', 0) * 1000,
+                g.get('metrics_statements', 0),
+                (time.perf_counter() - start) * 1000))
+    response.call_on_close(functools.partial(
+        _record, _endpoint(), request.method, response.status_code, start))
+    return response
+
+
+def _finish_request(exception=None):
+    """Record requests that failed before a response was made."""
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        _record(_endpoint(), request.method, 500, start)
+
+
+def instrument_engine(engine, name='primary'):
+    """Record the SQL statements and pool state of an engine.
+
+    The pool state is labelled with name, which replaces any engine
+    instrumented under that name before.
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _engines[name] = engine
+
+
+def init_app(app, caches):
+    """Record metrics for an app.
+
+    caches maps a name to each TTLCache whose hit rate should be exposed.
+    """
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_finish_request)
+
+    Collected('cache_hits_total', 'Lookups answered from a process cache.',
+              ('cache',),
+              lambda: {(k, ): v.hits for k, v in caches.items()},
+              type='counter')
+    Collected('cache_misses_total', 'Lookups that had to load the value.',
+              ('cache',),
+              lambda: {(k, ): v.misses for k, v in caches.items()},
+              type='counter')
+    Collected('cache_entries', 'Entries held by an in-process cache.',
+              ('cache',),
+              lambda: {(k, ): len(v) for k, v in caches.items()})
+
+    def pool_state():
+        state = {}
+        for name, engine in list(_engines.items()):
+            pool = engine.pool
+            if isinstance(pool, QueuePool):
+                state.update({
+                    (name, 'size'): pool.size(),
+                    (name, 'checked_in'): pool.checkedin(),
+                    (name, 'checked_out'): pool.checkedout(),
+                    (name, 'overflow'): pool.overflow()})
+        return state
+
+    Collected('db_pool_connections',
+              'Connections in the pool of each engine, by state.',
+              ('engine', 'state'), pool_state)
+
+
+class Flusher(object):
+    """Writes the values of this process to METRICS_DIR in the background."""
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the flushing thread of this process, if not running yet."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='metrics', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            flush()
+
+
+_flusher = Flusher()
+
+
+def _process_file(pid):
+    return os.path.join(METRICS_DIR, '%d.json' % pid)
+
+
+def _read(path):
+    """Return the values stored in a metrics file, or {} if it is gone."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write(path, data):
+    """Replace a metrics file, so readers see either the old or the new."""
+    fd, temporary = tempfile.mkstemp(dir=METRICS_DIR, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def _directory_lock(exclusive):
+    """Lock METRICS_DIR against retire() moving values between files."""
+    fd = os.open(os.path.join(METRICS_DIR, '.lock'),
+                 os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return fd
+
+
+def _merge_into(totals, data, counters_only):
+    """Add the samples of one process to totals, keyed by metric name.
+
+    Histogram samples are lists of bucket counts, added up one by one.
+    """
+    for name, metric in data.items():
+        if counters_only and metric['type'] == 'gauge':
+            continue
+        merged = totals.setdefault(name, {'type': metric['type'],
+                                          'samples': {}})['samples']
+        for key, value in metric['samples']:
+            key = tuple(key)
+            if key not in merged:
+                merged[key] = value
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+
+
+def _dump(totals):
+    """Return merged totals in the format of a metrics file."""
+    return {name: {'type': metric['type'],
+                   'samples': [[list(k), v]
+                               for k, v in metric['samples'].items()]}
+            for name, metric in totals.items()}
+
+
+def local_values():
+    """Return the samples of this process, in the format of a file."""
+    return {metric.name: {'type': metric.type,
+                          'samples': [[list(k), v]
+                                      for k, v in metric.values().items()]}
+            for metric in registry}
+
+
+def flush():
+    """Write the values of this process to METRICS_DIR, if it is set."""
+    if METRICS_DIR:
+        _write(_process_file(os.getpid()), local_values())
+
+
+def retire(pid):
+    """Add the counters of an exited process to the retired totals.
+
+    Its gauges are dropped. Called by the server for every worker that
+    exits, however it exited.
+    """
+    if not METRICS_DIR:
+        return
+    fd = _directory_lock(exclusive=True)
+    try:
+        data = _read(_process_file(pid))
+        if data:
+            totals = {}
+            _merge_into(totals, _read(os.path.join(METRICS_DIR, RETIRED)),
+                        counters_only=True)
+            _merge_into(totals, data, counters_only=True)
+            _write(os.path.join(METRICS_DIR, RETIRED), _dump(totals))
+        try:
+            os.remove(_process_file(pid))
+        except FileNotFoundError:
+            pass
+    finally:
+        os.close(fd)
+
+
+def clear_directory():
+    """Forget the values of every process, such as those of a previous run."""
+    if METRICS_DIR:
+        for pattern in ('*.json', '.tmp-*'):
+            for path in glob.glob(os.path.join(METRICS_DIR, pattern)):
+                os.remove(path)
+
+
+def aggregated_values():
+    """Return the values of every process in METRICS_DIR, added up."""
+    flush()
+    totals = {}
+    fd = _directory_lock(exclusive=False)
+    try:
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            _merge_into(totals, _read(path),
+                        counters_only=os.path.basename(path) == RETIRED)
+    finally:
+        os.close(fd)
+    return totals
+
+
+def exposition():
+    """Return every metric in the Prometheus text format.
+
+    With METRICS_DIR set, the values are those of every process.
+    """
+    totals = aggregated_values() if METRICS_DIR else None
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose(
+            totals.get(metric.name, {}).get('samples', {})
+            if totals is not None else None))
+    return '\n'.join(lines) + '\n'
+
+
+def response():
+    """Return a Flask response with the metrics, for the /metrics route."""
+    return Response(exposition(), content_type=CONTENT_TYPE)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""
+Versioned schema migrations for an existing exercisecatalog database.
+
+Each migration has a version number and runs once: the versions already
+applied are recorded in the schema_migrations table, and running the
+migrations again only applies the new ones, in order:
+
+    python migrations.py
+    python migrations.py --list
+
+New tables are created by database_setup.py (Base.metadata.create_all), which
+also creates the indexes declared on the models. Migrations bring databases
+created before a change up to date. Indexes on existing tables are built with
+CREATE INDEX CONCURRENTLY, which does not block writes to a live table; an
+index left invalid by an interrupted build is dropped and built again. New
+columns are backfilled in batches, each committed on its own.
+
+Only one process migrates at a time; the others wait on an advisory lock.
+"""
+
+import argparse
+
+from sqlalchemy import create_engine, text
+
+from database_setup import (
+    Base,
+    CatalogChange,
+    CatalogVersion,
+    Jobs,
+    upgrade_category_search,
+    upgrade_exercise_search,
+    upgrade_exercise_slugs,
+)
+
+# Held while migrating, so concurrent deploys do not migrate twice.
+ADVISORY_LOCK_ID = 4120318
+
+# Indexes the hot query paths need. They are declared on the models, which
+# are the single source of their definitions.
+HOT_PATH_INDEXES = (
+    'ix_exercises_secondary_category_id',
+    'ix_secondary_categories_primary_category_id',
+    'ix_exercise_equipment_reference_exercise_id',
+    'ix_exercise_equipment_reference_equipment_id',
+    'ix_templates_user_id',
+    'ix_template_items_template_id_id',
+)
+
+CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+)
+"""
+
+
+def model_index(name):
+    """Return the Index declared on the models under a name."""
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+def create_index_concurrently(engine, index):
+    """Build an index without locking its table against writes.
+
+    Safe to run more than once.
+    """
+    with engine.connect() as connection:
+        # CONCURRENTLY cannot run inside a transaction block.
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        valid = connection.execute(text(
+            'SELECT i.indisvalid FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name'), {'name': index.name}).scalar()
+        if valid is False:
+            connection.execute(text(
+                'DROP INDEX CONCURRENTLY IF EXISTS %s' % index.name))
+        using = index.dialect_options['postgresql']['using']
+        connection.execute(text(
+            'CREATE %sINDEX CONCURRENTLY IF NOT EXISTS %s ON %s %s(%s)' % (
+                'UNIQUE ' if index.unique else '', index.name,
+                index.table.name, 'USING %s ' % using if using else '',
+                ', '.join(column.name for column in index.columns))))
+
+
+def add_exercise_slugs(engine):
+    """Add and backfill exercises.slug, then index it per category."""
+    upgrade_exercise_slugs(engine)
+    create_index_concurrently(
+        engine, model_index('ix_exercises_secondary_category_slug'))
+
+
+def add_exercise_search(engine):
+    """Add and backfill exercises.search_vector, then build its GIN index."""
+    upgrade_exercise_search(engine)
+    create_index_concurrently(
+        engine, model_index('ix_exercises_search_vector'))
+
+
+def add_user_email_index(engine):
+    """Add the unique index on users.email, which logins upsert on.
+
+    Fails if two users share an email address; those rows must be merged
+    first.
+    """
+    create_index_concurrently(engine, model_index('ix_users_email'))
+
+
+def add_hot_path_indexes(engine):
+    """Index the columns every route filters or joins on."""
+    for name in HOT_PATH_INDEXES:
+        create_index_concurrently(engine, model_index(name))
+
+
+def add_job_queue(engine):
+    """Create the jobs table of the background job queue."""
+    Jobs.__table__.create(engine, checkfirst=True)
+
+
+def add_catalog_version(engine):
+    """Create the catalog_version table that workers watch for writes."""
+    CatalogVersion.__table__.create(engine, checkfirst=True)
+
+
+def add_catalog_changes(engine):
+    """Create the catalog_changes log the equipment index catches up from."""
+    CatalogChange.__table__.create(engine, checkfirst=True)
+
+
+MIGRATIONS = (
+    (1, 'Add exercise URL slugs', add_exercise_slugs),
+    (2, 'Add full-text exercise search', add_exercise_search),
+    (3, 'Add unique index on users.email', add_user_email_index),
+    (4, 'Add indexes for the hot query paths', add_hot_path_indexes),
+    (5, 'Add the background job queue', add_job_queue),
+    (6, 'Add the shared catalog version', add_catalog_version),
+    (7, 'Refresh search vectors on category renames',
+     upgrade_category_search),
+    (8, 'Add the catalog change log', add_catalog_changes),
+)
+
+
+def applied_versions(connection):
+    """Return the versions recorded in schema_migrations."""
+    return {row.version for row in connection.execute(
+        text('SELECT version FROM schema_migrations'))}
+
+
+def migrate(engine, verbose=True):
+    """Apply every migration that has not been applied yet."""
+    with engine.connect() as lock:
+        lock = lock.execution_options(isolation_level='AUTOCOMMIT')
+        lock.execute(text('SELECT pg_advisory_lock(:id)'),
+                     {'id': ADVISORY_LOCK_ID})
+        try:
+            lock.execute(text(CREATE_MIGRATIONS_TABLE))
+            applied = applied_versions(lock)
+            for version, description, upgrade in MIGRATIONS:
+                if version in applied:
+                    continue
+                if verbose:
+                    print('Applying %d: %s' % (version, description))
+                upgrade(engine)
+                lock.execute(text(
+                    'INSERT INTO schema_migrations (version, description) '
+                    'VALUES (:version, :description)'),
+                    {'version': version, 'description': description})
+        finally:
+            lock.execute(text('SELECT pg_advisory_unlock(:id)'),
+                         {'id': ADVISORY_LOCK_ID})
+
+
+def list_migrations(engine):
+    """Print every migration and whether it has been applied."""
+    with engine.begin() as connection:
+        connection.execute(text(CREATE_MIGRATIONS_TABLE))
+        applied = applied_versions(connection)
+    for version, description, upgrade in MIGRATIONS:
+        print('%s %3d  %s' % ('x' if version in applied else ' ', version,
+                              description))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Apply the pending schema migrations.')
+    parser.add_argument('--dsn', default='postgresql:///exercisecatalog',
+                        help='database to migrate')
+    parser.add_argument('--list', action='store_true',
+                        help='list the migrations and which are applied')
+    args = parser.parse_args()
+
+    engine = create_engine(args.dsn)
+    if args.list:
+        list_migrations(engine)
+    else:
+        migrate(engine)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in sampling profiler and slow-request log.
+
+When enabled, a background thread samples the Python stack of every request
+in flight every PROFILE_INTERVAL_MS milliseconds, and the SQL statements each
+request sends are timed. Sampling the stacks from another thread leaves the
+request code itself untouched, so the overhead stays low.
+
+A request's profile is written to PROFILE_DIR as JSON when the request was
+picked for sampling (a PROFILE_SAMPLE_RATE fraction of all requests) or when
+it took longer than PROFILE_SLOW_MS; slow requests are also logged. Only the
+newest PROFILE_KEEP profiles are kept. Profiling is off unless
+PROFILE_SAMPLE_RATE or PROFILE_SLOW_MS is set.
+
+The profiles can be summarized per endpoint, with the hottest functions and
+the most expensive queries, with:
+
+    python profiler.py --top 15 profiles
+"""
+
+import collections
+import functools
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+KEEP = int(os.environ.get('PROFILE_KEEP', 500))
+
+MAX_STACK_DEPTH = 64
+MAX_STATEMENT_LENGTH = 2000
+
+
+class Profile(object):
+    """The stack samples and SQL statements of one request."""
+
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        self.stacks = collections.Counter()
+        self.statements = []
+
+
+class Sampler(object):
+    """Samples the stacks of the threads that are handling a request."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._thread = None
+
+    def start(self, profile):
+        """Start sampling the current thread into profile."""
+        with self._lock:
+            self._profiles[threading.get_ident()] = profile
+            self._busy.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, profile):
+        """Stop sampling the thread that profile belongs to."""
+        with self._lock:
+            for thread_id, i in list(self._profiles.items()):
+                if i is profile:
+                    del self._profiles[thread_id]
+            if not self._profiles:
+                self._busy.clear()
+
+    def _run(self):
+        while True:
+            # Sleep without waking up while no request is in flight.
+            self._busy.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                profiles = list(self._profiles.items())
+            if not profiles:
+                continue
+            frames = sys._current_frames()
+            for thread_id, profile in profiles:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.stacks[stack_of(frame)] += 1
+
+
+def stack_of(frame):
+    """Return a frame's stack, outermost first, as function labels."""
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+sampler = Sampler(INTERVAL_MS / 1000.0)
+_sequence = itertools.count()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['profiler_start'].pop()
+    profile = g.get('profile') if has_request_context() else None
+    if profile is not None:
+        profile.statements.append((statement[:MAX_STATEMENT_LENGTH],
+                                   duration))
+
+
+def _start_request():
+    g.profile = Profile(sampled=random.random() < SAMPLE_RATE)
+    sampler.start(g.profile)
+
+
+def _finish(profile, app, endpoint, method, path, status):
+    """Write the profile if it was sampled or slow, and log slow requests."""
+    sampler.stop(profile)
+    duration_ms = (time.perf_counter() - profile.start) * 1000
+    slow = SLOW_MS and duration_ms >= SLOW_MS
+    if not (profile.sampled or slow):
+        return
+
+    path_written = write_profile({
+        'endpoint': endpoint,
+        'method': method,
+        'path': path,
+        'status': status,
+        'started_at': profile.started_at.isoformat(),
+        'duration_ms': round(duration_ms, 3),
+        'reason': 'slow' if slow else 'sampled',
+        'interval_ms': INTERVAL_MS,
+        'stacks': [{'stack': list(stack), 'samples': samples}
+                   for stack, samples in profile.stacks.most_common()],
+        'statements': [{'statement': statement,
+                        'duration_ms': round(duration * 1000, 3)}
+                       for statement, duration in profile.statements],
+    })
+    if slow:
+        app.logger.warning(
+            'Slow request: %s %s (%s) took %.0f ms with %d SQL statements '
+            '(%.0f ms); profile written to %s', method, path, endpoint,
+            duration_ms, len(profile.statements),
+            sum(i[1] for i in profile.statements) * 1000, path_written)
+
+
+def _finish_response(response):
+    """Finish the profile once the response, including streaming, is done."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        response.call_on_close(functools.partial(
+            _finish, profile, current_app._get_current_object(),
+            request.endpoint, request.method,
+            request.full_path.rstrip('?'), response.status_code))
+    return response
+
+
+def _finish_request(exception=None):
+    """Finish the profile of a request that failed before responding."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _finish(profile, current_app._get_current_object(), request.endpoint,
+                request.method, request.full_path.rstrip('?'), 500)
+
+
+def write_profile(data):
+    """Write one profile and drop the oldest beyond KEEP; return its path."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = '%s-%s-%d-%d.json' % (
+        datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f'),
+        data['endpoint'] or 'unmatched', os.getpid(), next(_sequence))
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+    profiles = sorted(i for i in os.listdir(PROFILE_DIR)
+                      if i.endswith('.json'))
+    for old in profiles[:max(0, len(profiles) - KEEP)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass
+    return path
+
+
+def instrument_engine(engine):
+    """Time the SQL statements of an engine, if profiling is enabled."""
+    if not (SAMPLE_RATE or SLOW_MS):
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app):
+    """Profile the requests of an app, if profiling is enabled."""
+    if not (SAMPLE_RATE or SLOW_MS):
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_finish_request)
+
+
+def load_profiles(directory):
+    """Yield every profile in a directory."""
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    yield json.load(f)
+            except (IOError, ValueError):
+                continue
+
+
+def report(directory, top=10, endpoint=None):
+    """Print the hottest functions and queries of each endpoint."""
+    endpoints = collections.defaultdict(lambda: {
+        'durations': [], 'self': collections.Counter(),
+        'total': collections.Counter(), 'samples': 0,
+        'queries': collections.defaultdict(lambda: [0, 0.0])})
+    for profile in load_profiles(directory):
+        name = profile['endpoint'] or 'unmatched'
+        if endpoint is not None and name != endpoint:
+            continue
+        summary = endpoints[name]
+        summary['durations'].append(profile['duration_ms'])
+        for i in profile['stacks']:
+            summary['samples'] += i['samples']
+            summary['self'][i['stack'][-1]] += i['samples']
+            for function in set(i['stack']):
+                summary['total'][function] += i['samples']
+        for i in profile['statements']:
+            query = summary['queries'][' '.join(i['statement'].split())]
+            query[0] += 1
+            query[1] += i['duration_ms']
+
+    for name, summary in sorted(endpoints.items()):
+        durations = sorted(summary['durations'])
+        samples = summary['samples'] or 1
+        print('%s: %d profiles, median %.1f ms, max %.1f ms' % (
+            name, len(durations), durations[len(durations) // 2],
+            durations[-1]))
+        print('  self%   total%  function')
+        for function, count in summary['self'].most_common(top):
+            print('  %5.1f  %6.1f   %s' % (
+                count * 100.0 / samples,
+                summary['total'][function] * 100.0 / samples, function))
+        print('  calls  total ms  mean ms  query')
+        queries = sorted(summary['queries'].items(),
+                         key=lambda i: i[1][1], reverse=True)
+        for query, (calls, total_ms) in queries[:top]:
+            print('  %5d  %8.1f  %7.2f  %s' % (calls, total_ms,
+                                               total_ms / calls, query[:160]))
+        print('')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Summarize request profiles per endpoint.')
+    parser.add_argument('directory', nargs='?', default=PROFILE_DIR,
+                        help='directory holding the profiles')
+    parser.add_argument('--top', type=int, default=10,
+                        help='functions and queries to show per endpoint')
+    parser.add_argument('--endpoint', help='only show this endpoint')
+    args = parser.parse_args()
+    report(args.directory, args.top, args.endpoint)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Workout program generation for the Workout Programming App.
+
+A template is a list of template items, each pointing at a secondary
+category. Generating a program expands every item into a concrete exercise
+drawn from that category, using only exercises the user can perform with the
+equipment they own. Optional equipment (is_optional in
+exercise_equipment_reference) never rules an exercise out; it is listed with
+the exercise when the user owns it.
+
+A whole template is resolved with two queries: one for the template and its
+items, one for every candidate exercise with its equipment references.
+"""
+
+import random
+
+from sqlalchemy.orm import joinedload
+
+from database_setup import (
+    ExerciseEquipmentReference,
+    Exercises,
+    Templates,
+)
+
+
+def load_template(session, template_id):
+    """Return the template with its items, or None if it does not exist."""
+    return (
+        session.query(Templates)
+        .options(joinedload(Templates.items))
+        .filter_by(id=template_id).one_or_none()
+    )
+
+
+def load_exercise_pools(session, secondary_ids):
+    """Return the candidate exercises of each secondary category.
+
+    The result maps a secondary category ID to a list of exercises. Each
+    exercise is a dictionary with its serialize fields, its slug, and the
+    sets of required and optional equipment IDs.
+    """
+    pools = {i: [] for i in secondary_ids}
+    if not pools:
+        return pools
+
+    rows = (
+        session.query(Exercises.id,
+                      Exercises.name,
+                      Exercises.slug,
+                      Exercises.description,
+                      Exercises.video_url,
+                      Exercises.secondary_category,
+                      ExerciseEquipmentReference.equipment_id,
+                      ExerciseEquipmentReference.is_optional)
+        .outerjoin(ExerciseEquipmentReference,
+                   ExerciseEquipmentReference.exercise_id == Exercises.id)
+        .filter(Exercises.secondary_category.in_(list(pools)))
+        .order_by(Exercises.id)
+    )
+
+    exercise = None
+    for row in rows:
+        if exercise is None or exercise['id'] != row.id:
+            exercise = {
+                'id': row.id,
+                'name': row.name,
+                'slug': row.slug,
+                'description': row.description,
+                'video_url': row.video_url,
+                'secondary_category': row.secondary_category,
+                'required': set(),
+                'optional': set(),
+            }
+            pools[row.secondary_category].append(exercise)
+        if row.equipment_id is not None:
+            if row.is_optional:
+                exercise['optional'].add(row.equipment_id)
+            else:
+                exercise['required'].add(row.equipment_id)
+    return pools
+
+
+def is_feasible(exercise, owned_equipment):
+    """Return True if the user owns every piece of required equipment.
+
+    owned_equipment of None means the user has access to all equipment.
+    """
+    return owned_equipment is None or exercise['required'] <= owned_equipment
+
+
+def expand_template(template, pools, owned_equipment=None, rng=random):
+    """Expand a loaded template into a program.
+
+    Each item gets a random feasible exercise from its secondary category.
+    Exercises are not repeated within a program unless a category runs out
+    of alternatives. Items without a feasible exercise get None.
+    """
+    used = set()
+    items = []
+    for item in template.items:
+        candidates = [i for i in pools.get(item.secondary_category, ())
+                      if is_feasible(i, owned_equipment)]
+        unused = [i for i in candidates if i['id'] not in used]
+        choice = rng.choice(unused or candidates) if candidates else None
+
+        exercise = None
+        if choice is not None:
+            used.add(choice['id'])
+            optional = choice['optional']
+            if owned_equipment is not None:
+                optional = optional & owned_equipment
+            exercise = {
+                'id': choice['id'],
+                'name': choice['name'],
+                'slug': choice['slug'],
+                'description': choice['description'],
+                'video_url': choice['video_url'],
+                'required_equipment': sorted(choice['required']),
+                'optional_equipment': sorted(optional),
+            }
+        items.append(dict(item.serialize,
+                          secondary_category=item.secondary_category,
+                          Exercise=exercise))
+
+    return {'Template': template.serialize, 'Items': items}
+
+
+def generate_program(session, template_id, owned_equipment=None, rng=random):
+    """Generate a program from a template, or return None if it is missing.
+
+    owned_equipment is a set of equipment IDs, or None for all equipment.
+    """
+    template = load_template(session, template_id)
+    if template is None:
+        return None
+    secondary_ids = {i.secondary_category for i in template.items}
+    secondary_ids.discard(None)
+    pools = load_exercise_pools(session, secondary_ids)
+    return expand_template(template, pools, owned_equipment, rng)
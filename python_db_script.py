@@ -1,43 +1,230 @@
 #!/usr/bin/env python
+import argparse
+import os
+import time
+
 import psycopg2
 
 
 """Python script to populate exercisecatlog database with
-pre-made information from csv files"""
-
-def database_connection():
-    '''Connects to PostgreSQL database using DB-API
-    and queries the DB with the above SQL.'''
-
-    db = psycopg2.connect("dbname=exercisecatalog")
-    c = db.cursor()
-
-    with open('primary_categories.csv', 'r') as f:
-        c.copy_from(f, 'primary_categories', sep=',')
-
+pre-made information from csv files.
+
+Every CSV file is copied with PostgreSQL COPY into a temporary staging table,
+then merged into the live table with set-based SQL, all in one transaction.
+Rows are matched on their natural keys, so the script can be re-run safely:
+existing rows are updated and only new rows are inserted. The load bumps the
+catalog version, so running app workers drop their cached catalog, and then
+queues an export of the catalog snapshot if --snapshot-directory (by default
+CATALOG_SNAPSHOT_DIR) is set.
+
+    python python_db_script.py [--dsn DSN] [--directory DIR]
+"""
+
+# Staging tables mirror the CSV columns. line_no records the position of
+# each row in its file, which is how reference_table.csv points at
+# equipment rows.
+STAGING_TABLES = """
+CREATE TEMPORARY TABLE staging_primary_categories (
+    line_no serial,
+    name varchar(250),
+    description text,
+    picture varchar(250)
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE staging_equipment (
+    line_no serial,
+    name varchar(250),
+    image varchar(250)
+) ON COMMIT DROP;
+
+CREATE TEMPORARY TABLE staging_reference (
+    exercise_id integer,
+    equipment_id integer,
+    is_optional boolean
+) ON COMMIT DROP;
+"""
+
+# (CSV file, staging table, columns in the file)
+CSV_FILES = [
+    ('primary_categories.csv', 'staging_primary_categories',
+     'name, description, picture'),
+    ('equipment_table.csv', 'staging_equipment', 'name, image'),
+    ('reference_table.csv', 'staging_reference',
+     'exercise_id, equipment_id, is_optional'),
+]
+
+MERGE_PRIMARY_CATEGORIES = """
+UPDATE primary_categories AS p
+SET description = s.description, picture = s.picture
+FROM staging_primary_categories AS s
+WHERE p.name = s.name;
+
+INSERT INTO primary_categories (name, description, picture)
+SELECT DISTINCT ON (s.name) s.name, s.description, s.picture
+FROM staging_primary_categories AS s
+WHERE NOT EXISTS (
+    SELECT 1 FROM primary_categories AS p WHERE p.name = s.name)
+ORDER BY s.name, s.line_no;
+"""
+
+MERGE_EQUIPMENT = """
+UPDATE equipment AS e
+SET image = s.image
+FROM staging_equipment AS s
+WHERE e.name = s.name;
+
+INSERT INTO equipment (id, name, image)
+SELECT nextval('equipment_id'), name, image FROM (
+    SELECT DISTINCT ON (s.name) s.name, s.image, s.line_no
+    FROM staging_equipment AS s
+    WHERE NOT EXISTS (SELECT 1 FROM equipment AS e WHERE e.name = s.name)
+    ORDER BY s.name, s.line_no
+) AS new_equipment
+ORDER BY line_no;
+"""
+
+# The equipment_id in reference_table.csv is the row number of the piece of
+# equipment in equipment_table.csv; it is resolved to the live equipment ID
+# through the equipment name. References to exercises that do not exist are
+# skipped.
+RESOLVE_REFERENCES = """
+CREATE TEMPORARY TABLE resolved_reference ON COMMIT DROP AS
+SELECT DISTINCT ON (r.exercise_id, e.id)
+       r.exercise_id, e.id AS equipment_id, r.is_optional
+FROM staging_reference AS r
+JOIN staging_equipment AS s ON s.line_no = r.equipment_id
+JOIN equipment AS e ON e.name = s.name
+JOIN exercises AS x ON x.id = r.exercise_id
+ORDER BY r.exercise_id, e.id;
+
+CREATE INDEX ON resolved_reference (exercise_id, equipment_id);
+ANALYZE resolved_reference;
+"""
+
+MERGE_REFERENCES = """
+UPDATE exercise_equipment_reference AS x
+SET is_optional = r.is_optional
+FROM resolved_reference AS r
+WHERE x.exercise_id = r.exercise_id
+  AND x.equipment_id = r.equipment_id
+  AND x.is_optional IS DISTINCT FROM r.is_optional;
+
+INSERT INTO exercise_equipment_reference
+    (id, exercise_id, equipment_id, is_optional)
+SELECT nextval('reference_id'), r.exercise_id, r.equipment_id, r.is_optional
+FROM resolved_reference AS r
+WHERE NOT EXISTS (
+    SELECT 1 FROM exercise_equipment_reference AS x
+    WHERE x.exercise_id = r.exercise_id
+      AND x.equipment_id = r.equipment_id);
+"""
+
+
+def copy_csv(cursor, path, table, columns):
+    """COPY a CSV file with a header line into a staging table.
+
+    Return the number of rows copied.
     """
+    with open(path, 'r') as f:
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER true)'
+            % (table, columns), f)
+    return cursor.rowcount
 
-    with open('secondary_categories.csv', 'r') as f:
-        c.copy_from(f, 'secondary_categories', sep=',')
-
-    with open('exercises.csv', 'r') as f:
-        c.copy_from(f, 'exercises', sep=',')
-
-    with open('additional_categories.csv', 'r') as f:
-        c.copy_from(f, 'additional_categories', sep=',')
 
-    """
-
-    #populate_database(c)
-
-    db.commit()
-    db.close()
-
-
-
-#def populate_database(connection):
-    #""""""
+def database_connection(dsn='dbname=exercisecatalog', directory='.'):
+    '''Connects to PostgreSQL database using DB-API
+    and loads every catalog CSV file in a single transaction.'''
+
+    db = psycopg2.connect(dsn)
+    try:
+        with db:
+            c = db.cursor()
+            c.execute(STAGING_TABLES)
+
+            for filename, table, columns in CSV_FILES:
+                start = time.time()
+                rows = copy_csv(c, os.path.join(directory, filename),
+                                table, columns)
+                report(filename, rows, time.time() - start)
+
+            populate_database(c)
+    finally:
+        db.close()
+
+
+def populate_database(c):
+    """Merge the staging tables into the live tables."""
+    start = time.time()
+    c.execute(MERGE_PRIMARY_CATEGORIES)
+    c.execute('SELECT count(*) FROM staging_primary_categories')
+    report('primary_categories', c.fetchone()[0], time.time() - start)
+
+    start = time.time()
+    c.execute(MERGE_EQUIPMENT)
+    c.execute('SELECT count(*) FROM staging_equipment')
+    report('equipment', c.fetchone()[0], time.time() - start)
+
+    start = time.time()
+    c.execute(RESOLVE_REFERENCES)
+    c.execute(MERGE_REFERENCES)
+    c.execute('SELECT count(*) FROM staging_reference')
+    staged = c.fetchone()[0]
+    c.execute('SELECT count(*) FROM resolved_reference')
+    resolved = c.fetchone()[0]
+    report('exercise_equipment_reference', resolved, time.time() - start)
+    if resolved < staged:
+        print('  skipped %d references to unknown exercises, unknown '
+              'equipment, or duplicates' % (staged - resolved))
+
+    # Databases that have not been migrated yet have no catalog version. Any
+    # exercise may have changed, so equipment indexes rebuild in full.
+    c.execute("SELECT to_regclass('catalog_version'), "
+              "to_regclass('catalog_changes')")
+    version_table, changes_table = c.fetchone()
+    if version_table is not None:
+        c.execute('UPDATE catalog_version SET version = version + 1')
+    if version_table is not None and changes_table is not None:
+        c.execute("INSERT INTO catalog_changes (id, version) "
+                  "SELECT nextval('catalog_change_id'), version "
+                  "FROM catalog_version WHERE id = 1")
+
+
+def queue_snapshot_export(dsn, directory):
+    """Queue an export of the catalog snapshot in directory, see jobs."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    import jobs
+
+    engine = create_engine('postgresql+psycopg2://',
+                           creator=lambda: psycopg2.connect(dsn))
+    try:
+        with Session(engine) as session:
+            jobs.queue_snapshot_export(session, directory)
+            session.commit()
+    finally:
+        engine.dispose()
+
+
+def report(name, rows, seconds):
+    """Print how many rows were processed and how fast."""
+    rate = rows / seconds if seconds > 0 else float(rows)
+    print('%-30s %9d rows %8.2fs %12.0f rows/s' % (name, rows, seconds, rate))
 
 
 if __name__ == '__main__':
-    database_connection()
+    parser = argparse.ArgumentParser(
+        description='Load the catalog CSV files into exercisecatalog.')
+    parser.add_argument('--dsn', default='dbname=exercisecatalog',
+                        help='libpq connection string')
+    parser.add_argument('--directory', default='.',
+                        help='directory containing the CSV files')
+    parser.add_argument('--snapshot-directory',
+                        default=os.environ.get('CATALOG_SNAPSHOT_DIR'),
+                        help='catalog snapshot directory to queue an export '
+                             'of after the load')
+    args = parser.parse_args()
+    database_connection(args.dsn, args.directory)
+    if args.snapshot_directory:
+        queue_snapshot_export(args.dsn, args.snapshot_directory)
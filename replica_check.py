@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Check that requests are routed between the primary and the replica.
+
+The check seeds a small synthetic catalog (see benchmark.py) into the primary,
+then sends requests as an anonymous visitor and as a user who adds an
+exercise, counting the SQL statements each database receives:
+
+* anonymous page views read the replica,
+* the add route and the login write to and read from the primary,
+* the writer's next page views read the primary (read-your-writes) and show
+  the new exercise, even when the process caches hold the replica's older
+  rows, until REPLICA_STICKY_SECONDS have passed.
+
+By default the primary and the replica are two temporary SQLite files, the
+replica being a copy of the seeded primary that never receives writes:
+
+    python replica_check.py
+
+To check two PostgreSQL instances, the replica streaming from the primary,
+pass both URLs. Every table of the primary is dropped, so only use throwaway
+databases:
+
+    python replica_check.py --database-url postgresql://localhost:5432/bench \\
+        --replica-url postgresql://localhost:5433/bench
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func
+
+import benchmark
+from database_setup import Exercises
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STICKY_SECONDS = 1
+
+
+def wait_for_replica(url, exercises, timeout=60):
+    """Wait until the replica has replayed the seeded exercises."""
+    engine = create_engine(url)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            with engine.connect() as connection:
+                try:
+                    count = connection.scalar(func.count(Exercises.id))
+                except Exception:
+                    count = None
+            if count == exercises:
+                return
+            if time.monotonic() > deadline:
+                raise SystemExit('The replica has not caught up with the '
+                                 'seeded primary after %ds' % timeout)
+            time.sleep(0.5)
+    finally:
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the routing of reads and writes to the replica.')
+    parser.add_argument('--database-url',
+                        help='throwaway primary database to seed; every '
+                             'table is dropped (default: a temporary SQLite '
+                             'file)')
+    parser.add_argument('--replica-url',
+                        help='replica of --database-url (default: a copy of '
+                             'the seeded SQLite file)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if bool(args.database_url) != bool(args.replica_url):
+        parser.error('pass both --database-url and --replica-url, or neither')
+
+    directory = None
+    database_url, replica_url = args.database_url, args.replica_url
+    if database_url is None:
+        directory = tempfile.mkdtemp(prefix='catalog-replica-')
+        database_url = 'sqlite:///%s' % os.path.join(directory, 'primary.db')
+        replica_url = 'sqlite:///%s' % os.path.join(directory, 'replica.db')
+
+    rng = random.Random(args.seed)
+    failures = []
+
+    def check(description, passed):
+        print('%s  %s' % ('ok  ' if passed else 'FAIL', description))
+        if not passed:
+            failures.append(description)
+
+    try:
+        engine = create_engine(database_url)
+        catalog = benchmark.seed(engine, dict(benchmark.SCALES['tiny']), rng)
+        engine.dispose()
+        if directory is not None:
+            shutil.copy(os.path.join(directory, 'primary.db'),
+                        os.path.join(directory, 'replica.db'))
+        else:
+            wait_for_replica(replica_url, len(catalog['exercises']))
+
+        import application
+        application.create_app({
+            'DATABASE_URL': database_url,
+            'DATABASE_REPLICA_URL': replica_url,
+            'REPLICA_STICKY_SECONDS': STICKY_SECONDS,
+            'SECRET_KEY': 'replica',
+            'CLIENT_SECRETS': os.environ.get(
+                'CLIENT_SECRETS', os.path.join(HERE, 'client_secrets.json')),
+        })
+        application.get_engine()
+        primary = benchmark.QueryCounter(application.engine)
+        replica = benchmark.QueryCounter(application.replica_engine)
+        recorder = benchmark.Recorder(primary)
+
+        def get(client, url, clear=True):
+            """GET url, with empty caches unless clear is False.
+
+            Return (body, primary, replica).
+            """
+            if clear:
+                benchmark.clear_caches(application)
+            primary.reset()
+            replica.reset()
+            response = client.get(url)
+            return (response.get_data(as_text=True), primary.count,
+                    replica.count)
+
+        primary_id, secondary_id = rng.choice(catalog['secondary'])
+        category = '/exercises/%d/%d/' % (primary_id, secondary_id)
+        name = 'Replica check exercise'
+        visitor = application.app.test_client()
+        writer = application.app.test_client()
+
+        with benchmark.stub_google(application):
+            body, on_primary, on_replica = get(visitor, category)
+            check('anonymous page view reads the replica',
+                  on_replica and not on_primary)
+
+            primary.reset()
+            replica.reset()
+            benchmark.log_in(recorder, writer, 'writer')
+            check('login writes to the primary only',
+                  primary.count and not replica.count)
+
+            body, on_primary, on_replica = get(writer, category + 'add/')
+            check('add form reads the primary', on_primary and not on_replica)
+
+            primary.reset()
+            replica.reset()
+            response = writer.post(category + 'add/', data={
+                'name': name, 'description': 'Added by replica_check.py.',
+                'video_url': 'https://www.youtube.com/embed/replica'})
+            check('add writes to the primary only',
+                  response.status_code == 302 and primary.count and
+                  not replica.count)
+
+            body, on_primary, on_replica = get(writer, category)
+            check('writer reads their write from the primary',
+                  name in body and on_primary and not on_replica)
+
+            body, on_primary, on_replica = get(visitor, category)
+            check('anonymous page view still reads the replica',
+                  on_replica and not on_primary)
+
+            # The visitor's view cached the replica's rows, which do not
+            # have the new exercise yet.
+            body, on_primary, on_replica = get(writer, category, clear=False)
+            check('writer reads their write past the process caches',
+                  name in body and on_primary and not on_replica)
+
+            time.sleep(STICKY_SECONDS)
+            body, on_primary, on_replica = get(writer, category)
+            check('writer reads the replica again after %ds' %
+                  STICKY_SECONDS, on_replica and not on_primary)
+
+        application.dispose_engines()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Import-time budget check for worker cold starts.
+
+The application is imported in fresh interpreters with python -X importtime.
+The check fails when the median import time is over the budget, or when one
+of the modules that should only be loaded on first use (the OAuth and HTTP
+clients, the database driver, Pillow) is imported eagerly:
+
+    python startup_check.py --budget-ms 650
+
+The modules that take the longest to import are listed, to show where the
+time goes when the budget is exceeded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MODULE = 'application'
+DEFAULT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 650))
+
+# Imported by the login routes, the database engine or the image build step
+# when they are first used, never by importing the application.
+LAZY_MODULES = ('oauth2client', 'httplib2', 'requests', 'psycopg2', 'PIL')
+
+PROBE = ('import sys, json, {module}; '
+         'print(json.dumps([m for m in {lazy!r} if m in sys.modules]))')
+
+
+def parse_importtime(output):
+    """Return (depth, name, self us, cumulative us) for each import line."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure(module):
+    """Import module in a fresh interpreter; return its imports and lazies."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         PROBE.format(module=module, lazy=LAZY_MODULES)],
+        cwd=HERE, capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr), json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the import time of the application.')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='maximum median import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh interpreters to measure')
+    parser.add_argument('--top', type=int, default=10,
+                        help='slowest imports to list')
+    parser.add_argument('--module', default=MODULE,
+                        help='module to import')
+    args = parser.parse_args()
+
+    totals = []
+    for run in range(args.runs):
+        imports, eager = measure(args.module)
+        totals.extend(i[3] / 1000.0 for i in imports
+                      if i[0] == 0 and i[1] == args.module)
+    median = statistics.median(totals)
+
+    print('import %s: median %.0f ms over %d runs (budget %.0f ms)' % (
+        args.module, median, args.runs, args.budget_ms))
+    print('slowest imports (cumulative ms):')
+    children = sorted((i for i in imports if i[0] == 1),
+                      key=lambda i: i[3], reverse=True)
+    for depth, name, self_us, cumulative_us in children[:args.top]:
+        print('  %8.1f  %s' % (cumulative_us / 1000.0, name))
+
+    failed = False
+    if median > args.budget_ms:
+        print('FAIL: import time is over budget')
+        failed = True
+    if eager:
+        print('FAIL: imported eagerly: %s' % ', '.join(eager))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+"""
+Responsive image variants for the pictures in static/img.
+
+The build step resizes every image in static/img to a few widths, in WebP
+and JPEG, and writes them to static/build under content-hashed file names
+(back.3f2a9c01-640.webp), served from /static/build/. A manifest records
+the variants of each source image together with the hash of the source, so
+re-running the build only reprocesses images that changed:
+
+    python static_images.py
+
+A build keeps the variants of the manifest it replaces, and only deletes
+them at the next build that changes the manifest. Pages rendered from the
+previous manifest, and still cached, therefore keep working.
+
+At runtime the responsive_image() template helper turns a picture path as
+stored in the database (img/back.jpg) into a <picture> element with WebP
+and JPEG srcsets. Images missing from the manifest fall back to the
+original file. The manifest is reloaded when a build replaces it, checked at
+most every MANIFEST_CHECK_SECONDS, so running workers pick up a new build
+without a restart. The hashed files never change, so they are served with
+far-future cache headers.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from flask import url_for
+from markupsafe import escape, Markup
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(HERE, 'static')
+BUILD_DIR = os.path.join(HERE, 'static', 'build')
+MANIFEST = os.path.join(BUILD_DIR, 'manifest.json')
+# The variants of the previous manifest, kept for one more build.
+PREVIOUS = os.path.join(BUILD_DIR, 'previous.json')
+MANIFEST_CHECK_SECONDS = float(
+    os.environ.get('STATIC_MANIFEST_CHECK_SECONDS', 1))
+
+WIDTHS = (320, 640, 1024)
+FORMATS = (('webp', 'WEBP', {'quality': 80, 'method': 6}),
+           ('jpg', 'JPEG', {'quality': 82, 'optimize': True,
+                            'progressive': True}))
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+_manifest = None
+_manifest_mtime = None
+_manifest_version = None
+_checked_at = None
+
+
+def file_hash(path):
+    """Return the SHA-1 of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_variants(picture, source_hash):
+    """Write the resized variants of one picture and return its entry."""
+    from PIL import Image
+
+    stem = os.path.splitext(os.path.basename(picture))[0]
+    with Image.open(os.path.join(SOURCE_DIR, picture)) as original:
+        original.seek(0)
+        rgba = original.convert('RGBA')
+
+    # JPEG has no transparency, so flatten transparent images onto white.
+    image = Image.new('RGB', rgba.size, 'white')
+    image.paste(rgba, mask=rgba.getchannel('A'))
+
+    entry = {'hash': source_hash, 'width': image.width, 'variants': {}}
+    widths = [i for i in WIDTHS if i < image.width] or [image.width]
+    for extension, image_format, options in FORMATS:
+        variants = {}
+        for width in widths:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+            name = '%s.%s-%d.%s' % (stem, source_hash[:8], width, extension)
+            resized.save(os.path.join(BUILD_DIR, name), image_format,
+                         **options)
+            variants[width] = name
+        entry['variants'][extension] = variants
+    return entry
+
+
+def variant_names(manifest):
+    """Return the file names of every variant in a manifest."""
+    return {os.path.basename(path)
+            for entry in manifest.values()
+            for variants in entry['variants'].values()
+            for path in variants.values()}
+
+
+def read_json(path, default):
+    """Return the content of a JSON file, or default if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    """Replace a JSON file, so readers see either the old or the new one."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def build(force=False):
+    """Build variants for every changed image and rewrite the manifest.
+
+    Return the new manifest.
+    """
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    old_manifest = read_json(MANIFEST, {})
+    manifest = {} if force else dict(old_manifest)
+
+    pictures = sorted(
+        'img/' + i for i in os.listdir(os.path.join(SOURCE_DIR, 'img'))
+        if i.lower().endswith(EXTENSIONS))
+    built = 0
+    for picture in pictures:
+        source_hash = file_hash(os.path.join(SOURCE_DIR, picture))
+        entry = manifest.get(picture)
+        if entry is not None and entry['hash'] == source_hash:
+            continue
+        manifest[picture] = build_variants(picture, source_hash)
+        built += 1
+
+    # Drop entries for images that were removed.
+    for picture in set(manifest) - set(pictures):
+        del manifest[picture]
+
+    # Workers and cached pages may still use the variants of the old
+    # manifest, so they are kept until the manifest changes again.
+    current = variant_names(manifest)
+    previous = set(read_json(PREVIOUS, []))
+    if manifest != old_manifest:
+        previous = variant_names(old_manifest) - current
+    write_json(PREVIOUS, sorted(previous))
+    write_json(MANIFEST, manifest)
+
+    keep = current | previous | {os.path.basename(MANIFEST),
+                                 os.path.basename(PREVIOUS)}
+    for name in os.listdir(BUILD_DIR):
+        if name not in keep:
+            os.remove(os.path.join(BUILD_DIR, name))
+    print('Built %d of %d images into %s' % (built, len(pictures), BUILD_DIR))
+    return manifest
+
+
+def manifest():
+    """Return the image manifest, reloading it if a build replaced it."""
+    global _manifest, _manifest_mtime, _manifest_version, _checked_at
+    now = time.monotonic()
+    if _manifest is not None and now - _checked_at < MANIFEST_CHECK_SECONDS:
+        return _manifest
+    _checked_at = now
+    try:
+        mtime = os.stat(MANIFEST).st_mtime_ns
+    except OSError:
+        mtime = None
+    if _manifest is None or mtime != _manifest_mtime:
+        _manifest = read_json(MANIFEST, {})
+        _manifest_mtime = mtime
+        _manifest_version = hashlib.sha1(json.dumps(
+            _manifest, sort_keys=True).encode('utf8')).hexdigest()
+    return _manifest
+
+
+def manifest_version():
+    """Return a hash of the current image manifest.
+
+    Pages that show images change with it, so it is part of their ETags.
+    """
+    manifest()
+    return _manifest_version
+
+
+def responsive_image(picture, alt='', css_class='', sizes='100vw'):
+    """Return a <picture> element with srcsets for a static image path."""
+    attributes = 'alt="%s" class="%s"' % (escape(alt), escape(css_class))
+    entry = manifest().get(picture)
+    if entry is None:
+        return Markup('<img src="%s" %s>' % (
+            url_for('static', filename=picture), attributes))
+
+    def srcset(variants):
+        return ', '.join('%s %sw' % (url_for('static_build', filename=path),
+                                     width)
+                         for width, path in sorted(variants.items(),
+                                                   key=lambda i: int(i[0])))
+
+    jpeg = entry['variants']['jpg']
+    widths = sorted(jpeg, key=int)
+    fallback = jpeg[widths[len(widths) // 2]]
+    return Markup(
+        '<picture>'
+        '<source type="image/webp" srcset="%s" sizes="%s">'
+        '<img src="%s" srcset="%s" sizes="%s" %s loading="lazy">'
+        '</picture>' % (srcset(entry['variants']['webp']), sizes,
+                        url_for('static_build', filename=fallback),
+                        srcset(jpeg), sizes, attributes))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Build responsive variants of the static images.')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every image, not just changed ones')
+    build(parser.parse_args().force)
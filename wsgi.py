@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+"""
+WSGI entrypoint for serving the Exercise Catalog in production.
+
+Run it under gunicorn with the settings in gunicorn.conf.py:
+
+    SECRET_KEY=... DATABASE_URL=postgresql:///exercisecatalog \
+        gunicorn -c gunicorn.conf.py wsgi:app
+
+Any other WSGI server can serve wsgi:app as well. Each worker process
+connects to the database on first use, so the app can be loaded before the
+server forks its workers.
+"""
+
+from application import create_app
+
+app = create_app()